@@ -21,9 +21,14 @@ Dependencies
 from __future__ import absolute_import
 
 # Import python lib
+import time
 import logging
 log = logging.getLogger(__file__)
 
+from collections import deque
+
+from salt.ext import six
+
 
 try:
     # will try to import NAPALM
@@ -43,6 +48,30 @@ __virtualname__ = 'bgp'
 __proxyenabled__ = ['napalm']
 # uses NAPALM-based proxy to interact with network devices
 
+# ----------------------------------------------------------------------------------------------------------------------
+# global variables
+# ----------------------------------------------------------------------------------------------------------------------
+
+NEIGHBORS_STATE = {}
+# last state polled, by neighbor: up/down, remote AS and accepted prefixes per address family
+
+NEIGHBORS_FLAPS = {}
+# flap history and dampening penalty, by neighbor
+
+FLAPS_KEPT = 50
+# number of transitions remembered for each neighbor
+
+PREFIX_THRESHOLD = '10%'
+# default change of the accepted prefixes triggering an event: count or percentage
+
+DAMPENING = {
+    'penalty': 1000.0,
+    'half_life': 900,
+    'suppress': 2000.0,
+    'reuse': 750.0
+}
+# dampening parameters, as in RFC 2439: penalty added on each flap, decaying by half every `half_life` seconds
+
 # ----------------------------------------------------------------------------------------------------------------------
 # property functions
 # ----------------------------------------------------------------------------------------------------------------------
@@ -65,6 +94,96 @@ def __virtual__():
 # helper functions -- will not be exported
 # ----------------------------------------------------------------------------------------------------------------------
 
+
+def _neighbors_state(bgp_neighbors):
+
+    '''
+    Flattens the output of `get_bgp_neighbors` into the compact state kept per neighbor.
+    '''
+
+    state = {}
+
+    for vrf, vrf_details in six.iteritems(bgp_neighbors or {}):
+        for neighbor, neighbor_details in six.iteritems(vrf_details.get('peers', {})):
+            key = '{vrf}/{neighbor}'.format(vrf=vrf, neighbor=neighbor)
+            state[key] = {
+                'vrf': vrf,
+                'neighbor': neighbor,
+                'up': neighbor_details.get('is_up', False),
+                'remote_as': neighbor_details.get('remote_as'),
+                'prefixes': dict(
+                    (family, family_details.get('accepted_prefixes', -1))
+                    for family, family_details in six.iteritems(neighbor_details.get('address_family', {}))
+                )
+            }
+            state[key]['reported'] = dict(state[key]['prefixes'])
+            # accepted prefixes at the last event, the base of the next comparison
+
+    return state
+
+
+def _prefix_delta_exceeded(previous, current, threshold):
+
+    if previous < 0 or current < 0:
+        return False  # not available on this platform
+
+    if isinstance(threshold, six.string_types) and threshold.endswith('%'):
+        return abs(current - previous) * 100.0 > float(threshold[:-1]) * max(previous, 1)
+
+    return abs(current - previous) > int(threshold)
+
+
+def _decay_penalty(flaps, now, half_life):
+
+    elapsed = now - flaps['updated']
+    flaps['penalty'] *= 0.5 ** (float(elapsed) / half_life)
+    flaps['updated'] = now
+    if flaps['suppressed'] and flaps['penalty'] < DAMPENING['reuse']:
+        flaps['suppressed'] = False
+
+    return flaps
+
+
+def _record_flap(key, up, now, half_life):
+
+    '''
+    Remembers the transition and updates the dampening penalty of the neighbor.
+    '''
+
+    flaps = NEIGHBORS_FLAPS.setdefault(key, {
+        'history': deque(maxlen=FLAPS_KEPT),
+        'count': 0,
+        'penalty': 0.0,
+        'suppressed': False,
+        'updated': now
+    })
+    _decay_penalty(flaps, now, half_life)
+    flaps['history'].append((now, 'up' if up else 'down'))
+    if not up:
+        flaps['count'] += 1
+        flaps['penalty'] += DAMPENING['penalty']
+        if flaps['penalty'] > DAMPENING['suppress']:
+            flaps['suppressed'] = True
+
+    return flaps
+
+
+def _send_event(state, neighbor_state, **data):
+
+    data.update({
+        'vrf': neighbor_state['vrf'],
+        'neighbor': neighbor_state['neighbor'],
+        'remote_as': neighbor_state['remote_as']
+    })
+    __salt__['event.send'](
+        'napalm/bgp/{vrf}/{neighbor}/{state}'.format(
+            vrf=neighbor_state['vrf'],
+            neighbor=neighbor_state['neighbor'],
+            state=state
+        ),
+        data
+    )
+
 # ----------------------------------------------------------------------------------------------------------------------
 # callable functions
 # ----------------------------------------------------------------------------------------------------------------------
@@ -284,3 +403,273 @@ def neighbors(neighbor=None):
             'neighbor_address': neighbor
         }
     )
+
+
+def sessions():
+
+    '''
+    Provides the summary of the BGP sessions, including their uptime.
+
+    :return: A dictionary having the VRF name as key, and the router ID and the peers as values.
+    Each peer has the following keys:
+
+        * local_as (int)
+        * remote_as (int)
+        * remote_id (string)
+        * is_up (True/False)
+        * is_enabled (True/False)
+        * description (string)
+        * uptime (int): seconds since the session changed state
+        * address_family (dict): received, accepted and sent prefixes, per address family
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' bgp.sessions
+
+    Output Example:
+
+    .. code-block:: python
+
+        {
+            'global': {
+                'router_id': u'192.168.0.1',
+                'peers': {
+                    u'192.247.78.0': {
+                        'local_as': 13335,
+                        'remote_as': 8121,
+                        'remote_id': u'192.247.78.1',
+                        'is_up': True,
+                        'is_enabled': True,
+                        'description': u'NTT',
+                        'uptime': 123456,
+                        'address_family': {
+                            'ipv4': {
+                                'received_prefixes': 566739,
+                                'accepted_prefixes': 566479,
+                                'sent_prefixes': 10
+                            }
+                        }
+                    }
+                }
+            }
+        }
+    '''
+
+    return __proxy__['napalm.call'](
+        'get_bgp_neighbors',
+        **{
+        }
+    )
+
+
+def monitor(prefix_threshold=None, half_life=None):
+
+    '''
+    Polls the BGP neighbors and compares their state with the previous poll, kept on the proxy.
+    Only the changes are sent as events on the Salt bus, tagged as ``napalm/bgp/<vrf>/<neighbor>/<change>``:
+
+    - ``up`` / ``down``: the session changed state
+    - ``prefixes``: the number of accepted prefixes changed more than `prefix_threshold`
+    - ``added`` / ``removed``: the neighbor appeared or disappeared from the configuration
+
+    Each transition is kept in the flap history of the neighbor, together with a dampening penalty:
+    every session going down adds 1000 to the penalty, which decays by half every `half_life` seconds.
+    The neighbor is marked as suppressed while the penalty is above 2000, until it drops below 750.
+
+    This function is meant to be executed periodically by the scheduler, without returning the job to the master,
+    e.g., in the proxy config:
+
+    .. code-block:: yaml
+
+        schedule:
+          bgp:
+            function: bgp.monitor
+            seconds: 30
+            return_job: False
+
+    :param prefix_threshold: Change of the accepted prefixes triggering an event: number of prefixes (e.g.: `1000`)
+    or percentage (e.g.: `5%`). If not specified, will use the value of the ``napalm_bgp_prefix_threshold`` option,
+    falling back to 10%.
+    :param half_life: Seconds after which the dampening penalty is reduced by half. If not specified, will use
+    the value of the ``napalm_bgp_dampening_half_life`` option, falling back to 900 seconds.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' bgp.monitor
+        salt '*' bgp.monitor prefix_threshold=1000
+
+    Example output:
+
+    .. code-block:: python
+
+        {
+            'out': {
+                'neighbors': 12,
+                'up': 11,
+                'changes': 1,
+                'suppressed': [],
+                'timestamp': 1480586400.2
+            },
+            'result': True,
+            'comment': ''
+        }
+    '''
+
+    proxy_output = __proxy__['napalm.call'](
+        'get_bgp_neighbors',
+        **{
+        }
+    )
+
+    if not proxy_output.get('result'):
+        return proxy_output
+
+    if prefix_threshold is None:
+        prefix_threshold = __salt__['config.get']('napalm_bgp_prefix_threshold', PREFIX_THRESHOLD)
+    if half_life is None:
+        half_life = __salt__['config.get']('napalm_bgp_dampening_half_life', DAMPENING['half_life'])
+
+    now = time.time()
+    first_poll = not NEIGHBORS_STATE
+    current_state = _neighbors_state(proxy_output.get('out', {}))
+    changes = 0
+
+    for key, neighbor_state in six.iteritems(current_state):
+        previous_state = NEIGHBORS_STATE.get(key)
+        if previous_state is None:
+            if not first_poll:
+                _send_event('added', neighbor_state, up=neighbor_state['up'])
+                changes += 1
+            neighbor_state['since'] = now
+            continue
+        neighbor_state['since'] = previous_state.get('since', now)
+        if neighbor_state['up'] != previous_state['up']:
+            neighbor_state['since'] = now
+            flaps = _record_flap(key, neighbor_state['up'], now, half_life)
+            _send_event('up' if neighbor_state['up'] else 'down',
+                        neighbor_state,
+                        flap_count=flaps['count'],
+                        penalty=round(flaps['penalty'], 1),
+                        suppressed=flaps['suppressed'])
+            changes += 1
+        if not (neighbor_state['up'] and previous_state['up']):
+            # the down / up event is enough
+            # when the session comes up, the base of the next comparison is the number of prefixes accepted now
+            if not neighbor_state['up']:
+                neighbor_state['reported'] = dict(previous_state['reported'])
+            continue
+        neighbor_state['reported'] = dict(previous_state['reported'])
+        for family, accepted in six.iteritems(neighbor_state['prefixes']):
+            previous_accepted = neighbor_state['reported'].get(family, -1)
+            neighbor_state['reported'][family] = accepted
+            if previous_accepted < 0:
+                continue
+            if not _prefix_delta_exceeded(previous_accepted, accepted, prefix_threshold):
+                neighbor_state['reported'][family] = previous_accepted  # small changes add up
+                continue
+            _send_event('prefixes',
+                        neighbor_state,
+                        family=family,
+                        previous=previous_accepted,
+                        accepted=accepted,
+                        delta=accepted - previous_accepted)
+            changes += 1
+
+    for key, previous_state in six.iteritems(NEIGHBORS_STATE):
+        if key not in current_state:
+            _send_event('removed', previous_state)
+            NEIGHBORS_FLAPS.pop(key, None)
+            changes += 1
+
+    NEIGHBORS_STATE.clear()
+    NEIGHBORS_STATE.update(current_state)
+
+    for flaps in six.itervalues(NEIGHBORS_FLAPS):
+        _decay_penalty(flaps, now, half_life)
+
+    return {
+        'out': {
+            'neighbors': len(current_state),
+            'up': len([neighbor_state for neighbor_state in six.itervalues(current_state) if neighbor_state['up']]),
+            'changes': changes,
+            'suppressed': sorted([key for key, flaps in six.iteritems(NEIGHBORS_FLAPS) if flaps['suppressed']]),
+            'timestamp': now
+        },
+        'result': True,
+        'comment': ''
+    }
+
+
+def flaps(neighbor=None, vrf=None):
+
+    '''
+    Returns the state of the BGP neighbors, as seen by the last `bgp.monitor` poll, and their flap history.
+    Does not query the device.
+
+    :param neighbor: IP Address of the neighbor. Default: all neighbors.
+    :param vrf: Name of the routing instance. Default: all routing instances.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' bgp.flaps
+        salt '*' bgp.flaps 172.17.17.1
+
+    Example output:
+
+    .. code-block:: python
+
+        {
+            'global/172.17.17.1': {
+                'vrf': 'global',
+                'neighbor': '172.17.17.1',
+                'remote_as': 8121,
+                'up': True,
+                'since': 1480586400.2,
+                'prefixes': {
+                    'ipv4': 566479
+                },
+                'flap_count': 3,
+                'penalty': 1204.7,
+                'suppressed': False,
+                'history': [
+                    [1480585211.8, 'down'],
+                    [1480585241.9, 'up']
+                ]
+            }
+        }
+    '''
+
+    now = time.time()
+    half_life = __salt__['config.get']('napalm_bgp_dampening_half_life', DAMPENING['half_life'])
+
+    neighbors_flaps = {}
+
+    for key, neighbor_state in six.iteritems(NEIGHBORS_STATE):
+        if neighbor and neighbor_state['neighbor'] != neighbor:
+            continue
+        if vrf and neighbor_state['vrf'] != vrf:
+            continue
+        neighbor_flaps = NEIGHBORS_FLAPS.get(key)
+        if neighbor_flaps:
+            _decay_penalty(neighbor_flaps, now, half_life)
+        neighbor_details = dict(neighbor_state)
+        neighbor_details.pop('reported', None)
+        neighbor_details.update({
+            'flap_count': neighbor_flaps['count'] if neighbor_flaps else 0,
+            'penalty': round(neighbor_flaps['penalty'], 1) if neighbor_flaps else 0.0,
+            'suppressed': neighbor_flaps['suppressed'] if neighbor_flaps else False,
+            'history': [list(transition) for transition in neighbor_flaps['history']] if neighbor_flaps else []
+        })
+        neighbors_flaps[key] = neighbor_details
+
+    return {
+        'out': neighbors_flaps,
+        'result': True,
+        'comment': ''
+    }
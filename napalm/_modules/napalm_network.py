@@ -21,10 +21,28 @@ Dependencies
 from __future__ import absolute_import
 
 # Import python lib
+import os
+import re
+import sys
+import socket
+import json
+import time
+import zlib
+import base64
+import fnmatch
+import hashlib
 import logging
 log = logging.getLogger(__name__)
 
+from collections import deque
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+# Import third party libs
+import jinja2
+
 # salt libs
+import salt.loader
 from salt.ext import six
 
 try:
@@ -37,6 +55,21 @@ try:
 except ImportError:
     HAS_NAPALM = False
 
+try:
+    # the Jinja filters NAPALM registers when rendering the templates
+    from napalm_base.utils.jinja_filters import CustomJinjaFilters
+    HAS_NAPALM_FILTERS = True
+except ImportError:
+    HAS_NAPALM_FILTERS = False
+
+try:
+    # TextFSM templates are optional
+    # regular expressions can be used instead
+    import textfsm
+    HAS_TEXTFSM = True
+except ImportError:
+    HAS_TEXTFSM = False
+
 # ----------------------------------------------------------------------------------------------------------------------
 # module properties
 # ----------------------------------------------------------------------------------------------------------------------
@@ -45,6 +78,107 @@ __virtualname__ = 'net'
 __proxyenabled__ = ['napalm']
 # uses NAPALM-based proxy to interact with network devices
 
+# ----------------------------------------------------------------------------------------------------------------------
+# global variables
+# ----------------------------------------------------------------------------------------------------------------------
+
+CLI_TEMPLATES_CACHE = {}
+# compiled CLI parsing templates, by path
+
+CONFIG_DIFF_CACHE = {}
+# diff of the last dry run and fingerprint of the running config it was computed against,
+# by hash of the config loaded and hash of the diff
+
+TEMPLATES_ENV_CACHE = {}
+# Jinja environments (holding the compiled templates), by driver and templates directory
+
+CONFIG_FINGERPRINT = {
+    'marker': None,
+    'fingerprint': None
+}
+# fingerprint of the running config, and the last commit marker it corresponds to
+
+CONFIG_CHANGE_MARKERS = {
+    'junos': ('show system commit', r'^\s*0\s+(.+)$'),
+    'iosxr': ('show configuration commit list 1', r'^\s*1\s+(\d+)'),
+    'ios': ('show running-config | include Last configuration change', r'Last configuration change at (.+)$')
+}
+# lightweight command exposing the last commit ID or last change timestamp, and how to extract it, per driver
+
+CONCURRENT_DRIVERS = ('eos', 'nxos')
+# drivers talking to the device over HTTP(S) APIs, where opening additional connections is cheap
+# the connection of the proxy is not thread safe, therefore each worker opens its own
+
+INTERFACES_COUNTERS = {}
+# ring buffers of counters samples, by interface
+
+COUNTERS_SAMPLED = (
+    ('rx_octets', ('rx_octets',)),
+    ('tx_octets', ('tx_octets',)),
+    ('rx_packets', ('rx_unicast_packets', 'rx_multicast_packets', 'rx_broadcast_packets')),
+    ('tx_packets', ('tx_unicast_packets', 'tx_multicast_packets', 'tx_broadcast_packets')),
+    ('rx_errors', ('rx_errors',)),
+    ('tx_errors', ('tx_errors',)),
+    ('rx_discards', ('rx_discards',)),
+    ('tx_discards', ('tx_discards',))
+)
+# counters computed from the samples, and the NAPALM counters they are the sum of
+
+COUNTERS_RAW = tuple(
+    napalm_counter
+    for _, napalm_counters in COUNTERS_SAMPLED
+    for napalm_counter in napalm_counters
+)
+# NAPALM counters kept in the samples
+
+COUNTERS_64BITS = {}
+# NAPALM counters seen above 2^32 at least once, by interface: they do not wrap at 32 bits
+
+WRAP_TOLERANCE = 10
+# a decreasing counter is considered wrapped only when the implied rate is at most 10 times the previous rate
+
+ENVIRONMENT_RESOLUTIONS = (
+    ('1m', 60, 60),
+    ('5m', 300, 288),
+    ('1h', 3600, 168)
+)
+# name, seconds aggregated in one point and number of points kept: 1 hour, 1 day and 1 week
+
+ENVIRONMENT_THRESHOLDS = {
+    'cpu/*': {'max': 90},
+    'memory/used_pct': {'max': 90},
+    'fans/*': {'min': 1},
+    'power/*/status': {'min': 1}
+}
+# default thresholds, overridden by the `napalm_environment_thresholds` option
+
+ENVIRONMENT_SERIES = {}
+# downsampled values (start, min, max, sum, count), by metric and resolution
+
+ENVIRONMENT_ALERTS = {}
+# metrics currently crossing the thresholds
+
+SNAPSHOTS = {}
+# last snapshots returned by the getters supporting delta mode, by getter and token
+
+SNAPSHOTS_KEPT = 3
+# number of snapshots kept for each getter
+
+SNAPSHOTS_VOLATILE = {
+    'interfaces': ('last_flapped',)
+}
+# fields changing on every call (e.g.: seconds since the last flap on Junos), ignored by the delta mode
+
+TEMPLATES_APPLIED = {}
+# hashes of the templates rendered and found already applied since the last commit,
+# mapped to the last commit marker verified for them (None when not verified yet)
+
+DIFF_FORMATS = ('text', 'structured', 'both')
+# the diff returned by the config functions: raw text, parsed in sections, or both
+
+DIFF_ROOT_SECTION = 'top'
+# section of the lines changed at the top level of the config hierarchy
+
 # ----------------------------------------------------------------------------------------------------------------------
 # property functions
 # ----------------------------------------------------------------------------------------------------------------------
@@ -109,20 +243,926 @@ def _filter_dict(input_dict, search_key, search_value):
     return output_dict
 
 
-def _config_logic(loaded_result, test=False, commit_config=True):
+def _driver_name():
+
+    '''
+    Returns the name of the NAPALM driver used by the proxy: from the grains when available, else from the pillar.
+    '''
+
+    return __grains__.get('os', '') or __pillar__.get('proxy', {}).get('driver', '')
+
+
+def _fingerprint(data):
+
+    '''
+    Computes a stable hash of a structured object returned by a NAPALM getter.
+
+    :param data: any JSON serializable object
+    :return:     hexadecimal digest, identical for equal objects regardless of the keys order
+    '''
+
+    serialized = json.dumps(data, sort_keys=True, default=str)
+    return hashlib.md5(serialized.encode('utf-8')).hexdigest()
+
+
+def _since_token(since):
+
+    '''
+    Returns the token the caller already has for this device.
+    Runners addressing many devices in a single job can send a dictionary
+    mapping the minion ID to the token known for that minion.
+    '''
+
+    if isinstance(since, dict):
+        return since.get(__opts__.get('id'))
+
+    return since
+
+
+def _cli_chunks(output, chunk_size):
+
+    '''
+    Yields the output of a command in chunks having at most `chunk_size` characters.
+    '''
+
+    for index in range(0, len(output), chunk_size):
+        yield output[index:index + chunk_size]
+
+
+def _cli_stream(commands, stream_id, chunk_size=65536, max_size=0, compress=False, returner=None):
+
+    '''
+    Executes the commands one by one and sends the output of each command in chunks,
+    either on the Salt event bus, either to a returner, as soon as the command completes.
+    Only the summary is returned, the output itself is never gathered.
+    '''
+
+    tag_prefix = 'napalm/cli/{minion}/{stream_id}'.format(
+        minion=__opts__.get('id'),
+        stream_id=stream_id
+    )
+
+    _returner = None
+    if returner:
+        _returners = salt.loader.returners(__opts__, __salt__)
+        _returner_fun = '{returner}.returner'.format(returner=returner)
+        if _returner_fun not in _returners:
+            return {
+                'out': {},
+                'result': False,
+                'comment': 'Returner {returner} is not available.'.format(returner=returner)
+            }
+        _returner = _returners[_returner_fun]
+
+    summary = {}
+    result = True
+    comment = ''
+
+    for command_index, command in enumerate(commands):
+        command_output = __proxy__['napalm.call'](
+            'cli',
+            **{
+                'commands': [command]
+            }
+        )
+        if not command_output.get('result'):
+            result = False
+            comment += '{comment}\n'.format(comment=command_output.get('comment'))
+            summary[command] = {
+                'chunks': 0,
+                'size': 0,
+                'truncated': False
+            }
+            continue
+        raw_output = command_output.get('out', {}).get(command, '')
+        del command_output  # keep a single reference, released as soon as the chunks are sent
+        size = len(raw_output)
+        truncated = bool(max_size) and size > max_size
+        if truncated:
+            raw_output = '{output}\n... [truncated: {dropped} characters dropped]'.format(
+                output=raw_output[:max_size],
+                dropped=size - max_size
+            )
+        chunks = max(int((len(raw_output) + chunk_size - 1) / chunk_size), 1)
+        for chunk_index, chunk in enumerate(_cli_chunks(raw_output, chunk_size) if raw_output else ['']):
+            if compress:
+                chunk = base64.b64encode(zlib.compress(chunk.encode('utf-8'))).decode('ascii')
+            data = {
+                'command': command,
+                'index': command_index,
+                'chunk': chunk_index,
+                'chunks': chunks,
+                'compressed': compress,
+                'truncated': truncated,
+                'output': chunk
+            }
+            if _returner:
+                _returner({
+                    'id': __opts__.get('id'),
+                    'jid': stream_id,
+                    'fun': 'net.cli',
+                    'return': data
+                })
+            else:
+                __salt__['event.send'](
+                    '{prefix}/{index}/{chunk}'.format(prefix=tag_prefix, index=command_index, chunk=chunk_index),
+                    data
+                )
+        del raw_output
+        summary[command] = {
+            'chunks': chunks,
+            'size': size,
+            'truncated': truncated
+        }
+
+    return {
+        'out': summary,
+        'result': result,
+        'comment': comment
+    }
+
+
+def _cli_template_path(template_path, command):
+
+    '''
+    Looks for the template to parse the output of a command, in the templates directory.
+    The template files are named after the driver and the command, e.g.: ``junos_show_bgp_summary.textfsm``
+    or ``junos_show_bgp_summary.regex``.
+    '''
+
+    driver = _driver_name()
+    command_name = re.sub(r'[^a-z0-9]+', '_', command.strip().lower()).strip('_')
+    template_basename = '{driver}_{command}'.format(driver=driver, command=command_name)
+
+    for extension in ('textfsm', 'regex'):
+        candidate = os.path.join(template_path, '{name}.{ext}'.format(name=template_basename, ext=extension))
+        if os.path.isfile(candidate):
+            return candidate
+
+    return None
+
+
+def _cli_template(template_file):
+
+    '''
+    Returns the compiled template, from the cache when the file did not change meanwhile.
+    '''
+
+    mtime = os.path.getmtime(template_file)
+    cached = CLI_TEMPLATES_CACHE.get(template_file)
+    if cached and cached[0] == mtime:
+        return cached[1]
+
+    if template_file.endswith('.textfsm'):
+        if not HAS_TEXTFSM:
+            raise ValueError('Please install TextFSM to use {template}: `pip install textfsm`'.format(
+                template=template_file
+            ))
+        with open(template_file, 'r') as template_fp:
+            compiled = textfsm.TextFSM(template_fp)
+    else:
+        with open(template_file, 'r') as template_fp:
+            compiled = re.compile(template_fp.read().strip(), re.MULTILINE)
+
+    CLI_TEMPLATES_CACHE[template_file] = (mtime, compiled)
+    return compiled
+
+
+def _cli_parse(template_file, raw_output):
+
+    '''
+    Parses the raw output using a TextFSM template or a regular expression with named groups.
+    Returns a compact structure: the header and the list of rows.
+    '''
+
+    compiled = _cli_template(template_file)
+
+    if template_file.endswith('.textfsm'):
+        compiled.Reset()  # the state machine is shared between the calls
+        return {
+            'header': list(compiled.header),
+            'rows': compiled.ParseText(raw_output)
+        }
+
+    header = [name for name, _ in sorted(six.iteritems(compiled.groupindex), key=lambda group: group[1])]
+    return {
+        'header': header,
+        'rows': [[match.group(name) for name in header] for match in compiled.finditer(raw_output)]
+    }
+
+
+def _destinations_list(destinations):
+
+    '''
+    Accepts either a list of destinations, either a comma separated string.
+    '''
+
+    if isinstance(destinations, six.string_types):
+        destinations = destinations.split(',')
+
+    return [destination.strip() for destination in destinations if destination and destination.strip()]
+
+
+def _worker_call_many(method, destinations, **params):
+
+    '''
+    Opens a dedicated connection to the device and calls the method for each destination, back to back.
+    '''
+
+    results = []
+
+    try:
+        driver = __proxy__['napalm.get_connection']()
+    except Exception as error:
+        comment = 'Cannot open a new connection to {device}: {error}'.format(
+            device=__opts__.get('id', ''),
+            error=error
+        )
+        log.error(comment)
+        return [(destination, {'out': {}, 'result': False, 'comment': comment}) for destination in destinations]
+
+    try:
+        for destination in destinations:
+            call_params = params.copy()
+            call_params['destination'] = destination
+            try:
+                output = {
+                    'out': getattr(driver, method)(**call_params),
+                    'result': True,
+                    'comment': ''
+                }
+            except Exception as error:
+                output = {
+                    'out': {},
+                    'result': False,
+                    'comment': 'Cannot execute "{method}" for {destination}. Reason: {error}!'.format(
+                        method=method,
+                        destination=destination,
+                        error=error
+                    )
+                }
+            results.append((destination, output))
+    finally:
+        try:
+            driver.close()
+        except Exception as error:
+            log.error('Cannot close the connection to {device}: {error}'.format(
+                device=__opts__.get('id', ''),
+                error=error
+            ))
+
+    return results
+
+
+def _call_many(method, destinations, concurrency=1, **params):
+
+    '''
+    Calls the same method of the network driver for each destination.
+    The calls are executed concurrently only when the driver can serve concurrent requests:
+    the destinations are split between the workers, each of them using its own connection to the device.
+    Otherwise they are executed back to back, on the connection of the proxy.
+    '''
+
+    def _call(destination):
+        call_params = params.copy()
+        call_params['destination'] = destination
+        return destination, __proxy__['napalm.call'](method, **call_params)
+
+    def _call_worker(worker_destinations):
+        return _worker_call_many(method, worker_destinations, **params)
+
+    driver = _driver_name()
+    concurrency = min(int(concurrency or 1), len(destinations))
+
+    if concurrency <= 1 or driver not in CONCURRENT_DRIVERS:
+        return [_call(destination) for destination in destinations]
+
+    workers_destinations = [destinations[index::concurrency] for index in range(concurrency)]
+
+    pool = ThreadPool(concurrency)
+    try:
+        workers_results = pool.map(_call_worker, workers_destinations)
+    finally:
+        pool.close()
+        pool.join()
+
+    results = dict(
+        (destination, output)
+        for worker_results in workers_results
+        for destination, output in worker_results
+    )
+
+    return [(destination, results[destination]) for destination in destinations]
+
+
+def _ping_summary(ping_output):
+
+    '''
+    Reduces the output of the ping to: packet loss and min/avg/max RTT.
+    '''
+
+    if not ping_output.get('result'):
+        return {
+            'error': ping_output.get('comment')
+        }
+
+    ping_result = ping_output.get('out', {})
+    if 'success' not in ping_result:
+        return {
+            'error': ping_result.get('error', 'Unknown error.')
+        }
+
+    success = ping_result['success']
+    probes_sent = success.get('probes_sent', 0)
+
+    return {
+        'loss': round(100.0 * success.get('packet_loss', 0) / probes_sent, 2) if probes_sent else 100.0,
+        'rtt_min': success.get('rtt_min'),
+        'rtt_avg': success.get('rtt_avg'),
+        'rtt_max': success.get('rtt_max')
+    }
+
+
+def _destination_addresses(destination):
+
+    '''
+    Returns the IP addresses of the destination: the destination itself when it is an IP address,
+    else the addresses it resolves to.
+    '''
+
+    addresses = set([destination])
+    try:
+        for address_info in socket.getaddrinfo(destination, None):
+            addresses.add(address_info[4][0])
+    except (socket.error, UnicodeError) as error:
+        log.debug('Cannot resolve {destination}: {error}'.format(destination=destination, error=error))
+
+    return addresses
+
+
+def _traceroute_summary(traceroute_output, destination=None):
+
+    '''
+    Reduces the output of the traceroute to the list of hops: the address replying first on each TTL.
+    When the destination is specified, also tells whether the last hop is the destination.
+    '''
+
+    if not traceroute_output.get('result'):
+        return {
+            'error': traceroute_output.get('comment')
+        }
+
+    traceroute_result = traceroute_output.get('out', {})
+    if 'success' not in traceroute_result:
+        return {
+            'error': traceroute_result.get('error', 'Unknown error.')
+        }
+
+    hops = []
+    for ttl in sorted(traceroute_result['success'].keys(), key=int):
+        probes = traceroute_result['success'][ttl].get('probes', {})
+        addresses = [probe.get('ip_address') for _, probe in sorted(probes.items()) if probe.get('ip_address')]
+        rtts = [probe.get('rtt') for probe in probes.values() if probe.get('rtt')]
+        hops.append({
+            'address': addresses[0] if addresses else '*',
+            'rtt_avg': round(sum(rtts) / len(rtts), 3) if rtts else None
+        })
+
+    summary = {
+        'hops': hops
+    }
+    if destination:
+        summary['reached'] = bool(hops) and hops[-1]['address'] in _destination_addresses(destination)
+
+    return summary
+
+
+def _destinations_stats(results):
+
+    '''
+    Computes summary statistics over the results of all destinations.
+    '''
+
+    reachable = [result for result in results.values() if 'error' not in result and result.get('loss', 0) < 100]
+    rtts = [result['rtt_avg'] for result in reachable if result.get('rtt_avg') is not None]
+
+    stats = {
+        'destinations': len(results),
+        'reachable': len(reachable),
+        'unreachable': len(results) - len(reachable)
+    }
+
+    losses = [result['loss'] for result in results.values() if 'loss' in result]
+    if losses:
+        stats['loss_avg'] = round(sum(losses) / len(losses), 2)
+    if rtts:
+        stats.update({
+            'rtt_min': min(rtts),
+            'rtt_avg': round(sum(rtts) / len(rtts), 3),
+            'rtt_max': max(rtts)
+        })
+
+    return stats
+
+
+def _counter_delta(previous, current, wide=False, max_delta=0):
+
+    '''
+    Returns the increase of a counter between two samples.
+    A decrease is considered a 32 bits wrap only when the counter never exceeded 2^32 and the implied increase
+    does not exceed `max_delta`, derived from the previous rate.
+    Otherwise, returns None: the counter has been reset (e.g.: cleared or line card reboot).
+    '''
+
+    if current >= previous:
+        return current - previous
+
+    if wide or previous >= 2 ** 32:
+        return None  # 64 bits counter
+
+    wrapped = 2 ** 32 - previous + current
+    if wrapped <= max_delta:
+        return wrapped
+
+    return None
+
+
+def _interface_rates(samples, wide_counters=()):
+
+    '''
+    Computes the rates per second between consecutive samples of an interface.
+    The deltas are computed for each NAPALM counter, then summed.
+    Returns the rates of the last interval and the average rates over all the samples.
+    '''
+
+    totals = dict((counter_name, 0) for counter_name, _ in COUNTERS_SAMPLED)
+    total_seconds = 0.0
+    current = None
+    previous_rates = {}
+
+    samples = list(samples)
+    for (previous_ts, previous_values), (current_ts, current_values) in zip(samples, samples[1:]):
+        seconds = float(current_ts - previous_ts)
+        if seconds <= 0:
+            current = None
+            continue
+        deltas = {}
+        for napalm_counter, previous_value, current_value in zip(COUNTERS_RAW, previous_values, current_values):
+            deltas[napalm_counter] = _counter_delta(
+                previous_value,
+                current_value,
+                wide=napalm_counter in wide_counters,
+                max_delta=previous_rates.get(napalm_counter, 0) * seconds * WRAP_TOLERANCE
+            )
+        if None in deltas.values():
+            current = None  # counters reset, this interval is not relevant
+            previous_rates = {}
+            continue
+        previous_rates = dict(
+            (napalm_counter, delta / seconds)
+            for napalm_counter, delta in six.iteritems(deltas)
+        )
+        total_seconds += seconds
+        current = {}
+        for counter_name, napalm_counters in COUNTERS_SAMPLED:
+            delta = sum([deltas[napalm_counter] for napalm_counter in napalm_counters])
+            totals[counter_name] += delta
+            current[counter_name] = delta / seconds
+
+    def _rates(values, seconds=1.0):
+        return {
+            'rx_bps': round(values['rx_octets'] * 8 / seconds, 2),
+            'tx_bps': round(values['tx_octets'] * 8 / seconds, 2),
+            'rx_pps': round(values['rx_packets'] / seconds, 2),
+            'tx_pps': round(values['tx_packets'] / seconds, 2),
+            'rx_errors_ps': round(values['rx_errors'] / seconds, 4),
+            'tx_errors_ps': round(values['tx_errors'] / seconds, 4),
+            'rx_discards_ps': round(values['rx_discards'] / seconds, 4),
+            'tx_discards_ps': round(values['tx_discards'] / seconds, 4)
+        }
+
+    return {
+        'current': _rates(current) if current else {},
+        'average': _rates(totals, total_seconds) if total_seconds else {},
+        'samples': len(samples),
+        'seconds': round(total_seconds, 3)
+    }
+
+
+def _environment_metrics(environment_details):
+
+    '''
+    Flattens the output of get_environment into numeric metrics.
+    '''
+
+    metrics = {}
+
+    for cpu_id, cpu_details in six.iteritems(environment_details.get('cpu', {})):
+        metrics['cpu/{cpu}'.format(cpu=cpu_id)] = float(cpu_details.get('%usage', 0))
+
+    memory = environment_details.get('memory', {})
+    if memory.get('available_ram'):
+        metrics['memory/used_pct'] = round(100.0 * memory.get('used_ram', 0) / memory['available_ram'], 2)
+
+    for sensor, sensor_details in six.iteritems(environment_details.get('temperature', {})):
+        metrics['temperature/{sensor}'.format(sensor=sensor)] = float(sensor_details.get('temperature', 0))
+
+    for fan, fan_details in six.iteritems(environment_details.get('fans', {})):
+        metrics['fans/{fan}'.format(fan=fan)] = 1 if fan_details.get('status') else 0
+
+    for psu, psu_details in six.iteritems(environment_details.get('power', {})):
+        metrics['power/{psu}/status'.format(psu=psu)] = 1 if psu_details.get('status') else 0
+        if psu_details.get('output') is not None:
+            metrics['power/{psu}/output'.format(psu=psu)] = float(psu_details['output'])
+
+    return metrics
+
+
+def _store_environment_metric(metric, value, now):
+
+    '''
+    Aggregates the value in the current point of each resolution.
+    '''
+
+    metric_series = ENVIRONMENT_SERIES.setdefault(metric, {})
+
+    for resolution, seconds, points in ENVIRONMENT_RESOLUTIONS:
+        series = metric_series.setdefault(resolution, deque(maxlen=points))
+        start = int(now // seconds) * seconds
+        if series and series[-1][0] == start:
+            point = series[-1]
+            point[1] = min(point[1], value)
+            point[2] = max(point[2], value)
+            point[3] += value
+            point[4] += 1
+        else:
+            series.append([start, value, value, value, 1])
+
+
+def _environment_threshold(metric, thresholds):
+
+    for metric_pattern, threshold in six.iteritems(thresholds):
+        if fnmatch.fnmatch(metric, metric_pattern):
+            return threshold
+
+    return None
+
+
+def _snapshot_delta(previous, current, depth=1):
+
+    '''
+    Computes the entries added, removed and changed between two snapshots.
+    The comparison descends `depth` levels in the nested dictionaries.
+    '''
+
+    delta = {
+        'added': {},
+        'removed': {},
+        'changed': {}
+    }
+
+    for key in set(previous.keys()) | set(current.keys()):
+        if key not in previous:
+            delta['added'][key] = current[key]
+        elif key not in current:
+            delta['removed'][key] = previous[key]
+        elif previous[key] != current[key]:
+            if depth > 1 and isinstance(previous[key], dict) and isinstance(current[key], dict):
+                key_delta = _snapshot_delta(previous[key], current[key], depth=depth - 1)
+                for delta_type, delta_entries in six.iteritems(key_delta):
+                    if delta_entries:
+                        delta[delta_type][key] = delta_entries
+            else:
+                delta['changed'][key] = current[key]
+
+    return delta
+
+
+def _delta_output(getter, proxy_output, since, depth=1):
+
+    '''
+    Stores the snapshot returned by the getter and replaces the output with the differences
+    from the snapshot identified by `since`, when the proxy still has it.
+    The volatile fields of the entries are not taken into account, nor returned in the differences.
+    '''
+
+    if not proxy_output.get('result'):
+        return proxy_output
+
+    snapshot = proxy_output.get('out', {})
+    volatile = SNAPSHOTS_VOLATILE.get(getter)
+    if volatile:
+        snapshot = dict(
+            (key, dict((field, value) for field, value in six.iteritems(entry) if field not in volatile)
+             if isinstance(entry, dict) else entry)
+            for key, entry in six.iteritems(snapshot)
+        )
+    token = _fingerprint(snapshot)
+    since = _since_token(since)
+
+    snapshots = SNAPSHOTS.setdefault(getter, OrderedDict())
+    previous = snapshots.get(since) if since else None
+
+    snapshots.pop(token, None)
+    snapshots[token] = snapshot
+    while len(snapshots) > SNAPSHOTS_KEPT:
+        snapshots.popitem(last=False)  # forget the oldest
+
+    proxy_output['token'] = token
+    proxy_output['delta'] = previous is not None
+
+    if previous is not None:
+        proxy_output['out'] = _snapshot_delta(previous, snapshot, depth=depth)
+
+    return proxy_output
+
+
+def _timed_call(timing, phase, method, **params):
+
+    '''
+    Calls a method of the network driver and accumulates the time spent, per phase.
+    '''
+
+    start = time.time()
+    output = __proxy__['napalm.call'](method, **params)
+    timing[phase] = round(timing.get(phase, 0.0) + time.time() - start, 3)
+
+    return output
+
+
+def _diff_hash(diff):
+
+    return hashlib.md5((diff or '').encode('utf-8')).hexdigest()
+
+
+def _diff_line(line, driver):
+
+    '''
+    Splits a line of the diff in the change marker (`+`, `-` or ` `) and the config line.
+    '''
+
+    if driver == 'eos':
+        # unified diff: the first column is always the marker
+        return line[:1] or ' ', line[1:]
+    if line[:1] in ('+', '-'):
+        return line[:1], line[1:]
+    if line[:1] == '#':
+        return '+', line[1:]  # IOS-XR: modified line, showing the new value
+    return ' ', line
+
+
+def _diff_sections(diff, driver):
+
+    '''
+    Parses the diff returned by `compare_config` into sections, each with the lines added and removed.
+    The Junos diffs are grouped by the `[edit ...]` hierarchy and the curly braces,
+    the IOS, IOS-XR and EOS diffs by the indentation of the config lines.
+    '''
+
+    sections = OrderedDict()
+    stack = []
+    junos_section = []
+
+    for line in (diff or '').splitlines():
+        if not line.strip() or line.startswith(('---', '+++', '@@')):
+            continue
+        if driver == 'junos' and line.startswith('[edit'):
+            junos_section = line.strip()[1:-1].split()[1:]
+            stack = []
+            continue
+        marker, config_line = _diff_line(line, driver)
+        config_line_stripped = config_line.strip()
+        if not config_line_stripped or config_line_stripped.startswith('!'):
+            continue
+        if driver == 'junos':
+            if config_line_stripped == '}':
+                if stack:
+                    stack.pop()
+                continue
+            section = ' '.join(junos_section + stack)
+            if config_line_stripped.endswith('{'):
+                stack.append(config_line_stripped[:-1].strip())
+        else:
+            indent = len(config_line) - len(config_line.lstrip())
+            while stack and stack[-1][0] >= indent:
+                stack.pop()
+            section = ' > '.join([parent for _, parent in stack])
+            stack.append((indent, config_line_stripped))
+        if marker not in ('+', '-'):
+            continue
+        section_changes = sections.setdefault(section or DIFF_ROOT_SECTION, {
+            'added': [],
+            'removed': []
+        })
+        section_changes['added' if marker == '+' else 'removed'].append(config_line_stripped)
+
+    for section_changes in six.itervalues(sections):
+        section_changes.update({
+            'added_count': len(section_changes['added']),
+            'removed_count': len(section_changes['removed'])
+        })
+
+    return sections
+
+
+def _format_diff(loaded_result, diff_format='text'):
+
+    '''
+    Replaces or completes the raw diff with the diff parsed in sections, as requested through `diff_format`.
+    '''
+
+    if diff_format == 'text' or 'diff' not in loaded_result:
+        return loaded_result
+
+    driver = _driver_name()
+    sections = _diff_sections(loaded_result['diff'], driver)
+
+    loaded_result['diff_sections'] = sections
+    loaded_result['diff_stats'] = {
+        'sections': len(sections),
+        'added': sum([section_changes['added_count'] for section_changes in six.itervalues(sections)]),
+        'removed': sum([section_changes['removed_count'] for section_changes in six.itervalues(sections)])
+    }
+    if diff_format == 'structured':
+        loaded_result.pop('diff')
+
+    return loaded_result
+
+
+def _template_environment(template_path=None):
+
+    '''
+    Returns the Jinja environment for the templates directory of the driver, or for a custom directory.
+    The templates are looked up as NAPALM does: under `<template_path>/<driver>/templates` when `template_path`
+    is an absolute directory, otherwise in the templates directory of the driver.
+    The environment caches the compiled templates and reloads them only when the file changes.
+    '''
+
+    driver_module = get_network_driver(__proxy__['napalm.get_device']().get('DRIVER_NAME')).__module__
+    if template_path and os.path.isabs(template_path) and os.path.isdir(template_path):
+        current_dir = os.path.join(template_path, driver_module.split('.')[-1])
+    else:
+        current_dir = os.path.dirname(os.path.abspath(sys.modules[driver_module].__file__))
+    searchpath = os.path.join(current_dir, 'templates')
+
+    cache_key = (driver_module, searchpath)
+    if cache_key not in TEMPLATES_ENV_CACHE:
+        environment = jinja2.Environment(
+            loader=jinja2.FileSystemLoader(searchpath),
+            auto_reload=True
+        )
+        if HAS_NAPALM_FILTERS:
+            environment.filters.update(CustomJinjaFilters.filters())
+        TEMPLATES_ENV_CACHE[cache_key] = environment
+
+    return TEMPLATES_ENV_CACHE[cache_key]
+
+
+def _render_template(template_name, template_source=None, template_path=None, **template_vars):
+
+    '''
+    Renders the template the same way NAPALM does, but using the cached compiled templates.
+    Unlike NAPALM, an inline template is rendered in the environment of the driver templates,
+    therefore it can include them.
+    '''
+
+    if template_source:
+        template = _template_environment().from_string(template_source)
+    else:
+        template = _template_environment(template_path).get_template(
+            '{template_name}.j2'.format(template_name=template_name)
+        )
+
+    return template.render(**template_vars)
+
+
+def _config_change_marker():
+
+    '''
+    Retrieves the ID or the timestamp of the last commit, on the platforms exposing it.
+    Returns None when not available.
+    '''
+
+    driver = _driver_name()
+    if driver not in CONFIG_CHANGE_MARKERS:
+        return None
+
+    command, marker_regex = CONFIG_CHANGE_MARKERS[driver]
+    command_output = __proxy__['napalm.call'](
+        'cli',
+        **{
+            'commands': [command]
+        }
+    )
+
+    if not command_output.get('result'):
+        return None
+
+    marker = re.search(marker_regex, command_output.get('out', {}).get(command, ''), re.MULTILINE)
+    if not marker:
+        return None
+
+    return marker.group(1).strip()
+
+
+def _running_config_fingerprint():
+
+    '''
+    Returns the fingerprint of the running config, or None when it cannot be retrieved.
+    The running config is retrieved only when the last commit marker changed,
+    or when the platform does not expose such a marker.
+    '''
+
+    marker = _config_change_marker()
+    if marker and marker == CONFIG_FINGERPRINT['marker'] and CONFIG_FINGERPRINT['fingerprint']:
+        return CONFIG_FINGERPRINT['fingerprint']
+
+    running_config = __proxy__['napalm.call'](
+        'get_config',
+        **{
+            'retrieve': 'running'
+        }
+    )
+
+    if not running_config.get('result'):
+        return None
+
+    fingerprint = _fingerprint([(running_config.get('out') or {}).get('running', ''), marker])
+    CONFIG_FINGERPRINT.update({
+        'marker': marker,
+        'fingerprint': fingerprint
+    })
+
+    return fingerprint
+
+
+def _load_hash(load_method, load_params):
+
+    '''
+    Computes the hash of the configuration loaded. When loading from a file, the contents of the file are hashed.
+    Returns None when the file cannot be read.
+    '''
+
+    if not load_params.get('filename'):
+        return _fingerprint([load_method, load_params])
+
+    try:
+        with open(load_params['filename'], 'r') as config_file:
+            config_contents = config_file.read()
+    except (IOError, OSError):
+        return None
+
+    return _fingerprint([load_method, dict(load_params, filename=None, config=config_contents)])
+
+
+def _config_logic(load_method, load_params, test=False, commit_config=True, expected_diff_hash=None):
 
     '''
     Builds the config logic for `load_config` and `load_template` functions.
+
+    The candidate configuration is loaded, compared once, then committed or discarded within the same session.
+    The diff is computed at most once and used both to decide whether to commit and in the returned payload.
+    When the hash of the expected diff is provided and it matches the diff of a previous dry run on this device,
+    loading exactly the same config while the running config did not change meanwhile,
+    the comparison is skipped and the diff is taken from the previous dry run.
     '''
 
+    timing = {}
+    load_hash = _load_hash(load_method, load_params)
+    cached_diff = None
+    if load_hash and expected_diff_hash and not test:
+        cached_diff = CONFIG_DIFF_CACHE.get((load_hash, expected_diff_hash))
+
+    loaded_result = _timed_call(timing, 'load', load_method, **load_params)
     loaded_result['already_configured'] = False
+    loaded_result['timing'] = timing
+
+    _loaded_res = loaded_result.get('result', False)
 
-    _compare = compare_config()
-    if _compare.get('result', False):
-        loaded_result['diff'] = _compare.get('out')
+    if _loaded_res:
+        if cached_diff and cached_diff['running'] and cached_diff['running'] == _running_config_fingerprint():
+            # the caller already knows the changes of this candidate
+            # no need to ask the device to compute the diff again
+            loaded_result['diff'] = cached_diff['diff']
+        else:
+            _compare = _timed_call(timing, 'compare', 'compare_config')
+            if not _compare.get('result', False):
+                loaded_result['result'] = _loaded_res = False
+                loaded_result['comment'] = _compare.get('comment') or 'Unable to compare the config.'
+            else:
+                loaded_result['diff'] = _compare.get('out') or ''
         loaded_result.pop('out', '')  # not needed
 
-    _loaded_res = loaded_result.get('result', False)
+    if 'diff' in loaded_result:
+        loaded_result['diff_hash'] = _diff_hash(loaded_result['diff'])
+        if test and load_hash and loaded_result['diff']:
+            # remember the diff of the dry run
+            # the real run can skip the comparison when it expects exactly the same changes
+            CONFIG_DIFF_CACHE.clear()
+            CONFIG_DIFF_CACHE[(load_hash, loaded_result['diff_hash'])] = {
+                'diff': loaded_result['diff'],
+                'running': _running_config_fingerprint()
+            }
 
     if not _loaded_res or test:
         # if unable to load the config (errors / warnings)
@@ -130,9 +1170,9 @@ def _config_logic(loaded_result, test=False, commit_config=True):
         # will discard the config
         if loaded_result['comment']:
             loaded_result['comment'] += '\n'
-        if not len(loaded_result.get('diff', '')) > 0:
+        if _loaded_res and not len(loaded_result.get('diff', '')) > 0:
             loaded_result['already_configured'] = True
-        _discarded = discard_config()
+        _discarded = _timed_call(timing, 'discard', 'discard_config')
         if not _discarded.get('result', False):
             loaded_result['comment'] += _discarded['comment'] if _discarded['comment'] else 'Unable to discard config.'
             loaded_result['result'] = False
@@ -150,18 +1190,20 @@ def _config_logic(loaded_result, test=False, commit_config=True):
             # if not testing mode
             # and also the user wants to commit (default)
             # and there are changes to commit
-            _commit = commit()  # calls the function commit, defined below
+            _commit = _timed_call(timing, 'commit', 'commit_config')
             if not _commit.get('result', False):
                 loaded_result['comment'] += _commit['comment'] if _commit['comment'] else 'Unable to commit config.'
                 loaded_result['result'] = False
-                _discarded = discard_config()  # unable to commit, discard config
-                loaded_result['comment'] +=  '\n'
+                _discarded = _timed_call(timing, 'discard', 'discard_config')  # unable to commit, discard config
+                loaded_result['comment'] += '\n'
                 loaded_result['comment'] += _discarded['comment'] if _discarded['comment'] else 'Unable to discard config.'
+            else:
+                CONFIG_DIFF_CACHE.pop((load_hash, loaded_result['diff_hash']), None)
 
         else:
             # would like to commit, but there's no change
             # need to call discard_config() to release the config DB
-            _discarded = discard_config()
+            _discarded = _timed_call(timing, 'discard', 'discard_config')
             if not _discarded.get('result', False):
                 loaded_result['comment'] += _discarded['comment'] if _discarded['comment'] else 'Unable to discard config.'
                 loaded_result['result'] = False
@@ -305,26 +1347,181 @@ def environment():
         }
     '''
 
-    return __proxy__['napalm.call'](
-        'get_environment',
-        **{
+    return __proxy__['napalm.call'](
+        'get_environment',
+        **{
+        }
+    )
+
+
+def sample_environment(thresholds=None):
+
+    '''
+    Retrieves the environment details and stores them on the proxy, downsampled in three resolutions:
+    1 minute (kept for 1 hour), 5 minutes (kept for 1 day) and 1 hour (kept for 1 week), as min/max/avg values.
+    When a metric crosses a threshold, or gets back within limits, an event is sent on the Salt bus,
+    tagged as ``napalm/environment/<metric>/alert``, respectively ``napalm/environment/<metric>/clear``.
+    No event is sent while the metric stays on the same side of the threshold.
+
+    This function is meant to be executed periodically by the scheduler, without returning the job to the master,
+    e.g., in the proxy config:
+
+    .. code-block:: yaml
+
+        schedule:
+          environment:
+            function: net.sample_environment
+            minutes: 1
+            return_job: False
+
+    :param thresholds: Dictionary having metric names (glob patterns allowed) as keys and the `min` and/or `max`
+    limits as values. If not specified, will use the value of the ``napalm_environment_thresholds`` option,
+    falling back to: CPU and memory usage at most 90%, fans and power supplies in good state.
+    The metrics are named as: ``cpu/<id>``, ``memory/used_pct``, ``temperature/<sensor>``, ``fans/<fan>`` (1 or 0),
+    ``power/<psu>/status`` (1 or 0), ``power/<psu>/output``.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' net.sample_environment
+        salt '*' net.sample_environment thresholds="{'temperature/*': {'max': 60}}"
+    '''
+
+    proxy_output = environment()
+
+    if not proxy_output.get('result'):
+        return proxy_output
+
+    if thresholds is None:
+        thresholds = __salt__['config.get']('napalm_environment_thresholds', {}) or ENVIRONMENT_THRESHOLDS
+
+    now = time.time()
+
+    for metric, value in six.iteritems(_environment_metrics(proxy_output.get('out', {}))):
+        _store_environment_metric(metric, value, now)
+        threshold = _environment_threshold(metric, thresholds)
+        if not threshold:
+            continue
+        crossed = (
+            ('max' in threshold and value > threshold['max']) or
+            ('min' in threshold and value < threshold['min'])
+        )
+        if crossed == ENVIRONMENT_ALERTS.get(metric, False):
+            continue  # no transition
+        ENVIRONMENT_ALERTS[metric] = crossed
+        __salt__['event.send'](
+            'napalm/environment/{metric}/{state}'.format(metric=metric, state='alert' if crossed else 'clear'),
+            {
+                'metric': metric,
+                'value': value,
+                'threshold': threshold,
+                'timestamp': now
+            }
+        )
+
+    return {
+        'out': {
+            'metrics': len(ENVIRONMENT_SERIES),
+            'alerts': sorted([metric for metric, crossed in six.iteritems(ENVIRONMENT_ALERTS) if crossed]),
+            'timestamp': now
+        },
+        'result': True,
+        'comment': ''
+    }
+
+
+def environment_history(metric='*', resolution='5m', since=0):
+
+    '''
+    Returns the environment metrics stored on the proxy by `net.sample_environment`, as compact arrays.
+
+    :param metric: metric name, glob patterns allowed. Default: all metrics.
+    :param resolution: 1m, 5m or 1h. Default: 5m.
+    :param since: return only the points starting after this UNIX timestamp.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' net.environment_history
+        salt '*' net.environment_history metric='cpu/*' resolution=1m
+
+    Example output:
+
+    .. code-block:: python
+
+        {
+            'cpu/0': {
+                'ts': [1480586400, 1480586700],
+                'min': [19.0, 22.0],
+                'max': [35.0, 41.0],
+                'avg': [24.5, 27.33]
+            }
+        }
+    '''
+
+    resolutions = [resolution_name for resolution_name, _, _ in ENVIRONMENT_RESOLUTIONS]
+    if resolution not in resolutions:
+        return {
+            'out': {},
+            'result': False,
+            'comment': 'Resolution must be one of: {resolutions}'.format(resolutions=', '.join(resolutions))
         }
-    )
+
+    history = {}
+
+    for metric_name, metric_series in six.iteritems(ENVIRONMENT_SERIES):
+        if not fnmatch.fnmatch(metric_name, metric):
+            continue
+        points = [point for point in metric_series.get(resolution, []) if point[0] >= since]
+        history[metric_name] = {
+            'ts': [point[0] for point in points],
+            'min': [point[1] for point in points],
+            'max': [point[2] for point in points],
+            'avg': [round(float(point[3]) / point[4], 2) for point in points]
+        }
+
+    return {
+        'out': history,
+        'result': True,
+        'comment': ''
+    }
 
 
-def cli(*commands):
+def cli(*commands, **kwargs):
 
     '''
     Returns a dictionary with the raw output of all commands passed as arguments.
 
     :param commands: list of commands to be executed on the device
+    :param stream: send the output of each command as soon as it completes, in chunks, instead of returning it.
+    The chunks are sent on the Salt event bus, tagged as ``napalm/cli/<minion ID>/<job ID>/<command index>/<chunk
+    index>``, or to a returner. The function returns only the size and the number of chunks of each output.
+    Default: False.
+    :param chunk_size: maximum number of characters sent in one chunk. Default: 65536.
+    :param max_size: maximum number of characters sent for one command, the rest being replaced by a truncation
+    marker. Default: 0 (no limit).
+    :param compress: compress the chunks using zlib, then base64 encode them. Default: False.
+    :param returner: send the chunks to this returner instead of the event bus.
+    :param parse: parse the output on the device side and return only the structured data. Default: False.
+    The templates are selected by the driver name and the command, e.g.: ``junos_show_bgp_summary.textfsm`` (TextFSM_
+    template) or ``junos_show_bgp_summary.regex`` (regular expression having named groups, matched repeatedly).
+    The output of a command having no template is returned as-is.
+    :param template_path: directory with the parsing templates. If not specified, will use the value of the
+    ``napalm_cli_templates`` option (from the proxy config, grains or pillar).
     :return: a dictionary with the mapping between each command and its raw output
 
+    .. _TextFSM: https://github.com/google/textfsm
+
     CLI Example:
 
     .. code-block:: bash
 
         salt '*' net.cli "show version" "show chassis fan"
+        salt '*' net.cli "show route" "show bgp summary" stream=True compress=True max_size=104857600
+        salt '*' net.cli "show route" stream=True returner=redis
+        salt '*' net.cli "show bgp summary" parse=True template_path=/etc/salt/cli_templates
 
     Example output:
 
@@ -347,9 +1544,43 @@ def cli(*commands):
                                       Bottom Front Fan          OK       3840    Spinning at intermediate-speed
                                      '
         }
+
+    Example output when streaming:
+
+    .. code-block:: python
+
+        {
+            'show route': {
+                'chunks': 1601,
+                'size': 241172480,
+                'truncated': True
+            }
+        }
+
+    Example output when parsing:
+
+    .. code-block:: python
+
+        {
+            'show bgp summary': {
+                'header': ['peer', 'asn', 'state', 'prefixes'],
+                'rows': [
+                    ['192.168.0.1', '13335', 'Establ', '566479'],
+                    ['172.17.17.1', '8121', 'Active', '0']
+                ]
+            }
+        }
     '''
 
-    return __proxy__['napalm.call'](
+    if kwargs.get('stream', False):
+        return _cli_stream(commands,
+                           kwargs.get('__pub_jid') or '{now:.6f}'.format(now=time.time()),
+                           chunk_size=int(kwargs.get('chunk_size', 65536)),
+                           max_size=int(kwargs.get('max_size', 0)),
+                           compress=kwargs.get('compress', False),
+                           returner=kwargs.get('returner'))
+
+    proxy_output = __proxy__['napalm.call'](
         'cli',
         **{
             'commands': list(commands)
@@ -358,6 +1589,38 @@ def cli(*commands):
     # thus we can display the output as is
     # in case of errors, they'll be catched in the proxy
 
+    if not (kwargs.get('parse', False) and proxy_output.get('result')):
+        return proxy_output
+
+    template_path = kwargs.get('template_path') or __salt__['config.get']('napalm_cli_templates', '')
+    if not template_path:
+        proxy_output['comment'] = 'No templates directory specified, returning the raw output.'
+        return proxy_output
+
+    parsed_output = {}
+    for command, raw_output in six.iteritems(proxy_output.get('out', {})):
+        template_file = _cli_template_path(template_path, command)
+        if not template_file:
+            parsed_output[command] = raw_output
+            continue
+        try:
+            parsed_output[command] = _cli_parse(template_file, raw_output)
+        except Exception as error:
+            log.error('Unable to parse the output of "{command}" using {template}: {error}'.format(
+                command=command,
+                template=template_file,
+                error=error
+            ))
+            parsed_output[command] = raw_output
+            proxy_output['comment'] += 'Unable to parse the output of "{command}": {error}\n'.format(
+                command=command,
+                error=error
+            )
+
+    proxy_output['out'] = parsed_output
+
+    return proxy_output
+
 
 def traceroute(destination, source='', ttl=0, timeout=0):
 
@@ -423,6 +1686,169 @@ def ping(destination, source='', ttl=0, timeout=0, size=0, count=0):
     )
 
 
+def ping_many(destinations, source='', ttl=0, timeout=0, size=0, count=0, concurrency=1):
+
+    '''
+    Executes a ping towards many destinations and returns, for each destination, the packet loss and the RTT
+    statistics, plus summary statistics over all destinations.
+    The pings are executed concurrently only on the platforms able to serve concurrent requests (EOS, NX-OS),
+    each worker opening its own connection to the device, otherwise they are executed back to back in the same
+    session.
+
+    :param destinations: List of hostnames or IP addresses of the remote hosts, or a comma separated string
+    :param source: Source address of echo request
+    :param ttl: IP time-to-live value (IPv6 hop-limit value) (1..255 hops)
+    :param timeout: Maximum wait time after sending final packet (seconds)
+    :param size: Size of request packets (0..65468 bytes)
+    :param count: Number of ping requests to send (1..2000000000 packets)
+    :param concurrency: Maximum number of pings executed at the same time. Default: 1.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' net.ping_many 8.8.8.8,1.1.1.1
+        salt '*' net.ping_many "['8.8.8.8', '1.1.1.1']" count=10 concurrency=5
+
+    Example output:
+
+    .. code-block:: python
+
+        {
+            'destinations': {
+                '8.8.8.8': {
+                    'loss': 0.0,
+                    'rtt_min': 1.312,
+                    'rtt_avg': 1.455,
+                    'rtt_max': 1.701
+                },
+                '1.1.1.1': {
+                    'error': 'unknown host: 1.1.1.1'
+                }
+            },
+            'stats': {
+                'destinations': 2,
+                'reachable': 1,
+                'unreachable': 1,
+                'loss_avg': 0.0,
+                'rtt_min': 1.455,
+                'rtt_avg': 1.455,
+                'rtt_max': 1.455
+            }
+        }
+    '''
+
+    destinations = _destinations_list(destinations)
+
+    ping_outputs = _call_many('ping',
+                              destinations,
+                              concurrency=concurrency,
+                              source=source,
+                              ttl=ttl,
+                              timeout=timeout,
+                              size=size,
+                              count=count)
+
+    results = dict(
+        (destination, _ping_summary(ping_output))
+        for destination, ping_output in ping_outputs
+    )
+
+    return {
+        'out': {
+            'destinations': results,
+            'stats': _destinations_stats(results)
+        },
+        'result': True,
+        'comment': ''
+    }
+
+
+def traceroute_many(destinations, source='', ttl=0, timeout=0, concurrency=1):
+
+    '''
+    Executes a traceroute towards many destinations and returns the list of hops for each destination.
+    The traceroutes are executed concurrently only on the platforms able to serve concurrent requests (EOS, NX-OS),
+    each worker opening its own connection to the device, otherwise they are executed back to back in the same
+    session.
+
+    :param destinations: List of hostnames or IP addresses of the remote hosts, or a comma separated string
+    :param source: Source address to use in outgoing traceroute packets
+    :param ttl: IP maximum time-to-live value (or IPv6 maximum hop-limit value)
+    :param timeout: Number of seconds to wait for response (seconds)
+    :param concurrency: Maximum number of traceroutes executed at the same time. Default: 1.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' net.traceroute_many 8.8.8.8,1.1.1.1 ttl=10
+
+    Example output:
+
+    .. code-block:: python
+
+        {
+            'destinations': {
+                '8.8.8.8': {
+                    'hops': [
+                        {
+                            'address': '172.17.17.1',
+                            'rtt_avg': 0.345
+                        },
+                        {
+                            'address': '8.8.8.8',
+                            'rtt_avg': 1.208
+                        }
+                    ],
+                    'reached': True
+                }
+            },
+            'stats': {
+                'destinations': 1,
+                'reachable': 1,
+                'unreachable': 0,
+                'hops_avg': 2.0
+            }
+        }
+    '''
+
+    destinations = _destinations_list(destinations)
+
+    traceroute_outputs = _call_many('traceroute',
+                                    destinations,
+                                    concurrency=concurrency,
+                                    source=source,
+                                    ttl=ttl,
+                                    timeout=timeout)
+
+    results = dict(
+        (destination, _traceroute_summary(traceroute_output, destination=destination))
+        for destination, traceroute_output in traceroute_outputs
+    )
+
+    reached = [
+        result['hops'] for result in six.itervalues(results)
+        if result.get('reached')
+    ]
+    stats = {
+        'destinations': len(results),
+        'reachable': len(reached),
+        'unreachable': len(results) - len(reached)
+    }
+    if reached:
+        stats['hops_avg'] = round(float(sum([len(hops) for hops in reached])) / len(reached), 2)
+
+    return {
+        'out': {
+            'destinations': results,
+            'stats': stats
+        },
+        'result': True,
+        'comment': ''
+    }
+
+
 def arp(interface='', ipaddr='', macaddr=''):
 
     '''
@@ -487,11 +1913,14 @@ def arp(interface='', ipaddr='', macaddr=''):
     return proxy_output
 
 
-def ipaddrs():
+def ipaddrs(since=None):
 
     '''
     Returns IP addresses configured on the device.
 
+    :param since: token returned by a previous call. When the token is known, only the differences since that call
+    are returned, under the keys `added`, `removed` and `changed`. Otherwise, the complete output is returned.
+    Can also be a dictionary having the minion ID as key and the token as value.
 
     :return:   A dictionary with the IPv4 and IPv6 addresses of the interfaces.\
     Returns all configured IP addresses on all interfaces as a dictionary of dictionaries.\
@@ -504,6 +1933,7 @@ def ipaddrs():
     .. code-block:: bash
 
         salt '*' net.ipaddrs
+        salt '*' net.ipaddrs since=5f7e1fbd4c8d0aa5e8ad5e1c3b4f02e9
 
     Example output:
 
@@ -536,20 +1966,45 @@ def ipaddrs():
                 }
             }
         }
+
+    Example output in delta mode (having the `delta` flag set and the new `token`):
+
+    .. code-block:: python
+
+        {
+            'added': {
+                u'Loopback555': {
+                    u'ipv4': {
+                        u'192.168.1.2': {
+                            'prefix_length': 24
+                        }
+                    }
+                }
+            },
+            'removed': {},
+            'changed': {}
+        }
     '''
 
-    return __proxy__['napalm.call'](
+    proxy_output = __proxy__['napalm.call'](
         'get_interfaces_ip',
         **{
         }
     )
 
+    return _delta_output('ipaddrs', proxy_output, since, depth=3)
+
 
-def interfaces():
+def interfaces(since=None):
 
     '''
     Returns details of the interfaces on the device.
 
+    :param since: token returned by a previous call. When the token is known, only the differences since that call
+    are returned, under the keys `added`, `removed` and `changed`. Otherwise, the complete output is returned.
+    Can also be a dictionary having the minion ID as key and the token as value.
+    The `last_flapped` field changes on every call on some platforms, therefore it is ignored by the token
+    and not returned in the differences.
     :return: Returns a dictionary of dictionaries. \
     The keys for the first dictionary will be the interfaces in the devices.
 
@@ -558,6 +2013,7 @@ def interfaces():
     .. code-block:: bash
 
         salt '*' net.interfaces
+        salt '*' net.interfaces since=0c7d5e2a8f6b1e4d3a9c2b7f1e0d8c6a
 
     Example output:
 
@@ -583,21 +2039,199 @@ def interfaces():
         }
     '''
 
-    return __proxy__['napalm.call'](
+    proxy_output = __proxy__['napalm.call'](
         'get_interfaces',
         **{
         }
     )
 
+    return _delta_output('interfaces', proxy_output, since)
+
+
+def interfaces_counters():
+
+    '''
+    Returns the counters of the interfaces.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' net.interfaces_counters
+
+    Example output:
+
+    .. code-block:: python
+
+        {
+            u'Ethernet2': {
+                'tx_multicast_packets': 699,
+                'tx_discards': 0,
+                'tx_octets': 88577,
+                'tx_errors': 0,
+                'rx_octets': 0,
+                'tx_unicast_packets': 0,
+                'rx_errors': 0,
+                'tx_broadcast_packets': 0,
+                'rx_multicast_packets': 0,
+                'rx_broadcast_packets': 0,
+                'rx_discards': 0,
+                'rx_unicast_packets': 0
+            }
+        }
+    '''
+
+    return __proxy__['napalm.call'](
+        'get_interfaces_counters',
+        **{
+        }
+    )
+
+
+def sample_counters(size=60):
+
+    '''
+    Retrieves the counters of the interfaces and stores them in a ring buffer, per interface, on the proxy.
+    Only the last `size` samples are kept. This function is meant to be executed periodically by the scheduler,
+    without returning the job to the master, e.g., in the proxy config:
+
+    .. code-block:: yaml
+
+        schedule:
+          interfaces_counters:
+            function: net.sample_counters
+            seconds: 30
+            return_job: False
+
+    The rates are then computed from the stored samples by `net.interface_rates`.
+
+    :param size: number of samples kept for each interface. Default: 60.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' net.sample_counters size=120
+    '''
+
+    proxy_output = interfaces_counters()
+
+    if not proxy_output.get('result'):
+        return proxy_output
+
+    now = time.time()
+    size = int(size)
+
+    for interface, counters in six.iteritems(proxy_output.get('out', {})):
+        values = tuple(counters.get(napalm_counter) or 0 for napalm_counter in COUNTERS_RAW)
+        COUNTERS_64BITS.setdefault(interface, set()).update([
+            napalm_counter
+            for napalm_counter, value in zip(COUNTERS_RAW, values)
+            if value >= 2 ** 32
+        ])
+        samples = INTERFACES_COUNTERS.get(interface)
+        if samples is None or samples.maxlen != size:
+            samples = INTERFACES_COUNTERS[interface] = deque(samples or [], maxlen=size)
+        samples.append((now, values))
+
+    for interface in set(INTERFACES_COUNTERS.keys()) - set(proxy_output.get('out', {}).keys()):
+        INTERFACES_COUNTERS.pop(interface)  # interface removed
+        COUNTERS_64BITS.pop(interface, None)
+
+    return {
+        'out': {
+            'interfaces': len(INTERFACES_COUNTERS),
+            'timestamp': now
+        },
+        'result': True,
+        'comment': ''
+    }
+
+
+def interface_rates(interface=''):
+
+    '''
+    Returns the bits, packets, errors and discards rates per second of the interfaces,
+    computed from the samples stored on the proxy by `net.sample_counters`.
+    For each interface, returns the rates between the last two samples (current)
+    and the average rates over all the stored samples.
+    The 32 bits counters wraps are handled, while the intervals when the counters were reset are ignored.
+
+    :param interface: interface name to filter on
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' net.interface_rates
+        salt '*' net.interface_rates interface=xe-0/0/1
+
+    Example output:
+
+    .. code-block:: python
+
+        {
+            'xe-0/0/1': {
+                'current': {
+                    'rx_bps': 4358712.53,
+                    'tx_bps': 918373.07,
+                    'rx_pps': 512.4,
+                    'tx_pps': 301.87,
+                    'rx_errors_ps': 0.0,
+                    'tx_errors_ps': 0.0,
+                    'rx_discards_ps': 0.0,
+                    'tx_discards_ps': 0.0
+                },
+                'average': {
+                    'rx_bps': 4012977.1,
+                    'tx_bps': 899017.6,
+                    'rx_pps': 498.12,
+                    'tx_pps': 297.35,
+                    'rx_errors_ps': 0.0,
+                    'tx_errors_ps': 0.0,
+                    'rx_discards_ps': 0.0,
+                    'tx_discards_ps': 0.0
+                },
+                'samples': 60,
+                'seconds': 1770.021
+            }
+        }
+    '''
+
+    if interface:
+        interfaces_samples = {interface: INTERFACES_COUNTERS.get(interface, [])}
+    else:
+        interfaces_samples = INTERFACES_COUNTERS
+
+    if not INTERFACES_COUNTERS:
+        return {
+            'out': {},
+            'result': False,
+            'comment': 'No samples available. Please schedule net.sample_counters.'
+        }
+
+    return {
+        'out': dict(
+            (interface_name, _interface_rates(samples, COUNTERS_64BITS.get(interface_name, ())))
+            for interface_name, samples in six.iteritems(interfaces_samples)
+        ),
+        'result': True,
+        'comment': ''
+    }
+
 
-def lldp(interface=''):
+def lldp(interface='', since=None):
 
     '''
     Returns a detailed view of the LLDP neighbors.
 
     :param interface: interface name to filter on
+    :param since:     fingerprint returned by a previous call. When the LLDP neighbors did not change meanwhile,
+    the output is empty and the flag `unchanged` is set. Can also be a dictionary having the minion ID as key and the
+    fingerprint as value, useful when the same job is published to many devices.
     :return:          A dictionary with the LLDL neighbors.\
     The keys are the interfaces with LLDP activated on.
+    Besides the usual keys, the output has `fingerprint`: the hash of the complete LLDP neighbors details.
 
     CLI Example:
 
@@ -605,6 +2239,7 @@ def lldp(interface=''):
 
         salt '*' net.lldp
         salt '*' net.lldp interface='TenGigE0/0/0/8'
+        salt '*' net.lldp since=9c1a0d6e0a25f0ab87a1e0f4a1f0c6d3
 
     Example output:
 
@@ -639,6 +2274,19 @@ def lldp(interface=''):
         return proxy_output
 
     lldp_neighbors = proxy_output.get('out')
+    fingerprint = _fingerprint(lldp_neighbors)
+
+    proxy_output['fingerprint'] = fingerprint
+    proxy_output['unchanged'] = False
+
+    if since and _since_token(since) == fingerprint:
+        # nothing changed since the previous call
+        # no need to send the neighbors back
+        proxy_output.update({
+            'out': {},
+            'unchanged': True
+        })
+        return proxy_output
 
     if interface:
         lldp_neighbors = {interface: lldp_neighbors.get(interface)}
@@ -726,7 +2374,7 @@ def mac(address='', interface='', vlan=0):
 # ----- Configuration specific functions ------------------------------------------------------------------------------>
 
 
-def load_config(filename=None, text=None, test=False, commit=True):
+def load_config(filename=None, text=None, test=False, commit=True, expected_diff_hash=None, diff_format='text'):
 
     '''
     Populates the candidate configuration. It can be loaded from a file or from a string. If you send both a
@@ -745,6 +2393,11 @@ def load_config(filename=None, text=None, test=False, commit=True):
                    and would not be optimal to commit after each operation.
                    Also, from the CLI when the user needs to apply the similar changes before committing,
                    can specify commit=False and will not discard the config.
+    :param expected_diff_hash: Hash of the diff returned by a previous dry run (`diff_hash`). When the proxy still
+    remembers the diff of that dry run, loading the same config (when loading from a file, the same contents) and the
+    running config did not change meanwhile, the comparison is skipped and the changes are committed straight away.
+    :param diff_format: How to return the changes: `text` (default) as returned by the device, `structured` parsed
+    in sections with the lines added and removed, or `both`.
 
     :raise MergeConfigException: If there is an error on the configuration sent.
 
@@ -756,6 +2409,11 @@ def load_config(filename=None, text=None, test=False, commit=True):
         * comment (str): a message for the user
         * already_configured (bool): flag to check if there were no changes applied
         * diff (str): returns the config changes applied
+        * diff_hash (str): hash of the diff, to be sent as `expected_diff_hash` when applying the changes of a dry run
+        * diff_sections (dict): the lines added and removed, and their counts, per config section, when \
+        `diff_format` is `structured` or `both`
+        * diff_stats (dict): number of sections changed, lines added and removed
+        * timing (dict): seconds spent in each phase: load, compare, commit, discard
 
     CLI Example:
 
@@ -765,6 +2423,8 @@ def load_config(filename=None, text=None, test=False, commit=True):
         salt '*' net.load_config filename='/absolute/path/to/your/file'
         salt '*' net.load_config filename='/absolute/path/to/your/file' test=True
         salt '*' net.load_config filename='/absolute/path/to/your/file' commit=False
+        salt '*' net.load_config filename='/absolute/path/to/your/file' expected_diff_hash=0bd8e3b9c2f1a8e4c8d0a0b5d5b7a1c2
+        salt '*' net.load_config filename='/absolute/path/to/your/file' test=True diff_format=structured
 
     Example output:
 
@@ -774,19 +2434,67 @@ def load_config(filename=None, text=None, test=False, commit=True):
             'comment': 'Configuration discarded.',
             'already_configured': False,
             'result': True,
-            'diff': '[edit interfaces xe-0/0/5]\n+   description "Adding a description";'
+            'diff': '[edit interfaces xe-0/0/5]\n+   description "Adding a description";',
+            'diff_hash': '0bd8e3b9c2f1a8e4c8d0a0b5d5b7a1c2',
+            'timing': {
+                'load': 0.412,
+                'compare': 1.873,
+                'discard': 0.208
+            }
+        }
+
+    Example output, with `diff_format=structured`:
+
+    .. code-block:: python
+
+        {
+            'comment': 'Configuration discarded.',
+            'already_configured': False,
+            'result': True,
+            'diff_sections': {
+                'interfaces xe-0/0/5': {
+                    'added': [
+                        'description "Adding a description";'
+                    ],
+                    'removed': [],
+                    'added_count': 1,
+                    'removed_count': 0
+                }
+            },
+            'diff_stats': {
+                'sections': 1,
+                'added': 1,
+                'removed': 0
+            },
+            'diff_hash': '0bd8e3b9c2f1a8e4c8d0a0b5d5b7a1c2',
+            'timing': {
+                'load': 0.412,
+                'compare': 1.873,
+                'discard': 0.208
+            }
         }
     '''
 
-    _loaded = __proxy__['napalm.call'](
-        'load_merge_candidate',
-        **{
-            'filename': filename,
-            'config': text
+    if diff_format not in DIFF_FORMATS:
+        return {
+            'result': False,
+            'already_configured': False,
+            'comment': 'Invalid diff format: {diff_format}. Choose between: {formats}'.format(
+                diff_format=diff_format,
+                formats=', '.join(DIFF_FORMATS)
+            )
         }
-    )
 
-    return _config_logic(_loaded, test=test, commit_config=commit)
+    loaded_result = _config_logic('load_merge_candidate',
+                                  {
+                                      'filename': filename,
+                                      'config': text
+                                  },
+                                  test=test,
+                                  commit_config=commit,
+                                  expected_diff_hash=expected_diff_hash)
+
+    return _format_diff(loaded_result, diff_format=diff_format)
 
 
 def load_template(template_name,
@@ -794,12 +2502,22 @@ def load_template(template_name,
                   template_path=None,
                   test=False,
                   commit=True,
+                  expected_diff_hash=None,
+                  diff_format='text',
                   **template_vars):
 
     '''
     Renders a configuration template (Jinja) and loads the result on the device.
     By default will commit the changes. To force a dry run, set `test=True`.
 
+    The compiled templates are cached, per driver. On the platforms exposing the last commit (Junos, IOS-XR, IOS),
+    when the same template renders exactly the same configuration as the last times it was found already applied
+    and nothing was committed meanwhile, the configuration is not loaded and the flag `already_configured` is set.
+    The last commit is checked only for the configurations previously found already applied.
+
+    The templates are looked up as in NAPALM. An inline template (`template_source`) is however rendered in the
+    environment of the driver templates, therefore it can include them, e.g.: ``{% include 'set_ntp_peers.j2' %}``.
+
     :param template_name: Identifies the template name.
     :param template_source (optional): Inline config template to be rendered and loaded on the device.
     :param template_path (optional): Specifies the absolute path to a different directory for the configuration \
@@ -811,6 +2529,11 @@ def load_template(template_name,
                    and would not be optimal to commit after each operation.
                    Also, from the CLI when the user needs to apply the similar changes before committing,
                    can specify commit=False and will not discard the config.
+    :param expected_diff_hash: Hash of the diff returned by a previous dry run (`diff_hash`). When the proxy still
+    remembers the diff of that dry run, loading the same config (when loading from a file, the same contents) and the
+    running config did not change meanwhile, the comparison is skipped and the changes are committed straight away.
+    :param diff_format: How to return the changes: `text` (default) as returned by the device, `structured` parsed
+    in sections with the lines added and removed, or `both`.
     :param template_vars: Dictionary with the arguments to be used when the template is rendered.
 
     :return a dictionary having the following keys:
@@ -821,6 +2544,11 @@ def load_template(template_name,
         * comment (str): a message for the user
         * already_configured (bool): flag to check if there were no changes applied
         * diff (str): returns the config changes applied
+        * diff_hash (str): hash of the diff, to be sent as `expected_diff_hash` when applying the changes of a dry run
+        * diff_sections (dict): the lines added and removed, and their counts, per config section, when \
+        `diff_format` is `structured` or `both`
+        * diff_stats (dict): number of sections changed, lines added and removed
+        * timing (dict): seconds spent in each phase: load, compare, commit, discard
 
     The template can use variables from the ``grains``, ``pillar`` or ``opts```, for example:
 
@@ -844,6 +2572,7 @@ def load_template(template_name,
         domain_name='test.com'
         salt '*' net.load_template my_template template_path='/tmp/tpl/' my_param='aaa'  # will commit
         salt '*' net.load_template my_template template_path='/tmp/tpl/' my_param='aaa' test=True  # dry run
+        salt '*' net.load_template my_template template_path='/tmp/tpl/' test=True diff_format=structured
 
     Example output:
 
@@ -853,29 +2582,87 @@ def load_template(template_name,
             'comment': '',
             'already_configured': False,
             'result': True,
-            'diff': '[edit system]\n+  host-name edge01.bjm01;''
+            'diff': '[edit system]\n+  host-name edge01.bjm01;'',
+            'diff_hash': '7d6b1d0f5b7e8b3a6d4cd41c9d8bb3e1',
+            'timing': {
+                'load': 0.377,
+                'compare': 1.524,
+                'commit': 3.016
+            }
         }
     '''
 
-    load_templates_params = template_vars.copy()  # to leave the template_vars unchanged
-    load_templates_params.update(
+    if diff_format not in DIFF_FORMATS:
+        return {
+            'result': False,
+            'already_configured': False,
+            'comment': 'Invalid diff format: {diff_format}. Choose between: {formats}'.format(
+                diff_format=diff_format,
+                formats=', '.join(DIFF_FORMATS)
+            )
+        }
+
+    template_vars = template_vars.copy()  # to leave the template_vars unchanged
+    template_vars.update(
         {
-            'template_name': template_name,
-            'template_source': template_source,  # inline template
-            'template_path': template_path,
             'pillar': __pillar__,  # inject pillar content, accessible as `pillar`
             'grains': __grains__,  # inject grains, accessible as `grains`
             'opts': __opts__  # inject opts, accessible as `opts`
         }
     )
 
-    _loaded = __proxy__['napalm.call']('load_template',
-                                       **load_templates_params
-                                       )
+    try:
+        rendered = _render_template(template_name,
+                                    template_source=template_source,
+                                    template_path=template_path,
+                                    **template_vars)
+    except Exception as error:
+        return {
+            'result': False,
+            'already_configured': False,
+            'comment': 'Unable to render the template {template_name}: {error}'.format(
+                template_name=template_name,
+                error=error
+            )
+        }
 
-    return _config_logic(_loaded,
-                         test=test,
-                         commit_config=commit)
+    applied_hash = _fingerprint([template_name, rendered])
+    marker = None
+
+    if applied_hash in TEMPLATES_APPLIED:
+        # the same config was found already applied
+        # only now worth asking the device for the last commit, as the load might be skipped
+        # retrieved before loading, a commit made during the load will not be missed
+        marker = _config_change_marker()
+        if marker and marker == TEMPLATES_APPLIED[applied_hash]:
+            # the running config did not change meanwhile
+            return _format_diff({
+                'result': True,
+                'already_configured': True,
+                'comment': 'Already configured.',
+                'diff': ''
+            }, diff_format=diff_format)
+
+    loaded_result = _config_logic('load_merge_candidate',
+                                  {
+                                      'config': rendered
+                                  },
+                                  test=test,
+                                  commit_config=commit,
+                                  expected_diff_hash=expected_diff_hash)
+
+    if not loaded_result.get('result'):
+        return _format_diff(loaded_result, diff_format=diff_format)
+
+    if loaded_result.get('already_configured') or not loaded_result.get('diff'):
+        # the next run will verify the last commit
+        # and skip the load when the marker is the same as now
+        TEMPLATES_APPLIED[applied_hash] = marker
+    elif 'commit' in loaded_result.get('timing', {}):
+        # committed, the marker changed
+        TEMPLATES_APPLIED.clear()
+
+    return _format_diff(loaded_result, diff_format=diff_format)
 
 
 def commit():
@@ -950,11 +2737,56 @@ def rollback():
     )
 
 
-def config_changed():
+def config_fingerprint():
+
+    '''
+    Returns the fingerprint of the running configuration: the hash of the running config and of the last commit ID
+    or last change timestamp, on the platforms exposing it (JunOS, IOS-XR, IOS).
+    On these platforms the running config is retrieved only when the last commit marker changed.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' net.config_fingerprint
+
+    Example output:
+
+    .. code-block:: python
+
+        {
+            'fingerprint': '8f2c3fd4dd5c5b8a0d1d6a5a1e3e7a91',
+            'marker': '2016-12-01 10:00:00 UTC by mircea via netconf'
+        }
+    '''
+
+    fingerprint = _running_config_fingerprint()
+
+    if not fingerprint:
+        return {
+            'out': {},
+            'result': False,
+            'comment': 'Unable to retrieve the running config.'
+        }
+
+    return {
+        'out': {
+            'fingerprint': fingerprint,
+            'marker': CONFIG_FINGERPRINT['marker']
+        },
+        'result': True,
+        'comment': ''
+    }
+
+
+def config_changed(since=None):
 
     '''
     Will prompt if the configuration has been changed.
 
+    :param since: fingerprint of the running config, as returned by `net.config_fingerprint`. When specified, checks
+    if the running config changed since that fingerprint, instead of comparing the candidate and the running config.
+    Can also be a dictionary having the minion ID as key and the fingerprint as value.
     :return: A tuple with a boolean that specifies if the config was changed on the device.\
     And a string that provides more details of the reason why the configuration was not changed.
 
@@ -963,10 +2795,22 @@ def config_changed():
     .. code-block:: bash
 
         salt '*' net.config_changed
+        salt '*' net.config_changed since=8f2c3fd4dd5c5b8a0d1d6a5a1e3e7a91
     '''
 
     is_config_changed = False
     reason = ''
+
+    if since:
+        fingerprint = _running_config_fingerprint()
+        if not fingerprint:
+            return is_config_changed, 'Unable to retrieve the running config.'
+        if fingerprint != _since_token(since):
+            is_config_changed = True
+        else:
+            reason = 'Configuration was not changed on the device.'
+        return is_config_changed, reason
+
     try_compare = compare_config()
 
     if try_compare.get('result'):
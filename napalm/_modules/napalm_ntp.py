@@ -23,9 +23,14 @@ Dependencies
 
 from __future__ import absolute_import
 
+import time
 import logging
 log = logging.getLogger(__file__)
 
+from collections import deque
+
+from salt.ext import six
+
 
 try:
     # will try to import NAPALM
@@ -45,6 +50,31 @@ __virtualname__ = 'ntp'
 __proxyenabled__ = ['napalm']
 # uses NAPALM-based proxy to interact with network devices
 
+# ----------------------------------------------------------------------------------------------------------------------
+# global variables
+# ----------------------------------------------------------------------------------------------------------------------
+
+PEERS_STATE = {}
+# last state polled, by NTP peer: synchronized, stratum, last offset and jitter samples, thresholds exceeded
+
+LAST_POLL = {
+    'timestamp': None,
+    'mine': None
+}
+# time of the last poll of the NTP stats, and of the last summary sent to the mine
+
+MINE_REFRESH = 300
+# default number of seconds after which the summary is sent again to the mine, even when nothing changed
+
+SAMPLES_KEPT = 10
+# number of offset and jitter samples kept for each peer, for the rolling statistics
+
+THRESHOLDS = {
+    'offset': 100.0,
+    'jitter': 50.0
+}
+# default thresholds of the rolling mean of the absolute offset and of the jitter, in milliseconds
+
 # ----------------------------------------------------------------------------------------------------------------------
 # property functions
 # ----------------------------------------------------------------------------------------------------------------------
@@ -67,6 +97,58 @@ def __virtual__():
 # helper functions -- will not be exported
 # ----------------------------------------------------------------------------------------------------------------------
 
+
+def _mean(samples):
+
+    return round(sum(samples) / float(len(samples)), 3) if samples else 0.0
+
+
+def _peer_stats(peer_state):
+
+    '''
+    Returns the rolling statistics of the peer.
+    '''
+
+    return {
+        'synchronized': peer_state['synchronized'],
+        'stratum': peer_state['stratum'],
+        'offset': _mean(peer_state['offset']),
+        'offset_max': max(peer_state['offset']) if peer_state['offset'] else 0.0,
+        'jitter': _mean(peer_state['jitter']),
+        'jitter_max': max(peer_state['jitter']) if peer_state['jitter'] else 0.0,
+        'exceeded': sorted(peer_state['exceeded']),
+        'samples': len(peer_state['offset'])
+    }
+
+
+def _synchronized():
+
+    return any([peer_state['synchronized'] for peer_state in six.itervalues(PEERS_STATE)])
+
+
+def _summary():
+
+    return {
+        'synchronized': _synchronized(),
+        'peers': dict(
+            (peer, _peer_stats(peer_state))
+            for peer, peer_state in six.iteritems(PEERS_STATE)
+        ),
+        'timestamp': LAST_POLL['timestamp']
+    }
+
+
+def _send_event(peer, change, **data):
+
+    data['peer'] = peer
+    __salt__['event.send'](
+        'napalm/ntp/{peer}/{change}'.format(
+            peer=peer,
+            change=change
+        ),
+        data
+    )
+
 # ----------------------------------------------------------------------------------------------------------------------
 # callable functions
 # ----------------------------------------------------------------------------------------------------------------------
@@ -332,3 +414,206 @@ def delete_servers(*servers, **options):
                                          servers=servers,
                                          test=test,
                                          commit=commit)
+
+
+def monitor(offset_threshold=None, jitter_threshold=None):
+
+    '''
+    Polls the NTP stats and keeps, on the proxy, the rolling statistics of the offset and jitter of each peer,
+    over the last 10 polls.
+    Only the changes are sent as events on the Salt bus, tagged as ``napalm/ntp/<peer>/<change>``:
+
+    - ``synchronized`` / ``unsynchronized``: the device started or stopped synchronizing with the peer
+    - ``stratum``: the stratum of the peer changed
+    - ``offset`` / ``jitter``: the rolling mean of the absolute offset, or of the jitter, went above or back below
+    the threshold
+    - ``added`` / ``removed``: the peer appeared or disappeared
+
+    When anything changes, the summary returned by `ntp.summary` is sent to the Salt mine,
+    therefore the ``ntp.unsynchronized`` runner can answer without polling the devices.
+    The summary is also sent at least every ``napalm_ntp_mine_refresh`` seconds (default: 300), even when nothing
+    changed, so the runner can tell the devices still polled from those whose summary in the mine is outdated.
+
+    This function is meant to be executed periodically by the scheduler, without returning the job to the master,
+    e.g., in the proxy config:
+
+    .. code-block:: yaml
+
+        schedule:
+          ntp:
+            function: ntp.monitor
+            seconds: 60
+            return_job: False
+
+    :param offset_threshold: Threshold of the mean absolute offset, in milliseconds. If not specified, will use
+    the value of the ``napalm_ntp_offset_threshold`` option, falling back to 100.
+    :param jitter_threshold: Threshold of the mean jitter, in milliseconds. If not specified, will use the value
+    of the ``napalm_ntp_jitter_threshold`` option, falling back to 50.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' ntp.monitor
+        salt '*' ntp.monitor offset_threshold=10
+
+    Example output:
+
+    .. code-block:: python
+
+        {
+            'out': {
+                'peers': 3,
+                'synchronized': True,
+                'changes': 1,
+                'timestamp': 1480586400.2
+            },
+            'result': True,
+            'comment': ''
+        }
+    '''
+
+    proxy_output = __proxy__['napalm.call'](
+        'get_ntp_stats',
+        **{
+        }
+    )
+
+    if not proxy_output.get('result'):
+        return proxy_output
+
+    thresholds = {
+        'offset': offset_threshold,
+        'jitter': jitter_threshold
+    }
+    for metric, default_threshold in six.iteritems(THRESHOLDS):
+        if thresholds[metric] is None:
+            thresholds[metric] = __salt__['config.get']('napalm_ntp_{0}_threshold'.format(metric), default_threshold)
+        thresholds[metric] = float(thresholds[metric])
+
+    now = time.time()
+    first_poll = LAST_POLL['timestamp'] is None
+    changes = 0
+    polled = set()
+
+    for peer_stats in proxy_output.get('out') or []:
+        peer = peer_stats.get('remote', '')
+        if not peer:
+            continue
+        polled.add(peer)
+        synchronized = peer_stats.get('synchronized', False)
+        stratum = peer_stats.get('stratum', 16)
+        peer_state = PEERS_STATE.get(peer)
+        if peer_state is None:
+            peer_state = PEERS_STATE[peer] = {
+                'synchronized': synchronized,
+                'stratum': stratum,
+                'offset': deque(maxlen=SAMPLES_KEPT),
+                'jitter': deque(maxlen=SAMPLES_KEPT),
+                'exceeded': set()
+            }
+            if not first_poll:
+                _send_event(peer, 'added', synchronized=synchronized, stratum=stratum)
+                changes += 1
+        else:
+            if synchronized != peer_state['synchronized']:
+                _send_event(peer,
+                            'synchronized' if synchronized else 'unsynchronized',
+                            stratum=stratum)
+                changes += 1
+            if stratum != peer_state['stratum']:
+                _send_event(peer, 'stratum', previous=peer_state['stratum'], stratum=stratum)
+                changes += 1
+            peer_state.update({
+                'synchronized': synchronized,
+                'stratum': stratum
+            })
+        peer_state['offset'].append(abs(float(peer_stats.get('offset', 0.0))))
+        peer_state['jitter'].append(float(peer_stats.get('jitter', 0.0)))
+        for metric, threshold in six.iteritems(thresholds):
+            mean = _mean(peer_state[metric])
+            exceeded = mean > threshold
+            if exceeded == (metric in peer_state['exceeded']):
+                continue
+            if exceeded:
+                peer_state['exceeded'].add(metric)
+            else:
+                peer_state['exceeded'].discard(metric)
+            _send_event(peer, metric, exceeded=exceeded, mean=mean, threshold=threshold)
+            changes += 1
+
+    for peer in list(PEERS_STATE.keys()):
+        if peer not in polled:
+            _send_event(peer, 'removed')
+            PEERS_STATE.pop(peer)
+            changes += 1
+
+    LAST_POLL['timestamp'] = now
+
+    mine_refresh = float(__salt__['config.get']('napalm_ntp_mine_refresh', MINE_REFRESH))
+    if changes or LAST_POLL['mine'] is None or now - LAST_POLL['mine'] >= mine_refresh:
+        __salt__['mine.send']('ntp.summary')
+        LAST_POLL['mine'] = now
+
+    return {
+        'out': {
+            'peers': len(PEERS_STATE),
+            'synchronized': _synchronized(),
+            'changes': changes,
+            'timestamp': now
+        },
+        'result': True,
+        'comment': ''
+    }
+
+
+def summary():
+
+    '''
+    Returns the state of the NTP peers, as seen by the last `ntp.monitor` poll, with the rolling statistics
+    of the offset and jitter. Does not query the device.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' ntp.summary
+
+    Example output:
+
+    .. code-block:: python
+
+        {
+            'out': {
+                'synchronized': True,
+                'peers': {
+                    '188.114.101.4': {
+                        'synchronized': True,
+                        'stratum': 4,
+                        'offset': 13.866,
+                        'offset_max': 15.102,
+                        'jitter': 2.695,
+                        'jitter_max': 3.01,
+                        'exceeded': [],
+                        'samples': 10
+                    }
+                },
+                'timestamp': 1480586400.2
+            },
+            'result': True,
+            'comment': ''
+        }
+    '''
+
+    if LAST_POLL['timestamp'] is None:
+        return {
+            'out': {},
+            'result': False,
+            'comment': 'No NTP stats polled yet. Please schedule ntp.monitor.'
+        }
+
+    return {
+        'out': _summary(),
+        'result': True,
+        'comment': ''
+    }
@@ -19,9 +19,24 @@ Dependencies
 
 from __future__ import absolute_import
 
+import os
+import gzip
+import time
+import socket
 import logging
+import binascii
 log = logging.getLogger(__file__)
 
+from salt.ext import six
+
+# msgpack is a Salt dependency
+import msgpack
+
+try:
+    import zstandard
+    HAS_ZSTD = True
+except ImportError:
+    HAS_ZSTD = False
 
 try:
     # will try to import NAPALM
@@ -41,6 +56,54 @@ __virtualname__ = 'route'
 __proxyenabled__ = ['napalm']
 # uses NAPALM-based proxy to interact with network devices
 
+# ----------------------------------------------------------------------------------------------------------------------
+# global variables
+# ----------------------------------------------------------------------------------------------------------------------
+
+RIB_SNAPSHOT = {
+    'tables': {
+        4: {},
+        6: {}
+    },
+    'protocol': None,
+    'prefixes': 0,
+    'timestamp': None
+}
+# routes loaded by `route.snapshot`, indexed by IP version, prefix length and network address
+
+RIB_ROUTE_FIELDS = (
+    'protocol',
+    'current_active',
+    'next_hop',
+    'outgoing_interface',
+    'preference',
+    'routing_table'
+)
+# details kept in the snapshot for each route
+# without the age, which would mark all the routes as changed on every refresh
+
+_ADDRESS_FAMILIES = (
+    (4, socket.AF_INET, 32),
+    (6, socket.AF_INET6, 128)
+)
+
+RIB_EXPORT_FIELDS = (
+    'prefix',
+    'protocol',
+    'next_hop',
+    'outgoing_interface',
+    'routing_table',
+    'preference',
+    'current_active'
+)
+# columns of the routes exported by `route.export`
+
+RIB_EXPORT_INTERNED = ('protocol', 'next_hop', 'outgoing_interface', 'routing_table')
+# columns written as references to a string table, as they repeat across the routes
+
+RIB_EXPORT_STRING, RIB_EXPORT_ROUTE = 0, 1
+# record types of the export: string definition, route
+
 # ----------------------------------------------------------------------------------------------------------------------
 # property functions
 # ----------------------------------------------------------------------------------------------------------------------
@@ -63,24 +126,220 @@ def __virtual__():
 # helper functions -- will not be exported
 # ----------------------------------------------------------------------------------------------------------------------
 
+
+def _parse_prefix(prefix):
+
+    '''
+    Returns the IP version, the number of bits, the prefix length and the network address of a prefix,
+    as integer. An address without prefix length is considered a host route.
+    '''
+
+    address, _, prefix_length = prefix.strip().partition('/')
+    for version, address_family, bits in _ADDRESS_FAMILIES:
+        try:
+            packed = socket.inet_pton(address_family, address)
+        except (socket.error, ValueError):
+            continue
+        prefix_length = int(prefix_length) if prefix_length else bits
+        return version, bits, prefix_length, int(binascii.hexlify(packed), 16) >> (bits - prefix_length)
+
+    raise ValueError('Invalid prefix: {prefix}'.format(prefix=prefix))
+
+
+def _compact_routes(routes):
+
+    return [
+        dict((field, route.get(field)) for field in RIB_ROUTE_FIELDS)
+        for route in routes
+    ]
+
+
+def _snapshot_age():
+
+    if RIB_SNAPSHOT['timestamp'] is None:
+        return None
+
+    return round(time.time() - RIB_SNAPSHOT['timestamp'], 1)
+
+
+def _filter_protocol(routes, protocol):
+
+    if not protocol:
+        return routes
+
+    return [route for route in routes if (route.get('protocol') or '').lower() == protocol.lower()]
+
+
+def _snapshot_lookup(destination, mode='lpm', protocol=''):
+
+    '''
+    Returns the prefixes from the snapshot matching the destination, having routes learned via the protocol:
+
+    - lpm: the most specific prefix covering the destination
+    - covering: all the prefixes covering the destination
+    - covered: all the prefixes within the destination
+    '''
+
+    version, _, prefix_length, network = _parse_prefix(destination)
+    tables = RIB_SNAPSHOT['tables'][version]
+    matches = {}
+
+    if mode in ('lpm', 'covering'):
+        for length in range(prefix_length, -1, -1):
+            table = tables.get(length)
+            if not table:
+                continue
+            match = table.get(network >> (prefix_length - length))
+            if match is None:
+                continue
+            routes = _filter_protocol(match[1], protocol)
+            if not routes:
+                continue
+            matches[match[0]] = routes
+            if mode == 'lpm':
+                break
+    elif mode == 'covered':
+        for length, table in six.iteritems(tables):
+            if length < prefix_length:
+                continue
+            for table_network, match in six.iteritems(table):
+                if table_network >> (length - prefix_length) != network:
+                    continue
+                routes = _filter_protocol(match[1], protocol)
+                if routes:
+                    matches[match[0]] = routes
+    else:
+        raise ValueError('Unknown lookup mode: {mode}. Choose between: lpm, covering, covered'.format(mode=mode))
+
+    return matches
+
+
+def _destinations_protocols(destinations, protocol):
+
+    '''
+    Accepts a list of destinations or a comma separated string, all looked up for the same protocol,
+    or a dictionary having the destinations as keys and the protocols as values.
+    '''
+
+    if isinstance(destinations, dict):
+        return [
+            (destination.strip(), destination_protocol or protocol)
+            for destination, destination_protocol in six.iteritems(destinations)
+        ]
+
+    if isinstance(destinations, six.string_types):
+        destinations = destinations.split(',')
+
+    return [(destination.strip(), protocol) for destination in destinations if destination and destination.strip()]
+
+
+def _route_summary(route_output):
+
+    '''
+    Summarizes the output of `get_route_to`: number of routes and the details of the active route.
+    '''
+
+    if not route_output.get('result'):
+        return {
+            'error': route_output.get('comment', '')
+        }
+
+    routes = 0
+    best = None
+
+    for prefix, prefix_routes in six.iteritems(route_output.get('out') or {}):
+        routes += len(prefix_routes)
+        for route in prefix_routes:
+            if best is None and route.get('current_active'):
+                best = {
+                    'prefix': prefix,
+                    'protocol': route.get('protocol', ''),
+                    'next_hop': route.get('next_hop', ''),
+                    'outgoing_interface': route.get('outgoing_interface', ''),
+                    'preference': route.get('preference'),
+                    'age': route.get('age')
+                }
+
+    return {
+        'found': routes > 0,
+        'routes': routes,
+        'best': best
+    }
+
+
+def _export_path(protocol, compression):
+
+    export_dir = os.path.join(__opts__['cachedir'], 'napalm', 'rib')
+    if not os.path.isdir(export_dir):
+        os.makedirs(export_dir)
+
+    return os.path.join(export_dir, 'rib{protocol}.msgpack{extension}'.format(
+        protocol='-{0}'.format(protocol.lower()) if protocol else '',
+        extension={'zstd': '.zst', 'gzip': '.gz'}.get(compression, '')
+    ))
+
+
+def _export_writer(path, compression):
+
+    raw_file = open(path, 'wb')
+    if compression == 'zstd':
+        return raw_file, zstandard.ZstdCompressor().stream_writer(raw_file)
+    if compression == 'gzip':
+        return raw_file, gzip.GzipFile(fileobj=raw_file, mode='wb')
+
+    return raw_file, raw_file
+
+
+def _export_routes(protocol, cached):
+
+    '''
+    Yields the prefixes and their routes, releasing them as they are consumed.
+    When not using the snapshot, the complete table returned by `get_route_to` is first held in memory.
+    '''
+
+    if cached:
+        for tables in six.itervalues(RIB_SNAPSHOT['tables']):
+            for table in six.itervalues(tables):
+                for prefix, routes in six.itervalues(table):
+                    yield prefix, _filter_protocol(routes, protocol)
+        return
+
+    routes_output = __proxy__['napalm.call'](
+        'get_route_to',
+        **{
+            'destination': '',
+            'protocol': protocol
+        }
+    )
+    if not routes_output.get('result'):
+        raise Exception(routes_output.get('comment'))
+
+    all_routes = routes_output.pop('out') or {}
+    while all_routes:
+        yield all_routes.popitem()  # the routes already written can be garbage collected
+
 # ----------------------------------------------------------------------------------------------------------------------
 # callable functions
 # ----------------------------------------------------------------------------------------------------------------------
 
 
-def show(destination, protocol):
+def show(destination, protocol, cached=False):
 
     '''
     Displays all details for a certain route learned via a specific protocol.
 
     :param destination: destination prefix.
     :param protocol: protocol used to learn the routes to the destination.
+    :param cached: answer from the snapshot loaded by `route.snapshot`, with the longest prefix match,
+    without querying the device. The age of the snapshot, in seconds, is returned as `snapshot_age`.
+    The snapshot keeps only the main details of the routes, without the protocol attributes.
 
     CLI Example:
 
     .. code-block:: bash
 
         salt 'my_router' route.show 172.16.0.0/25 bgp
+        salt 'my_router' route.show 172.16.0.1 bgp cached=True
 
     Output example:
 
@@ -144,6 +403,9 @@ def show(destination, protocol):
         }
     '''
 
+    if cached:
+        return lookup(destination, mode='lpm', protocol=protocol)
+
     return __proxy__['napalm.call'](
         'get_route_to',
         **{
@@ -151,3 +413,401 @@ def show(destination, protocol):
             'protocol': protocol
         }
     )
+
+
+def show_many(destinations, protocol='', details=False, stream=False, stream_id=None, **kwargs):
+
+    '''
+    Looks up many destinations, back to back, in the same session with the device.
+    Returns, for each destination, a compact summary: whether any route was found, the number of routes,
+    and the details of the active route.
+
+    :param destinations: List of destination prefixes, or a comma separated string. To look up each destination
+    for a different protocol, send a dictionary having the destinations as keys and the protocols as values.
+    :param protocol: Protocol used to learn the routes, for the destinations not specifying one.
+    Default: any protocol.
+    :param details: Return the complete output of `route.show` for each destination, not only the summary.
+    :param stream: Send the result of each destination on the Salt event bus, as soon as it is retrieved,
+    tagged as ``napalm/route/<minion>/<stream_id>/<index>``. Only the counters are returned.
+    :param stream_id: Identifies the events of this execution. Default: the job ID.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt 'my_router' route.show_many 172.16.0.0/25,10.0.0.0/8 bgp
+        salt 'my_router' route.show_many "{'172.16.0.0/25': 'bgp', '10.10.10.10/32': 'isis'}"
+        salt 'my_router' route.show_many 172.16.0.0/25,10.0.0.0/8 stream=True
+
+    Output example:
+
+    .. code-block:: python
+
+        {
+            '172.16.0.0/25': {
+                'found': True,
+                'routes': 2,
+                'best': {
+                    'prefix': '172.16.0.0/25',
+                    'protocol': 'BGP',
+                    'next_hop': '192.168.0.11',
+                    'outgoing_interface': 'xe-1/1/1.100',
+                    'preference': 170,
+                    'age': 1178693
+                }
+            },
+            '10.0.0.0/8': {
+                'found': False,
+                'routes': 0,
+                'best': None
+            }
+        }
+    '''
+
+    destinations = _destinations_protocols(destinations, protocol)
+
+    if stream:
+        stream_id = stream_id or kwargs.get('__pub_jid') or '{now:.6f}'.format(now=time.time())
+        tag_prefix = 'napalm/route/{minion}/{stream_id}'.format(
+            minion=__opts__.get('id'),
+            stream_id=stream_id
+        )
+
+    results = {}
+    counters = {
+        'destinations': len(destinations),
+        'found': 0,
+        'not_found': 0,
+        'errors': 0
+    }
+
+    for index, (destination, destination_protocol) in enumerate(destinations):
+        route_output = show(destination, destination_protocol)
+        destination_result = _route_summary(route_output)
+        if details and route_output.get('result'):
+            destination_result['details'] = route_output.get('out', {})
+        if 'error' in destination_result:
+            counters['errors'] += 1
+        elif destination_result['found']:
+            counters['found'] += 1
+        else:
+            counters['not_found'] += 1
+        if stream:
+            destination_result.update({
+                'destination': destination,
+                'protocol': destination_protocol,
+                'index': index
+            })
+            __salt__['event.send']('{prefix}/{index}'.format(prefix=tag_prefix, index=index), destination_result)
+            continue
+        results[destination] = destination_result
+
+    return {
+        'out': counters if stream else results,
+        'result': True,
+        'comment': ''
+    }
+
+
+def snapshot(protocol=''):
+
+    '''
+    Loads the routing table in memory, on the proxy, to answer the lookups without querying the device:
+    see `route.lookup` and `route.show` with `cached=True`.
+
+    The routes are retrieved in bulk, in one request. On refresh, only the prefixes added, removed or changed
+    since the previous snapshot are updated in the lookup tables.
+
+    This function is meant to be executed periodically by the scheduler, without returning the job to the master,
+    e.g., in the proxy config:
+
+    .. code-block:: yaml
+
+        schedule:
+          rib_snapshot:
+            function: route.snapshot
+            minutes: 15
+            return_job: False
+
+    :param protocol: load only the routes learned via this protocol. Default: all protocols.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt 'my_router' route.snapshot
+        salt 'my_router' route.snapshot bgp
+
+    Output example:
+
+    .. code-block:: python
+
+        {
+            'prefixes': 712043,
+            'added': 18,
+            'removed': 7,
+            'changed': 391,
+            'duration': 94.2,
+            'timestamp': 1480586400.2
+        }
+    '''
+
+    start = time.time()
+
+    proxy_output = __proxy__['napalm.call'](
+        'get_route_to',
+        **{
+            'destination': '',
+            'protocol': protocol
+        }
+    )
+
+    if not proxy_output.get('result'):
+        return proxy_output
+
+    if RIB_SNAPSHOT['protocol'] != protocol:
+        # different set of routes, start over
+        for tables in six.itervalues(RIB_SNAPSHOT['tables']):
+            tables.clear()
+
+    counters = {
+        'added': 0,
+        'removed': 0,
+        'changed': 0
+    }
+    seen = set()
+
+    for prefix, routes in six.iteritems(proxy_output.pop('out') or {}):
+        try:
+            version, _, prefix_length, network = _parse_prefix(prefix)
+        except ValueError:
+            continue  # e.g.: MPLS labels
+        table = RIB_SNAPSHOT['tables'][version].setdefault(prefix_length, {})
+        compact = _compact_routes(routes)
+        previous = table.get(network)
+        if previous is None:
+            counters['added'] += 1
+            table[network] = (prefix, compact)
+        elif previous[1] != compact:
+            counters['changed'] += 1
+            table[network] = (prefix, compact)
+        seen.add((version, prefix_length, network))
+
+    prefixes = 0
+    for version, tables in six.iteritems(RIB_SNAPSHOT['tables']):
+        for prefix_length, table in list(six.iteritems(tables)):
+            for network in [network for network in table if (version, prefix_length, network) not in seen]:
+                table.pop(network)
+                counters['removed'] += 1
+            if not table:
+                tables.pop(prefix_length)
+            prefixes += len(table)
+
+    RIB_SNAPSHOT.update({
+        'protocol': protocol,
+        'prefixes': prefixes,
+        'timestamp': time.time()
+    })
+
+    counters.update({
+        'prefixes': prefixes,
+        'duration': round(time.time() - start, 3),
+        'timestamp': RIB_SNAPSHOT['timestamp']
+    })
+
+    return {
+        'out': counters,
+        'result': True,
+        'comment': ''
+    }
+
+
+def lookup(destination, mode='lpm', protocol=''):
+
+    '''
+    Looks up a destination in the routing table snapshot loaded by `route.snapshot`, without querying the device.
+    The age of the snapshot, in seconds, is returned as `snapshot_age`.
+
+    :param destination: IP address or prefix.
+    :param mode: `lpm` (default) returns the most specific prefix covering the destination, `covering` returns all
+    the prefixes covering the destination, `covered` returns all the prefixes within the destination.
+    :param protocol: return only the routes learned via this protocol. Default: all protocols.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt 'my_router' route.lookup 172.16.0.1
+        salt 'my_router' route.lookup 172.16.0.0/16 mode=covered protocol=bgp
+
+    Output example:
+
+    .. code-block:: python
+
+        {
+            'out': {
+                '172.16.0.0/25': [
+                    {
+                        'protocol': 'BGP',
+                        'current_active': True,
+                        'next_hop': '192.168.0.11',
+                        'outgoing_interface': 'xe-1/1/1.100',
+                        'preference': 170,
+                        'routing_table': 'inet.0'
+                    }
+                ]
+            },
+            'result': True,
+            'comment': '',
+            'snapshot_age': 312.4
+        }
+    '''
+
+    if RIB_SNAPSHOT['timestamp'] is None:
+        return {
+            'out': {},
+            'result': False,
+            'comment': 'No routing table snapshot available. Please execute route.snapshot first.'
+        }
+
+    try:
+        matches = _snapshot_lookup(destination, mode=mode, protocol=protocol)
+    except ValueError as error:
+        return {
+            'out': {},
+            'result': False,
+            'comment': str(error)
+        }
+
+    return {
+        'out': matches,
+        'result': True,
+        'comment': '',
+        'snapshot_age': _snapshot_age()
+    }
+
+
+def export(protocol='', compression='zstd', push=False, cached=False):
+
+    '''
+    Exports the routing table into a file in the cachedir of the proxy, for offline analysis.
+
+    The file is a stream of msgpack records, written as the routes are processed. Each record is a list,
+    whose first element is the record type:
+
+    - ``[0, <index>, <string>]``: defines a string, the first time it is used
+    - ``[1, <prefix>, <protocol>, <next_hop>, <outgoing_interface>, <routing_table>, <preference>, <active>]``: a route,
+      where the protocol, the next-hop, the outgoing interface and the routing table are indexes of the strings
+
+    Writing the file needs memory only for the distinct strings, and the routes are released as they are written.
+    However, when not exporting from the snapshot, NAPALM returns the complete routing table from `get_route_to`
+    in one call, therefore the whole table is held in memory, on the proxy, before the export starts.
+    On large tables, load the snapshot using `route.snapshot` and export it with `cached=True`.
+
+    :param protocol: export only the routes learned via this protocol. Default: all protocols.
+    :param compression: `zstd` (default, requires the zstandard library), `gzip`, or `none`.
+    When zstandard is not installed, the file is compressed using gzip.
+    :param push: upload the file to the master, using `cp.push`. The master must have `file_recv: True`.
+    :param cached: export the routes from the snapshot loaded by `route.snapshot`, without querying the device.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt 'my_router' route.export
+        salt 'my_router' route.export bgp push=True
+        salt 'my_router' route.export compression=gzip cached=True
+
+    Output example:
+
+    .. code-block:: python
+
+        {
+            'path': '/var/cache/salt/proxy/napalm/rib/rib.msgpack.zst',
+            'compression': 'zstd',
+            'prefixes': 712043,
+            'routes': 1835210,
+            'strings': 2381,
+            'size': 21093812,
+            'pushed': False
+        }
+    '''
+
+    if compression == 'zstd' and not HAS_ZSTD:
+        compression = 'gzip'
+    if compression not in ('zstd', 'gzip'):
+        compression = 'none'
+
+    if cached and RIB_SNAPSHOT['timestamp'] is None:
+        return {
+            'out': {},
+            'result': False,
+            'comment': 'No routing table snapshot available. Please execute route.snapshot first.'
+        }
+
+    path = _export_path(protocol, compression)
+    tmp_path = '{path}.tmp'.format(path=path)
+
+    packer = msgpack.Packer()
+    strings = {}
+    counters = {
+        'prefixes': 0,
+        'routes': 0
+    }
+
+    raw_file, writer = _export_writer(tmp_path, compression)
+    export_error = None
+
+    try:
+        for prefix, routes in _export_routes(protocol, cached):
+            if not routes:
+                continue
+            counters['prefixes'] += 1
+            for route in routes:
+                record = [RIB_EXPORT_ROUTE, prefix]
+                for field in RIB_EXPORT_FIELDS[1:]:
+                    value = route.get(field)
+                    if field in RIB_EXPORT_INTERNED:
+                        value = value or ''
+                        if value not in strings:
+                            strings[value] = len(strings)
+                            writer.write(packer.pack([RIB_EXPORT_STRING, strings[value], value]))
+                        value = strings[value]
+                    record.append(value)
+                writer.write(packer.pack(record))
+                counters['routes'] += 1
+    except Exception as error:
+        export_error = error
+    finally:
+        if writer is not raw_file:
+            writer.close()
+        if not raw_file.closed:
+            raw_file.close()
+
+    if export_error is not None:
+        os.remove(tmp_path)
+        return {
+            'out': {},
+            'result': False,
+            'comment': 'Unable to export the routing table: {error}'.format(error=export_error)
+        }
+
+    os.rename(tmp_path, path)
+
+    pushed = False
+    if push:
+        pushed = __salt__['cp.push'](path)
+
+    counters.update({
+        'path': path,
+        'compression': compression,
+        'strings': len(strings),
+        'size': os.path.getsize(path),
+        'pushed': pushed
+    })
+
+    return {
+        'out': counters,
+        'result': True,
+        'comment': ''
+    }
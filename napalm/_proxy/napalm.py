@@ -204,6 +204,39 @@ def grains_refresh():
     return grains()
 
 
+def get_device():
+
+    '''
+    Returns the name of the driver and the optional arguments used to connect to the network device.
+    The credentials are not exposed.
+    '''
+
+    return {
+        'DRIVER_NAME': NETWORK_DEVICE.get('DRIVER_NAME'),
+        'OPTIONAL_ARGS': dict(NETWORK_DEVICE.get('OPTIONAL_ARGS', {}))
+    }
+
+
+def get_connection():
+
+    '''
+    Opens a new connection with the network device, besides the connection kept by the proxy.
+    Useful to execute requests in parallel. The caller must close the connection.
+    '''
+
+    _driver_ = napalm_base.get_network_driver(NETWORK_DEVICE.get('DRIVER_NAME'))
+    connection = _driver_(
+        NETWORK_DEVICE.get('HOSTNAME', ''),
+        NETWORK_DEVICE.get('USERNAME', ''),
+        NETWORK_DEVICE.get('PASSWORD', ''),
+        timeout=NETWORK_DEVICE['TIMEOUT'],
+        optional_args=NETWORK_DEVICE['OPTIONAL_ARGS']
+    )
+    connection.open()
+
+    return connection
+
+
 def fns():
 
     '''
@@ -0,0 +1,360 @@
+"""
+Aggregates the BGP sessions of the network devices managed through the NAPALM proxy.
+
+The neighbors are collected from all the devices in one job, streaming the returns into columns:
+device, vrf, neighbor, local and remote AS, type (internal / external), up, state,
+received and accepted prefixes, number of flaps and uptime.
+When numpy is installed, the aggregates are computed on arrays, otherwise in pure Python.
+The columns can be exported as CSV, or as Parquet when pandas and pyarrow are installed.
+
+CLI Example:
+
+.. code-block:: bash
+
+    salt-run bgp.aggregate by=remote_as
+    salt-run bgp.aggregate by=type tgt='edge*'
+    salt-run bgp.export /tmp/bgp.parquet fmt=parquet
+"""
+from __future__ import absolute_import
+
+# Import stdlib
+import csv
+import logging
+log = logging.getLogger(__name__)
+
+# Import third party libs
+try:
+    import numpy
+    HAS_NUMPY = True
+except ImportError:
+    HAS_NUMPY = False
+
+try:
+    import pandas
+    import pyarrow  # pylint: disable=W0611
+    HAS_PARQUET = True
+except ImportError:
+    HAS_PARQUET = False
+
+# Import salt modules
+import salt.client
+from salt.ext import six
+
+# ----------------------------------------------------------------------------------------------------------------------
+# globals
+# ----------------------------------------------------------------------------------------------------------------------
+
+_COLUMNS = (
+    'device',
+    'vrf',
+    'neighbor',
+    'local_as',
+    'remote_as',
+    'type',
+    'up',
+    'state',
+    'received_prefixes',
+    'accepted_prefixes',
+    'flap_count',
+    'uptime'
+)
+
+_STATS_COLUMNS = ('received_prefixes', 'accepted_prefixes', 'uptime')
+
+# ----------------------------------------------------------------------------------------------------------------------
+# helper functions -- will not be exported
+# ----------------------------------------------------------------------------------------------------------------------
+
+
+def _get_client():
+
+    return salt.client.LocalClient(__opts__['conf_file'])
+
+
+def _collect(tgt, expr_form, timeout):
+
+    '''
+    Collects the BGP neighbors from the devices, appending the rows to the columns as the devices return.
+    The details of the neighbors and the summary of the sessions, having the uptime, are retrieved in the same job.
+    '''
+
+    _client = _get_client()
+    columns = dict((column, []) for column in _COLUMNS)
+    failed = []
+
+    for device_return in _client.cmd_iter(tgt,
+                                          ['bgp.neighbors', 'bgp.sessions'],
+                                          [[], []],
+                                          expr_form=expr_form,
+                                          timeout=timeout):
+        for device, device_output in six.iteritems(device_return):
+            device_ret = device_output.get('ret', {})
+            if not isinstance(device_ret, dict):
+                failed.append(device)
+                continue
+            bgp_neighbors = device_ret.get('bgp.neighbors', {})
+            if not isinstance(bgp_neighbors, dict) or not bgp_neighbors.get('result'):
+                failed.append(device)
+                continue
+            bgp_sessions = device_ret.get('bgp.sessions', {})
+            if not isinstance(bgp_sessions, dict) or not bgp_sessions.get('result'):
+                bgp_sessions = {}  # the uptime is not available, still counting the sessions
+            for vrf, vrf_neighbors in six.iteritems(bgp_neighbors.get('out') or {}):
+                vrf_peers = ((bgp_sessions.get('out') or {}).get(vrf) or {}).get('peers') or {}
+                for remote_as, neighbors in six.iteritems(vrf_neighbors):
+                    for neighbor in neighbors:
+                        local_as = neighbor.get('local_as')
+                        columns['device'].append(device)
+                        columns['vrf'].append(vrf)
+                        columns['neighbor'].append(neighbor.get('remote_address', ''))
+                        columns['local_as'].append(local_as)
+                        columns['remote_as'].append(remote_as)
+                        columns['type'].append('internal' if local_as == remote_as else 'external')
+                        columns['up'].append(bool(neighbor.get('up')))
+                        columns['state'].append(neighbor.get('connection_state', ''))
+                        columns['received_prefixes'].append(neighbor.get('received_prefix_count', -1))
+                        columns['accepted_prefixes'].append(neighbor.get('accepted_prefix_count', -1))
+                        columns['flap_count'].append(neighbor.get('flap_count', 0))
+                        columns['uptime'].append(
+                            vrf_peers.get(neighbor.get('remote_address', ''), {}).get('uptime', -1)
+                        )
+
+    return columns, sorted(failed)
+
+
+def _nearest_rank(sorted_values, percent):
+
+    if not len(sorted_values):
+        return None
+
+    return sorted_values[int(percent / 100.0 * (len(sorted_values) - 1) + 0.5)]
+
+
+def _percentiles_list(percentiles):
+
+    if isinstance(percentiles, six.string_types):
+        percentiles = percentiles.split(',')
+
+    return [float(percent) for percent in percentiles]
+
+
+def _column_stats(sorted_values, percentiles):
+
+    stats = {
+        'sum': sum(sorted_values) if len(sorted_values) else 0,
+        'min': sorted_values[0] if len(sorted_values) else None,
+        'max': sorted_values[-1] if len(sorted_values) else None
+    }
+    for percent in percentiles:
+        stats['p{0:g}'.format(percent)] = _nearest_rank(sorted_values, percent)
+
+    return stats
+
+
+def _column_stats_numpy(values, inverse, groups_count, percentiles):
+
+    '''
+    Computes the stats of a column for all groups at once.
+    The values are sorted once, by group then by value, each group being a contiguous slice.
+    '''
+
+    stats = [_column_stats([], percentiles) for _ in range(groups_count)]
+
+    valid = values >= 0  # -1 when not available
+    if not valid.any():
+        return stats
+
+    values = values[valid]
+    inverse = inverse[valid]
+    order = numpy.lexsort((values, inverse))
+    sorted_values = values[order].astype(numpy.int64)
+    present, starts = numpy.unique(inverse[order], return_index=True)
+    counts = numpy.diff(numpy.append(starts, len(sorted_values)))
+
+    sums = numpy.add.reduceat(sorted_values, starts)
+    columns_stats = {
+        'sum': sums,
+        'min': sorted_values[starts],
+        'max': sorted_values[starts + counts - 1]
+    }
+    for percent in percentiles:
+        ranks = (percent / 100.0 * (counts - 1) + 0.5).astype(numpy.int64)  # same rounding as _nearest_rank
+        columns_stats['p{0:g}'.format(percent)] = sorted_values[starts + ranks]
+
+    for stat, stat_values in six.iteritems(columns_stats):
+        for group_index, value in six.moves.zip(present.tolist(), stat_values.tolist()):
+            stats[group_index][stat] = value
+
+    return stats
+
+
+def _aggregate_numpy(columns, by, percentiles):
+
+    keys = numpy.array([six.text_type(value) for value in columns[by]])
+    groups, inverse = numpy.unique(keys, return_inverse=True)
+    groups = [six.text_type(group) for group in groups]
+    sessions = numpy.bincount(inverse, minlength=len(groups))
+    up = numpy.bincount(inverse, weights=numpy.array(columns['up'], dtype=float), minlength=len(groups))
+
+    aggregates = {}
+    for index, group in enumerate(groups):
+        aggregates[group] = {
+            'sessions': int(sessions[index]),
+            'up': int(up[index]),
+            'down': int(sessions[index] - up[index])
+        }
+
+    for column in _STATS_COLUMNS:
+        values = numpy.array(columns[column], dtype=float)
+        column_stats = _column_stats_numpy(values, inverse, len(groups), percentiles)
+        for index, group in enumerate(groups):
+            aggregates[group][column] = column_stats[index]
+
+    return aggregates
+
+
+def _aggregate_python(columns, by, percentiles):
+
+    grouped = {}
+    for row_index, key in enumerate(columns[by]):
+        grouped.setdefault(six.text_type(key), []).append(row_index)
+
+    aggregates = {}
+    for group, rows in six.iteritems(grouped):
+        up = len([row_index for row_index in rows if columns['up'][row_index]])
+        aggregates[group] = {
+            'sessions': len(rows),
+            'up': up,
+            'down': len(rows) - up
+        }
+        for column in _STATS_COLUMNS:
+            sorted_values = sorted([columns[column][row_index] for row_index in rows
+                                    if columns[column][row_index] >= 0])
+            aggregates[group][column] = _column_stats(sorted_values, percentiles)
+
+    return aggregates
+
+# ----------------------------------------------------------------------------------------------------------------------
+# callable functions
+# ----------------------------------------------------------------------------------------------------------------------
+
+
+def aggregate(by='remote_as', tgt='*', expr_form='glob', percentiles='50,90,99', timeout=60):
+
+    """
+    Returns the number of BGP sessions, up and down, and the distribution of the received and accepted prefixes
+    and of the uptime, grouped by one of the columns.
+
+    :param by: the column to group by: device, vrf, neighbor, local_as, remote_as, type, up, state
+    :param tgt: target expression, by default all the devices
+    :param expr_form: target type
+    :param percentiles: comma separated list of the percentiles of the prefix counts and of the uptime
+    :param timeout: maximum number of seconds to wait for the devices to reply
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt-run bgp.aggregate by=remote_as
+        salt-run bgp.aggregate by=type percentiles=50,95
+
+    Output Example:
+
+    .. code-block:: python
+
+        {
+            'groups': {
+                '8121': {
+                    'sessions': 24,
+                    'up': 23,
+                    'down': 1,
+                    'received_prefixes': {
+                        'sum': 12994581,
+                        'min': 0,
+                        'max': 566739,
+                        'p50': 566712,
+                        'p90': 566739,
+                        'p99': 566739
+                    },
+                    'accepted_prefixes': {
+                        ...
+                    },
+                    'uptime': {
+                        ...
+                    }
+                }
+            },
+            'sessions': 1382,
+            'failed': []
+        }
+    """
+
+    if by not in _COLUMNS:
+        return {
+            'result': False,
+            'comment': 'Cannot group by {by}. Choose between: {columns}'.format(by=by, columns=', '.join(_COLUMNS))
+        }
+
+    columns, failed = _collect(tgt, expr_form, timeout)
+    percentiles = _percentiles_list(percentiles)
+
+    if not columns['device']:
+        groups = {}
+    elif HAS_NUMPY:
+        groups = _aggregate_numpy(columns, by, percentiles)
+    else:
+        groups = _aggregate_python(columns, by, percentiles)
+
+    return {
+        'groups': groups,
+        'sessions': len(columns['device']),
+        'failed': failed
+    }
+
+
+def export(path, fmt='csv', tgt='*', expr_form='glob', timeout=60):
+
+    """
+    Collects the BGP sessions and exports them to a file, one row per session.
+
+    :param path: absolute path of the file, on the master
+    :param fmt: csv or parquet. Parquet requires pandas and pyarrow.
+    :param tgt: target expression, by default all the devices
+    :param expr_form: target type
+    :param timeout: maximum number of seconds to wait for the devices to reply
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt-run bgp.export /tmp/bgp.csv
+        salt-run bgp.export /tmp/bgp.parquet fmt=parquet tgt='edge*'
+    """
+
+    if fmt not in ('csv', 'parquet'):
+        return {
+            'result': False,
+            'comment': 'Unknown format: {fmt}. Choose between: csv, parquet'.format(fmt=fmt)
+        }
+
+    if fmt == 'parquet' and not HAS_PARQUET:
+        return {
+            'result': False,
+            'comment': 'Please install pandas and pyarrow to export as Parquet.'
+        }
+
+    columns, failed = _collect(tgt, expr_form, timeout)
+
+    if fmt == 'parquet':
+        pandas.DataFrame(columns, columns=_COLUMNS).to_parquet(path, index=False)
+    else:
+        with open(path, 'w') as export_file:
+            writer = csv.writer(export_file)
+            writer.writerow(_COLUMNS)
+            writer.writerows(six.moves.zip(*[columns[column] for column in _COLUMNS]))
+
+    return {
+        'result': True,
+        'comment': '{sessions} sessions exported to {path}'.format(sessions=len(columns['device']), path=path),
+        'failed': failed
+    }
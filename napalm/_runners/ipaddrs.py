@@ -0,0 +1,452 @@
+"""
+Maintains an index of the IP addresses and prefixes configured on the network devices managed through the NAPALM proxy,
+to answer questions such as "which device owns 10.1.2.3?" without querying the fleet.
+
+The index is persisted in the master cachedir and refreshed incrementally: `ipaddrs.update` asks the devices only
+for the addresses changed since the previous run (see the `since` argument of `net.ipaddrs`).
+
+The prefixes are indexed by IP version, prefix length and network address, therefore the longest prefix match
+is at most one dictionary lookup per prefix length configured. Only the entries of the devices whose addresses
+changed are updated.
+
+CLI Example:
+
+.. code-block:: bash
+
+    salt-run ipaddrs.update
+    salt-run ipaddrs.exact 10.1.2.3
+    salt-run ipaddrs.lookup 10.1.2.200
+    salt-run ipaddrs.contains 10.1.0.0/16
+"""
+from __future__ import absolute_import
+
+# Import stdlib
+import os
+import json
+import time
+import socket
+import logging
+import binascii
+log = logging.getLogger(__name__)
+
+# Import salt modules
+import salt.client
+from salt.ext import six
+
+# ----------------------------------------------------------------------------------------------------------------------
+# globals
+# ----------------------------------------------------------------------------------------------------------------------
+
+_INDEX_FILENAME = 'napalm_ipaddrs_index.json'
+
+_INDEX_VERSION = 2
+# the index stored by a previous version is rebuilt from the addresses of the devices
+
+_INDEX_CACHE = {
+    'mtime': None,
+    'index': None
+}
+# the index last read or written, reused while the file did not change
+
+_FAMILIES = {
+    'ipv4': (4, socket.AF_INET, 32),
+    'ipv6': (6, socket.AF_INET6, 128)
+}
+
+# ----------------------------------------------------------------------------------------------------------------------
+# helper functions -- will not be exported
+# ----------------------------------------------------------------------------------------------------------------------
+
+
+def _get_client():
+
+    return salt.client.LocalClient(__opts__['conf_file'])
+
+
+def _get_index_path():
+
+    return os.path.join(__opts__['cachedir'], _INDEX_FILENAME)
+
+
+def _empty_index():
+
+    return {
+        'version': _INDEX_VERSION,
+        'devices': {},
+        'addresses': {},
+        'prefixes': {},
+        'updated': 0
+    }
+
+
+def _load_index():
+
+    '''
+    Reads the index, only when the file changed since it was last read or written.
+    '''
+
+    index_path = _get_index_path()
+    if not os.path.isfile(index_path):
+        return _empty_index()
+
+    mtime = os.path.getmtime(index_path)
+    if mtime == _INDEX_CACHE['mtime']:
+        return _INDEX_CACHE['index']
+
+    try:
+        with open(index_path, 'r') as index_file:
+            index = json.load(index_file)
+    except (IOError, ValueError) as error:
+        log.error('Cannot read the IP addresses index from {path}: {error}'.format(
+            path=index_path,
+            error=error
+        ))
+        return _empty_index()
+
+    if index.get('version') != _INDEX_VERSION:
+        _build_index(index)
+
+    _INDEX_CACHE.update({
+        'mtime': mtime,
+        'index': index
+    })
+
+    return index
+
+
+def _save_index(index):
+
+    index_path = _get_index_path()
+    tmp_path = '{path}.tmp'.format(path=index_path)
+    with open(tmp_path, 'w') as index_file:
+        json.dump(index, index_file)
+    os.rename(tmp_path, index_path)
+
+    _INDEX_CACHE.update({
+        'mtime': os.path.getmtime(index_path),
+        'index': index
+    })
+
+
+def _parse_address(address):
+
+    '''
+    Returns the IP version, the number of bits and the integer value of an address.
+    '''
+
+    address = address.split('%')[0]  # IPv6 zone
+    for family in ('ipv4', 'ipv6'):
+        version, af_family, bits = _FAMILIES[family]
+        try:
+            packed = socket.inet_pton(af_family, address)
+        except (socket.error, ValueError):
+            continue
+        return version, bits, int(binascii.hexlify(packed), 16)
+
+    raise ValueError('Invalid IP address: {address}'.format(address=address))
+
+
+def _parse_prefix(prefix):
+
+    address, _, prefix_length = prefix.partition('/')
+    version, bits, value = _parse_address(address)
+    prefix_length = int(prefix_length) if prefix_length else bits
+
+    return version, bits, prefix_length, value >> (bits - prefix_length)
+
+
+def _apply_delta(addresses, delta):
+
+    '''
+    Applies the delta returned by `net.ipaddrs` on the addresses known from the previous run.
+    '''
+
+    for interface, families in six.iteritems(delta.get('removed', {})):
+        for family, family_addresses in six.iteritems(families):
+            for address in family_addresses:
+                addresses.get(interface, {}).get(family, {}).pop(address, None)
+            if not addresses.get(interface, {}).get(family, True):
+                addresses[interface].pop(family)
+        if not addresses.get(interface, True):
+            addresses.pop(interface)
+
+    for delta_type in ('added', 'changed'):
+        for interface, families in six.iteritems(delta.get(delta_type, {})):
+            for family, family_addresses in six.iteritems(families):
+                addresses.setdefault(interface, {}).setdefault(family, {}).update(family_addresses)
+
+    return addresses
+
+
+def _device_entries(device, addresses):
+
+    '''
+    Yields the entries of the addresses of a device: the key in the table of the addresses,
+    the IP version, prefix length and network of the prefix, and the owner.
+    '''
+
+    for interface, families in six.iteritems(addresses or {}):
+        for family, family_addresses in six.iteritems(families):
+            if family not in _FAMILIES:
+                continue
+            for address, address_details in six.iteritems(family_addresses):
+                try:
+                    version, bits, value = _parse_address(address)
+                except ValueError:
+                    continue
+                prefix_length = address_details.get('prefix_length')
+                if not isinstance(prefix_length, int):
+                    prefix_length = bits  # e.g.: N/A for link local
+                yield (
+                    '{version}/{value}'.format(version=version, value=value),
+                    (str(version), str(prefix_length), str(value >> (bits - prefix_length))),
+                    [device, interface, address, prefix_length]
+                )
+
+
+def _remove_owners(table, key, device):
+
+    owners = [owner for owner in table.get(key, []) if owner[0] != device]
+    if owners:
+        table[key] = owners
+    else:
+        table.pop(key, None)
+
+
+def _index_device(index, device, addresses, remove=False):
+
+    '''
+    Adds the entries of the addresses of a device to the lookup tables, or removes them.
+    '''
+
+    exact_table = index['addresses']
+    prefixes = index['prefixes']
+
+    for address_key, (version, prefix_length, network), owner in _device_entries(device, addresses):
+        if not remove:
+            exact_table.setdefault(address_key, []).append(owner[:3])
+            prefixes.setdefault(version, {}).setdefault(prefix_length, {}).setdefault(network, []).append(owner)
+            continue
+        _remove_owners(exact_table, address_key, device)
+        length_table = prefixes.get(version, {}).get(prefix_length, {})
+        _remove_owners(length_table, network, device)
+        if not length_table:
+            prefixes.get(version, {}).pop(prefix_length, None)
+        if not prefixes.get(version, True):
+            prefixes.pop(version)
+
+    return index
+
+
+def _build_index(index):
+
+    '''
+    Rebuilds the lookup tables from the addresses of each device.
+    The prefixes are stored by IP version, then prefix length, then network address.
+    '''
+
+    index.update({
+        'version': _INDEX_VERSION,
+        'addresses': {},
+        'prefixes': {}
+    })
+
+    for device, device_details in six.iteritems(index.get('devices', {})):
+        _index_device(index, device, device_details.get('addresses', {}))
+
+    return index
+
+
+def _prefixes_count(index):
+
+    return sum([
+        len(networks)
+        for length_tables in six.itervalues(index.get('prefixes', {}))
+        for networks in six.itervalues(length_tables)
+    ])
+
+
+def _owners(owners):
+
+    return [
+        dict(zip(('device', 'interface', 'address', 'prefix_length'), owner))
+        for owner in owners
+    ]
+
+# ----------------------------------------------------------------------------------------------------------------------
+# callable functions
+# ----------------------------------------------------------------------------------------------------------------------
+
+
+def update(tgt='*', expr_form='glob', full=False, timeout=60):
+
+    '''
+    Refreshes the index: the devices return only the addresses changed since the previous run.
+
+    :param tgt: target expression, by default all the devices
+    :param expr_form: target type
+    :param full: retrieve all the addresses, ignoring the tokens of the previous run
+    :param timeout: maximum number of seconds to wait for the devices to reply
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt-run ipaddrs.update
+        salt-run ipaddrs.update tgt='edge*' full=True
+    '''
+
+    _client = _get_client()
+    index = _load_index()
+    devices = index.setdefault('devices', {})
+
+    since = {}
+    if not full:
+        since = dict(
+            (device, device_details.get('token'))
+            for device, device_details in six.iteritems(devices)
+        )
+
+    ipaddrs_output = _client.cmd(tgt, 'net.ipaddrs', kwarg={'since': since}, expr_form=expr_form, timeout=timeout)
+
+    updated = []
+    unchanged = []
+    failed = []
+
+    for device, device_ipaddrs in six.iteritems(ipaddrs_output):
+        if not isinstance(device_ipaddrs, dict) or not device_ipaddrs.get('result', False):
+            failed.append(device)
+            continue
+        device_details = devices.setdefault(device, {})
+        if device_ipaddrs.get('token') == device_details.get('token'):
+            unchanged.append(device)
+            continue
+        _index_device(index, device, device_details.get('addresses', {}), remove=True)
+        if device_ipaddrs.get('delta', False):
+            _apply_delta(device_details.setdefault('addresses', {}), device_ipaddrs.get('out', {}))
+        else:
+            device_details['addresses'] = device_ipaddrs.get('out', {})
+        _index_device(index, device, device_details['addresses'])
+        device_details.update({
+            'token': device_ipaddrs.get('token'),
+            'updated': time.time()
+        })
+        updated.append(device)
+
+    index['updated'] = time.time()
+    _save_index(index)
+
+    return {
+        'updated': sorted(updated),
+        'unchanged': len(unchanged),
+        'failed': sorted(failed),
+        'addresses': len(index.get('addresses', {})),
+        'prefixes': _prefixes_count(index)
+    }
+
+
+def exact(address):
+
+    '''
+    Returns the devices and the interfaces having this IP address configured.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt-run ipaddrs.exact 10.1.2.3
+
+    Output Example:
+
+    .. code-block:: python
+
+        [
+            {
+                'device': 'edge01.bjm01',
+                'interface': 'xe-0/0/1.100',
+                'address': '10.1.2.3'
+            }
+        ]
+    '''
+
+    index = _load_index()
+    version, _, value = _parse_address(address)
+
+    return _owners(index.get('addresses', {}).get('{version}/{value}'.format(version=version, value=value), []))
+
+
+def lookup(address):
+
+    '''
+    Longest prefix match: returns the most specific prefix configured on the devices, covering this address,
+    and the devices and interfaces having it configured.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt-run ipaddrs.lookup 10.1.2.200
+
+    Output Example:
+
+    .. code-block:: python
+
+        {
+            'prefix_length': 24,
+            'owners': [
+                {
+                    'device': 'edge01.bjm01',
+                    'interface': 'xe-0/0/1.100',
+                    'address': '10.1.2.1',
+                    'prefix_length': 24
+                }
+            ]
+        }
+    '''
+
+    index = _load_index()
+    version, bits, value = _parse_address(address)
+    length_tables = index.get('prefixes', {}).get(str(version), {})
+
+    for prefix_length in sorted([int(length) for length in length_tables], reverse=True):
+        owners = length_tables[str(prefix_length)].get(str(value >> (bits - prefix_length)))
+        if owners:
+            return {
+                'prefix_length': prefix_length,
+                'owners': _owners(owners)
+            }
+
+    return {}
+
+
+def contains(prefix):
+
+    '''
+    Returns the addresses configured on the devices, within this prefix.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt-run ipaddrs.contains 10.1.0.0/16
+    '''
+
+    index = _load_index()
+    version, bits, prefix_length, network = _parse_prefix(prefix)
+
+    contained = []
+    for length, networks in six.iteritems(index.get('prefixes', {}).get(str(version), {})):
+        length = int(length)
+        if length <= prefix_length:
+            # at most one subnet covering the prefix, only some of its addresses may be within
+            for owner in networks.get(str(network >> (prefix_length - length)), []):
+                _, _, address_value = _parse_address(owner[2])
+                if address_value >> (bits - prefix_length) == network:
+                    contained.append(owner[:3])
+            continue
+        # the subnets within the prefix: all their addresses are within
+        for subnet, owners in six.iteritems(networks):
+            if int(subnet) >> (length - prefix_length) == network:
+                contained.extend([owner[:3] for owner in owners])
+
+    return _owners(contained)
@@ -0,0 +1,476 @@
+"""
+Builds and queries the physical topology of the network, using the LLDP neighbors details
+retrieved from the devices managed through the NAPALM proxy.
+
+The topology graph is persisted in the master cachedir. On every `lldp.update`, the devices
+are asked for their LLDP neighbors only when the fingerprint changed since the previous run,
+therefore only the devices having a different view of the topology will return data.
+
+CLI Example:
+
+.. code-block:: bash
+
+    salt-run lldp.update
+    salt-run lldp.neighbors edge01.bjm01
+    salt-run lldp.path edge01.bjm01 edge01.sjc01
+    salt-run lldp.links edge01.bjm01
+"""
+from __future__ import absolute_import
+
+# Import stdlib
+import os
+import json
+import time
+import logging
+log = logging.getLogger(__name__)
+
+from collections import deque
+
+# Import salt modules
+import salt.client
+import salt.utils.minions
+from salt.ext import six
+
+# ----------------------------------------------------------------------------------------------------------------------
+# globals
+# ----------------------------------------------------------------------------------------------------------------------
+
+_TOPOLOGY_FILENAME = 'napalm_lldp_topology.json'
+
+# ----------------------------------------------------------------------------------------------------------------------
+# helper functions -- will not be exported
+# ----------------------------------------------------------------------------------------------------------------------
+
+
+def _get_client():
+
+    return salt.client.LocalClient(__opts__['conf_file'])
+
+
+def _target_minions(tgt, expr_form):
+
+    '''
+    Resolves the target expression on the master, without executing a job.
+    '''
+
+    minions = salt.utils.minions.CkMinions(__opts__).check_minions(tgt, expr_form)
+    if isinstance(minions, dict):
+        minions = minions.get('minions', [])
+
+    return sorted(minions)
+
+
+def _get_topology_path():
+
+    return os.path.join(__opts__['cachedir'], _TOPOLOGY_FILENAME)
+
+
+def _empty_topology():
+
+    return {
+        'devices': {},
+        'nodes': {},
+        'names': {},
+        'adjacency': {},
+        'links': 0,
+        'updated': 0
+    }
+
+
+def _load_topology():
+
+    '''
+    Reads the topology stored after the previous run.
+    '''
+
+    topology_path = _get_topology_path()
+    if not os.path.isfile(topology_path):
+        return _empty_topology()
+
+    try:
+        with open(topology_path, 'r') as topology_file:
+            return json.load(topology_file)
+    except (IOError, ValueError) as error:
+        log.error('Cannot read the LLDP topology from {path}: {error}'.format(
+            path=topology_path,
+            error=error
+        ))
+
+    return _empty_topology()
+
+
+def _save_topology(topology):
+
+    topology_path = _get_topology_path()
+    tmp_path = '{path}.tmp'.format(path=topology_path)
+    with open(tmp_path, 'w') as topology_file:
+        json.dump(topology, topology_file)
+    os.rename(tmp_path, topology_path)  # atomic, the queries will never read a partial file
+
+
+def _normalize_name(name):
+
+    return (name or '').strip().lower()
+
+
+def _compact_neighbors(lldp_neighbors):
+
+    '''
+    Keeps only the details needed to build the graph.
+    '''
+
+    compact = {}
+
+    for interface, neighbors in six.iteritems(lldp_neighbors or {}):
+        compact[interface] = [
+            {
+                'chassis': neighbor.get('remote_chassis_id', ''),
+                'name': neighbor.get('remote_system_name', ''),
+                'port': neighbor.get('remote_port', '')
+            }
+            for neighbor in (neighbors or [])
+        ]
+
+    return compact
+
+
+def _build_graph(topology):
+
+    '''
+    Rebuilds the adjacency of the graph from the neighbors reported by each device.
+    The nodes are keyed by the LLDP chassis ID: the chassis ID of a managed device is learned
+    from the neighbors advertising a system name matching the minion ID.
+    '''
+
+    devices = topology.get('devices', {})
+
+    short_names = {}
+    for device in devices.keys():
+        short_name = _normalize_name(device).split('.')[0]
+        short_names[short_name] = short_names.get(short_name, 0) + 1
+
+    chassis_by_name = {}
+    for device_details in six.itervalues(devices):
+        for neighbors in six.itervalues(device_details.get('neighbors', {})):
+            for neighbor in neighbors:
+                if not (neighbor.get('name') and neighbor.get('chassis')):
+                    continue
+                name = _normalize_name(neighbor['name'])
+                chassis_by_name[name] = neighbor['chassis']
+                if short_names.get(name.split('.')[0]) == 1:
+                    # some devices advertise only the hostname, without the domain
+                    # but the hostname is not enough when two devices share it
+                    chassis_by_name.setdefault(name.split('.')[0], neighbor['chassis'])
+
+    nodes = {}
+    for device in devices.keys():
+        name = _normalize_name(device)
+        short_name = name.split('.')[0]
+        nodes[device] = chassis_by_name.get(name)
+        if not nodes[device] and short_names.get(short_name) == 1:
+            nodes[device] = chassis_by_name.get(short_name)
+        nodes[device] = nodes[device] or device
+
+    adjacency = {}
+    links = set()
+
+    for device, device_details in six.iteritems(devices):
+        local_node = nodes[device]
+        for interface, neighbors in six.iteritems(device_details.get('neighbors', {})):
+            for neighbor in neighbors:
+                remote_node = neighbor.get('chassis') or neighbor.get('name')
+                if not remote_node:
+                    continue
+                remote_port = neighbor.get('port', '')
+                # when both ends are managed devices, each of them reports the link
+                adjacency.setdefault(local_node, {}).setdefault(interface, set()).add((remote_node, remote_port))
+                adjacency.setdefault(remote_node, {}).setdefault(remote_port, set()).add((local_node, interface))
+                links.add(tuple(sorted([(local_node, interface), (remote_node, remote_port)])))
+
+    for node_adjacency in six.itervalues(adjacency):
+        for interface, remote_ends in six.iteritems(node_adjacency):
+            node_adjacency[interface] = [list(remote_end) for remote_end in sorted(remote_ends)]
+
+    topology.update({
+        'nodes': nodes,
+        'names': dict((node, device) for device, node in six.iteritems(nodes)),
+        'adjacency': adjacency,
+        'links': len(links)
+    })
+
+    return topology
+
+
+def _node(topology, device):
+
+    '''
+    Returns the graph node of a device: either its minion ID, either a chassis ID.
+    '''
+
+    return topology.get('nodes', {}).get(device, device)
+
+
+def _node_name(topology, node):
+
+    '''
+    Returns the minion ID when the node is a managed device.
+    '''
+
+    return topology.get('names', {}).get(node, node)
+
+# ----------------------------------------------------------------------------------------------------------------------
+# callable functions
+# ----------------------------------------------------------------------------------------------------------------------
+
+
+def _collect(minions, since, timeout):
+
+    '''
+    Retrieves the LLDP neighbors from the minions.
+    The minions without a fingerprint from the previous run are addressed in a single job,
+    while each of the others receives only its own fingerprint.
+    '''
+
+    _client = _get_client()
+
+    jobs = []
+    new_minions = [minion for minion in minions if not since.get(minion)]
+    if new_minions:
+        jobs.append(_client.run_job(new_minions, 'net.lldp', expr_form='list', timeout=timeout))
+    for minion in minions:
+        if not since.get(minion):
+            continue
+        jobs.append(_client.run_job([minion], 'net.lldp', expr_form='list', timeout=timeout,
+                                    kwarg={'since': since[minion]}))
+
+    lldp_output = {}
+    deadline = time.time() + timeout
+
+    # all jobs are already published, the devices are executing them in parallel
+    for job in jobs:
+        if not job or not job.get('minions'):
+            continue
+        for ret in _client.get_cli_returns(job['jid'], job['minions'],
+                                           timeout=max(deadline - time.time(), 1)):
+            for minion, minion_ret in six.iteritems(ret or {}):
+                lldp_output[minion] = minion_ret.get('ret')
+
+    return lldp_output
+
+
+def update(tgt='*', expr_form='glob', full=False, timeout=60):
+
+    '''
+    Collects the LLDP neighbors from the devices and updates the stored topology.
+    Only the devices whose LLDP neighbors changed since the previous run will return their neighbors.
+    The targeted devices not replying anymore are removed from the topology.
+
+    :param tgt: target expression, by default all the devices
+    :param expr_form: target type
+    :param full: retrieve the neighbors from all targeted devices, ignoring the stored fingerprints
+    :param timeout: maximum number of seconds to wait for the devices to reply
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt-run lldp.update
+        salt-run lldp.update tgt='edge*' full=True
+    '''
+
+    topology = _load_topology()
+    devices = topology.setdefault('devices', {})
+
+    since = {}
+    if not full:
+        since = dict(
+            (device, device_details.get('fingerprint'))
+            for device, device_details in six.iteritems(devices)
+        )
+
+    minions = _target_minions(tgt, expr_form)
+    lldp_output = _collect(minions, since, timeout)
+
+    updated = []
+    unchanged = []
+    failed = []
+    removed = [device for device in minions if device not in lldp_output and device in devices]
+
+    for device, device_lldp in six.iteritems(lldp_output):
+        if not isinstance(device_lldp, dict) or not device_lldp.get('result', False):
+            failed.append(device)
+            continue  # keep the neighbors known from the previous run
+        if device_lldp.get('unchanged', False):
+            unchanged.append(device)
+            continue
+        devices[device] = {
+            'fingerprint': device_lldp.get('fingerprint'),
+            'updated': time.time(),
+            'neighbors': _compact_neighbors(device_lldp.get('out', {}))
+        }
+        updated.append(device)
+
+    for device in removed:
+        devices.pop(device)
+
+    if updated or removed or not topology.get('adjacency'):
+        _build_graph(topology)
+    topology['updated'] = time.time()
+    _save_topology(topology)
+
+    return {
+        'updated': sorted(updated),
+        'unchanged': len(unchanged),
+        'failed': sorted(failed),
+        'removed': removed,
+        'nodes': len(topology.get('adjacency', {})),
+        'links': topology.get('links', 0)
+    }
+
+
+def neighbors(device, interface=None):
+
+    '''
+    Returns the neighbors of a device, from the stored topology.
+
+    :param device: minion ID or LLDP chassis ID
+    :param interface: return only the neighbors on this interface
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt-run lldp.neighbors edge01.bjm01
+        salt-run lldp.neighbors edge01.bjm01 interface=xe-0/0/1
+
+    Output Example:
+
+    .. code-block:: python
+
+        {
+            'xe-0/0/1': [
+                {
+                    'node': 'edge01.sjc01',
+                    'port': 'xe-1/0/3'
+                }
+            ]
+        }
+    '''
+
+    topology = _load_topology()
+    node_adjacency = topology.get('adjacency', {}).get(_node(topology, device), {})
+
+    if interface:
+        node_adjacency = {interface: node_adjacency.get(interface, [])}
+
+    return dict(
+        (local_interface, [
+            {
+                'node': _node_name(topology, remote_node),
+                'port': remote_port
+            }
+            for remote_node, remote_port in remote_ends
+        ])
+        for local_interface, remote_ends in six.iteritems(node_adjacency)
+    )
+
+
+def links(device=None):
+
+    '''
+    Returns the number of links: the total in the topology, or the links of a certain device.
+
+    :param device: minion ID or LLDP chassis ID
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt-run lldp.links
+        salt-run lldp.links edge01.bjm01
+    '''
+
+    topology = _load_topology()
+
+    if not device:
+        return topology.get('links', 0)
+
+    node_adjacency = topology.get('adjacency', {}).get(_node(topology, device), {})
+
+    return sum([len(remote_ends) for remote_ends in six.itervalues(node_adjacency)])
+
+
+def path(source, destination):
+
+    '''
+    Returns the shortest path between two devices, from the stored topology.
+    Each hop is described by the node and the interfaces on both ends of the link.
+
+    :param source: minion ID or LLDP chassis ID
+    :param destination: minion ID or LLDP chassis ID
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt-run lldp.path edge01.bjm01 edge01.sjc01
+
+    Output Example:
+
+    .. code-block:: python
+
+        [
+            {
+                'node': 'edge01.bjm01',
+                'interface': 'xe-0/0/1',
+                'next': 'core01.bjm01',
+                'next_interface': 'Ethernet1/1'
+            },
+            {
+                'node': 'core01.bjm01',
+                'interface': 'Ethernet2/1',
+                'next': 'edge01.sjc01',
+                'next_interface': 'xe-1/0/3'
+            }
+        ]
+    '''
+
+    topology = _load_topology()
+    adjacency = topology.get('adjacency', {})
+
+    source_node = _node(topology, source)
+    destination_node = _node(topology, destination)
+
+    if source_node not in adjacency or destination_node not in adjacency:
+        return []
+
+    previous = {source_node: None}
+    queue = deque([source_node])
+
+    while queue:
+        node = queue.popleft()
+        if node == destination_node:
+            break
+        for interface, remote_ends in six.iteritems(adjacency.get(node, {})):
+            for remote_node, remote_port in remote_ends:
+                if remote_node in previous:
+                    continue
+                previous[remote_node] = (node, interface, remote_port)
+                queue.append(remote_node)
+
+    if destination_node not in previous:
+        return []
+
+    hops = []
+    node = destination_node
+    while previous[node] is not None:
+        previous_node, interface, remote_port = previous[node]
+        hops.append({
+            'node': _node_name(topology, previous_node),
+            'interface': interface,
+            'next': _node_name(topology, node),
+            'next_interface': remote_port
+        })
+        node = previous_node
+
+    return list(reversed(hops))
@@ -2,13 +2,19 @@
 """
 # Import stdlib
 import os
+import json
+import time
 import yaml
+import hashlib
+import logging
+log = logging.getLogger(__name__)
 
 from copy import deepcopy
 
 # Import salt modules
 import salt.client
 import salt.runner
+import salt.utils.minions
 from salt.ext import six
 
 # ----------------------------------------------------------------------------------------------------------------------
@@ -22,6 +28,11 @@ _SERVERS = [
     '40.118.103.7'  # time.windows.com
 ]
 
+_DIFF_CACHE_FILENAME = 'napalm_ntp_diff.json'
+
+_MINE_MAX_AGE = 900
+# seconds after which the NTP summary of a device in the mine is outdated, three times the refresh of ntp.monitor
+
 # ----------------------------------------------------------------------------------------------------------------------
 # module properties
 # ----------------------------------------------------------------------------------------------------------------------
@@ -53,81 +64,294 @@ def _get_rclient():
     return _rclient
 
 
+def _target_minions(tgt, expr_form):
+
+    '''
+    Resolves the target expression on the master, without executing a job.
+    '''
+
+    minions = salt.utils.minions.CkMinions(__opts__).check_minions(tgt, expr_form)
+    if isinstance(minions, dict):
+        minions = minions.get('minions', [])
+
+    return sorted(minions)
+
+
+def _progress(message, **data):
+
+    '''
+    Streams the progress of the diff on the event bus.
+    '''
+
+    data['message'] = message
+    log.info(message)
+    try:
+        __jid_event__.fire_event(data, 'progress')
+    except NameError:
+        pass  # not executed through the runner client
+
+
+def _get_diff_cache_path():
+
+    return os.path.join(__opts__['cachedir'], _DIFF_CACHE_FILENAME)
+
+
+def _load_diff_cache():
+
+    diff_cache_path = _get_diff_cache_path()
+    if not os.path.isfile(diff_cache_path):
+        return {}
+
+    try:
+        with open(diff_cache_path, 'r') as diff_cache_file:
+            return json.load(diff_cache_file)
+    except (IOError, ValueError):
+        return {}
+
+
+def _save_diff_cache(devices_cache):
+
+    diff_cache_path = _get_diff_cache_path()
+    tmp_path = '{path}.tmp'.format(path=diff_cache_path)
+    with open(tmp_path, 'w') as diff_cache_file:
+        json.dump(devices_cache, diff_cache_file)
+    os.rename(tmp_path, diff_cache_path)
+
+
+def _device_changes(device_states_run):
+
+    '''
+    Extracts the NTP peers and servers to be added and removed, from the result of the state run on a device.
+    '''
+
+    device_changes = {
+        'add': {},
+        'remove': {}
+    }
+
+    for state_run, state_result in six.iteritems(device_states_run):
+        if not isinstance(state_result, dict) or state_result.get('result') is False:
+            continue
+        state_changes = state_result.get('changes', {})
+        for entity in ('peers', 'servers'):
+            entity_change = state_changes.get(entity, {})
+            if entity_change.get('added'):
+                device_changes['add'][entity] = entity_change['added']
+            if entity_change.get('removed'):
+                device_changes['remove'][entity] = entity_change['removed']
+
+    return device_changes
+
+
+def _file_hash(filepath):
+
+    if not os.path.isfile(filepath):
+        return None
+
+    with open(filepath, 'rb') as existing_file:
+        return hashlib.md5(existing_file.read()).hexdigest()
+
+
+def _write_if_changed(filepath, content):
+
+    '''
+    Writes the file only when the content differs from the file on disk, replacing it atomically.
+    Returns True when the file was written.
+    '''
+
+    content = content.encode('utf-8') if isinstance(content, six.text_type) else content
+    if _file_hash(filepath) == hashlib.md5(content).hexdigest():
+        return False
+
+    tmp_path = '{path}.tmp'.format(path=filepath)
+    with open(tmp_path, 'wb') as tmp_file:
+        tmp_file.write(content)
+    os.rename(tmp_path, filepath)
+
+    return True
+
+
+def _merge_device_changes(_ntp_diff, device, device_changes):
+
+    for action, action_changes in six.iteritems(device_changes):
+        for entity, entities in six.iteritems(action_changes):
+            _ntp_diff[action].setdefault(entity, {})[device] = entities
+
+
 # ----------------------------------------------------------------------------------------------------------------------
 # callable functions
 # ----------------------------------------------------------------------------------------------------------------------
 
 
-def diff():
+def diff(tgt='*', expr_form='glob', batch_size=0, cache_window=0, timeout=60):
+
+    """
+    Returns the differences between the expected device config and the actual config.
+
+    The results are aggregated as the devices return, and reported as progress events,
+    together with the devices failing or not replying within `timeout`.
+    The changes found on each device are cached on the master: a device tested less than `cache_window` seconds ago
+    is not tested again, its cached changes are used instead.
 
-    """Returns the differences between the expected device config and the actual config."""
+    :param tgt: target expression, by default all the devices
+    :param expr_form: target type
+    :param batch_size: maximum number of devices tested at the same time. Default: all of them.
+    :param cache_window: number of seconds a device is not tested again. Default: 0, always test.
+    :param timeout: maximum number of seconds to wait for a device to reply
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt-run ntp.diff
+        salt-run ntp.diff tgt='edge*' batch_size=50 cache_window=3600
+    """
 
     _client = _get_client()
 
-    ntp_state_result = _client.cmd('*', 'state.sls', ['router.ntp', 'test=True'], expr_form='glob', timeout=60)
+    devices_cache = _load_diff_cache()
+    now = time.time()
+
+    devices = _target_minions(tgt, expr_form)
+    cached_devices = [
+        device for device in devices
+        if cache_window and now - devices_cache.get(device, {}).get('timestamp', 0) < float(cache_window)
+    ]
+    tested_devices = [device for device in devices if device not in cached_devices]
 
     _ntp_diff = {
         'add': {},
         'remove': {}
     }
 
-    for device, device_states_run in six.iteritems(ntp_state_result):
-        for state_run, state_result in six.iteritems(device_states_run):
-            if state_result.get('result') is False:
+    for device in cached_devices:
+        _merge_device_changes(_ntp_diff, device, devices_cache[device]['changes'])
+
+    _progress('Testing {tested} devices, {cached} from cache'.format(
+        tested=len(tested_devices),
+        cached=len(cached_devices)
+    ))
+
+    batch_size = int(batch_size) or len(tested_devices) or 1
+    done = 0
+
+    for index in range(0, len(tested_devices), batch_size):
+        batch = tested_devices[index:index + batch_size]
+        replied = set()
+        for device_return in _client.cmd_iter(batch,
+                                              'state.sls',
+                                              ['router.ntp', 'test=True'],
+                                              expr_form='list',
+                                              timeout=timeout):
+            for device, device_output in six.iteritems(device_return):
+                done += 1
+                replied.add(device)
+                device_states_run = device_output.get('ret', {})
+                if not isinstance(device_states_run, dict):
+                    _progress('{device}: failed ({done}/{total})'.format(
+                        device=device,
+                        done=done,
+                        total=len(tested_devices)
+                    ), device=device, result=False)
+                    continue
+                device_changes = _device_changes(device_states_run)
+                devices_cache[device] = {
+                    'timestamp': time.time(),
+                    'changes': device_changes
+                }
+                _merge_device_changes(_ntp_diff, device, device_changes)
+                _progress('{device}: tested ({done}/{total})'.format(
+                    device=device,
+                    done=done,
+                    total=len(tested_devices)
+                ), device=device, result=True, changes=device_changes)
+        for device in batch:
+            if device in replied:
                 continue
+            done += 1
+            _progress('{device}: no response in {timeout} seconds ({done}/{total})'.format(
+                device=device,
+                timeout=timeout,
+                done=done,
+                total=len(tested_devices)
+            ), device=device, result=False, comment='No response in {0} seconds'.format(timeout))
 
-            state_changes = state_result.get('changes', {})
-            peers_change = state_changes.get('peers', {})
-            servers_change = state_changes.get('servers', {})
-
-            add_peers = peers_change.get('added', [])
-            remove_peers = peers_change.get('removed', [])
+    _save_diff_cache(devices_cache)
 
-            add_servers = servers_change.get('added', [])
-            remove_servers = servers_change.get('removed', [])
+    return _ntp_diff
 
-            if add_peers:
-                if 'peers' not in _ntp_diff['add'].keys():
-                    _ntp_diff['add']['peers'] = {}
-                _ntp_diff['add']['peers'][device] = add_peers
 
-            if remove_peers:
-                if 'peers' not in _ntp_diff['remove'].keys():
-                    _ntp_diff['remove']['peers'] = {}
-                _ntp_diff['remove']['peers'][device] = remove_peers
+def unsynchronized(mine=False, tgt='*', expr_form='glob', max_age=_MINE_MAX_AGE):
 
-            if add_servers:
-                if 'servers' not in _ntp_diff['add'].keys():
-                    _ntp_diff['add']['servers'] = {}
-                _ntp_diff['add']['servers'][device] = add_servers
+    """
+    Returns the devices not synchronized, and the devices synchronized only with peers above the expected stratum.
+    The NTP stats and the `ntp` pillar are retrieved in the same job: each device returns its own pillar,
+    so the master does not compile the pillar of every device.
 
-            if remove_servers:
-                if 'servers' not in _ntp_diff['remove'].keys():
-                    _ntp_diff['remove']['servers'] = {}
-                _ntp_diff['remove']['servers'][device] = remove_servers
+    :param mine: answer from the summaries sent to the mine by `ntp.monitor`, and from the pillar cached on the master,
+    without polling the devices. Returns a dictionary having the keys `not_synchronized`, `over_stratum`, together
+    with `stale`: the devices whose summary is older than `max_age`, and `missing`: the devices without a summary.
+    :param tgt: target expression, by default all the devices
+    :param expr_form: target type
+    :param max_age: maximum age of the summary in the mine, in seconds. Default: 900.
 
-    return _ntp_diff
+    CLI Example:
 
+    .. code-block:: bash
 
-def unsynchronized():
+        salt-run ntp.unsynchronized
+        salt-run ntp.unsynchronized mine=True max_age=600
+    """
 
-    _client = _get_client()
-    _rclient = _get_rclient()
-    ntp_stats = _client.cmd('*', 'ntp.stats', [], expr_form='glob', timeout=120)
+    if mine:
+        _rclient = _get_rclient()
+        ntp_mine = _rclient.cmd('cache.mine', [tgt], kwarg={'expr_form': expr_form})
+        ntp_pillars = _rclient.cmd('cache.pillar', [tgt], kwarg={'expr_form': expr_form})
+        ntp_output = {}
+        _stale_devices = list()
+        now = time.time()
+        for device, device_mine in six.iteritems(ntp_mine or {}):
+            device_summary = (device_mine or {}).get('ntp.summary') or {}
+            if not isinstance(device_summary, dict) or not device_summary.get('result', False):
+                continue
+            if now - (device_summary.get('out', {}).get('timestamp') or 0) > float(max_age):
+                _stale_devices.append(device)  # the device might have changed meanwhile
+                continue
+            ntp_output[device] = {
+                'ntp.stats': {
+                    'result': True,
+                    'out': [
+                        {
+                            'remote': peer,
+                            'synchronized': peer_stats.get('synchronized', False),
+                            'stratum': peer_stats.get('stratum', 16)
+                        }
+                        for peer, peer_stats in six.iteritems(device_summary.get('out', {}).get('peers', {}))
+                    ]
+                },
+                'pillar.get': (ntp_pillars.get(device) or {}).get('ntp')
+            }
+    else:
+        _client = _get_client()
+        ntp_output = _client.cmd(tgt, ['ntp.stats', 'pillar.get'], [[], ['ntp']], expr_form=expr_form, timeout=120)
 
     _not_synced_devices = list()
     _over_stratum_devices = list()
 
-    for device, device_ntp_stats in six.iteritems(ntp_stats):
-        if not device_ntp_stats.get('result', False):
+    for device, device_output in six.iteritems(ntp_output):
+        if not isinstance(device_output, dict):
+            continue
+        device_ntp_stats = device_output.get('ntp.stats', {})
+        if not isinstance(device_ntp_stats, dict) or not device_ntp_stats.get('result', False):
             continue
         device_ntp_stats = device_ntp_stats.get('out', {})
         if not device_ntp_stats:
             continue  # if cannot retrieve for some reason,
-        kwarg={'minion': device}
-        device_pillar = _rclient.cmd('pillar.show_pillar', kwarg=kwarg)
-        sync = device_pillar.get('ntp', {}).get('synchronized', False)
-        stratum = device_pillar.get('ntp', {}).get('stratum', 16)
+        device_ntp_pillar = device_output.get('pillar.get') or {}
+        if not isinstance(device_ntp_pillar, dict):
+            continue
+        sync = device_ntp_pillar.get('synchronized', False)
+        stratum = device_ntp_pillar.get('stratum', 16)
         if not sync:
             continue  # if this device does not need sync
         synced_peers = [
@@ -144,35 +368,82 @@ def unsynchronized():
             _over_stratum_devices.append(device)
             continue
 
+    if mine:
+        return {
+            'not_synchronized': sorted(_not_synced_devices),
+            'over_stratum': sorted(_over_stratum_devices),
+            'stale': sorted(_stale_devices),
+            'missing': [
+                device for device in _target_minions(tgt, expr_form)
+                if device not in ntp_output and device not in _stale_devices
+            ]
+        }
+
     return (_not_synced_devices, _over_stratum_devices)
 
 
 def make_pillars_from_existing():
 
+    """
+    Writes the NTP pillar of each device, from the NTP peers and servers currently configured.
+    The peers and servers are retrieved in the same job. A file is written only when its content changes,
+    through a temporary file renamed over the previous one.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt-run ntp.make_pillars_from_existing
+
+    Output Example:
+
+    .. code-block:: python
+
+        {
+            'written': ['ntp_edge01_bjm01.sls'],
+            'unchanged': 2871,
+            'failed': ['edge02.sjc01']
+        }
+    """
+
     _client = _get_client()
     _pillar_path = _get_pillar_path()
 
-    ntp_peers = _client.cmd('*', 'ntp.peers', [], expr_form='glob', timeout=60)
-    ntp_servers = _client.cmd('*', 'ntp.servers', [], expr_form='glob', timeout=60)
+    ntp_output = _client.cmd('*', ['ntp.peers', 'ntp.servers'], [[], []], expr_form='glob', timeout=60)
+
+    written = []
+    unchanged = 0
+    failed = []
 
-    for device, device_ntp_peers in six.iteritems(ntp_peers):
-        if not device_ntp_peers.get('result', False):
+    for device, device_output in six.iteritems(ntp_output):
+        if not isinstance(device_output, dict):
+            failed.append(device)
+            continue
+        device_ntp_peers = device_output.get('ntp.peers', {})
+        device_ntp_servers = device_output.get('ntp.servers', {})
+        if not all([isinstance(ntp_entities, dict) and ntp_entities.get('result', False)
+                    for ntp_entities in (device_ntp_peers, device_ntp_servers)]):
+            failed.append(device)  # do not overwrite the pillar with partial data
             continue
-        ntp_peers_list = device_ntp_peers.get('out', [])
-        ntp_servers_list = ntp_servers.get(device, {}).get('out', [])
         ntp_filecontent = {
-            'ntp.peers': ntp_peers_list,
-            'ntp.servers': ntp_servers_list
+            'ntp.peers': device_ntp_peers.get('out', []),
+            'ntp.servers': device_ntp_servers.get('out', [])
         }
         device_flat_name = device.replace('.', '_')
         ntp_filename = 'ntp_{device}.sls'.format(
             device=device_flat_name
         )
-        ntp_peers_filepath = os.path.join(_pillar_path, ntp_filename)
-        with open(ntp_peers_filepath, 'w') as ntp_file:
-            ntp_file.write(
-                yaml.dump(ntp_filecontent, default_flow_style=False)
-            )
+        ntp_filepath = os.path.join(_pillar_path, ntp_filename)
+        if _write_if_changed(ntp_filepath, yaml.dump(ntp_filecontent, default_flow_style=False)):
+            written.append(ntp_filename)
+        else:
+            unchanged += 1
+
+    return {
+        'written': sorted(written),
+        'unchanged': unchanged,
+        'failed': sorted(failed)
+    }
 
 
 def rebuild_pillars():
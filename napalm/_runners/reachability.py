@@ -0,0 +1,128 @@
+"""
+Checks the reachability of many destinations from many network devices, in a single job,
+and aggregates the results per destination, across the fleet.
+
+CLI Example:
+
+.. code-block:: bash
+
+    salt-run reachability.ping 8.8.8.8,1.1.1.1
+    salt-run reachability.ping 8.8.8.8,1.1.1.1 tgt='edge*' count=10 concurrency=5
+"""
+from __future__ import absolute_import
+
+# Import salt modules
+import salt.client
+from salt.ext import six
+
+# ----------------------------------------------------------------------------------------------------------------------
+# helper functions -- will not be exported
+# ----------------------------------------------------------------------------------------------------------------------
+
+
+def _get_client():
+
+    return salt.client.LocalClient(__opts__['conf_file'])
+
+
+def _percentile(values, percent):
+
+    '''
+    Returns the nearest-rank percentile of a sorted list.
+    '''
+
+    if not values:
+        return None
+
+    rank = int(round(percent / 100.0 * (len(values) - 1)))
+    return values[rank]
+
+# ----------------------------------------------------------------------------------------------------------------------
+# callable functions
+# ----------------------------------------------------------------------------------------------------------------------
+
+
+def ping(destinations, tgt='*', expr_form='glob', source='', ttl=0, timeout=0, size=0, count=0, concurrency=1,
+         job_timeout=300):
+
+    '''
+    Executes `net.ping_many` on the targeted devices and returns, for each destination, the fleet level statistics:
+    number of devices reaching the destination, average loss and RTT percentiles, plus the devices not reaching it.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt-run reachability.ping 8.8.8.8,1.1.1.1 tgt='edge*'
+
+    Output Example:
+
+    .. code-block:: python
+
+        {
+            '8.8.8.8': {
+                'devices': 120,
+                'reachable': 119,
+                'loss_avg': 0.4,
+                'rtt_p50': 1.455,
+                'rtt_p90': 12.871,
+                'rtt_max': 74.002,
+                'unreachable_from': [
+                    'edge01.bjm01'
+                ]
+            }
+        }
+    '''
+
+    _client = _get_client()
+
+    fleet_output = _client.cmd(tgt,
+                               'net.ping_many',
+                               kwarg={
+                                   'destinations': destinations,
+                                   'source': source,
+                                   'ttl': ttl,
+                                   'timeout': timeout,
+                                   'size': size,
+                                   'count': count,
+                                   'concurrency': concurrency
+                               },
+                               expr_form=expr_form,
+                               timeout=job_timeout)
+
+    per_destination = {}
+
+    for device, device_output in six.iteritems(fleet_output):
+        if not isinstance(device_output, dict) or not device_output.get('result'):
+            continue
+        for destination, result in six.iteritems(device_output.get('out', {}).get('destinations', {})):
+            destination_stats = per_destination.setdefault(destination, {
+                'devices': 0,
+                'losses': [],
+                'rtts': [],
+                'unreachable_from': []
+            })
+            destination_stats['devices'] += 1
+            if 'error' in result or result.get('loss', 100) >= 100:
+                destination_stats['unreachable_from'].append(device)
+                continue
+            destination_stats['losses'].append(result.get('loss', 0))
+            if result.get('rtt_avg') is not None:
+                destination_stats['rtts'].append(result['rtt_avg'])
+
+    fleet_stats = {}
+
+    for destination, destination_stats in six.iteritems(per_destination):
+        losses = destination_stats['losses']
+        rtts = sorted(destination_stats['rtts'])
+        fleet_stats[destination] = {
+            'devices': destination_stats['devices'],
+            'reachable': destination_stats['devices'] - len(destination_stats['unreachable_from']),
+            'loss_avg': round(sum(losses) / len(losses), 2) if losses else None,
+            'rtt_p50': _percentile(rtts, 50),
+            'rtt_p90': _percentile(rtts, 90),
+            'rtt_max': rtts[-1] if rtts else None,
+            'unreachable_from': sorted(destination_stats['unreachable_from'])
+        }
+
+    return fleet_stats
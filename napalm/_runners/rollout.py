@@ -0,0 +1,322 @@
+"""
+Rolls out a configuration change across the network devices managed through the NAPALM proxy, gradually:
+first on a canary batch, then in waves, checking the health of the devices between the waves.
+The rollout stops as soon as the failures exceed the accepted limit or the health check fails,
+and the remaining devices are not touched.
+
+The progress is streamed as the devices and the waves complete.
+
+CLI Example:
+
+.. code-block:: bash
+
+    salt-run rollout.template set_ntp_peers tgt='edge*' peers='["172.17.17.1"]'
+    salt-run rollout.config text='set system ntp peer 172.17.17.1' canary=2 wave=10 concurrency=5
+"""
+from __future__ import absolute_import
+
+# Import stdlib
+import time
+import logging
+log = logging.getLogger(__name__)
+
+# Import salt modules
+import salt.client
+from salt.ext import six
+
+# ----------------------------------------------------------------------------------------------------------------------
+# helper functions -- will not be exported
+# ----------------------------------------------------------------------------------------------------------------------
+
+
+def _get_client():
+
+    return salt.client.LocalClient(__opts__['conf_file'])
+
+
+def _progress(message, **data):
+
+    '''
+    Streams the progress of the rollout on the event bus.
+    '''
+
+    data['message'] = message
+    log.info(message)
+    try:
+        __jid_event__.fire_event(data, 'progress')
+    except NameError:
+        pass  # not executed through the runner client
+
+
+def _clean_kwargs(kwargs):
+
+    return dict(
+        (key, value)
+        for key, value in six.iteritems(kwargs)
+        if not key.startswith('__')
+    )
+
+
+def _wave_size(wave, total):
+
+    '''
+    Returns the number of devices in a wave, given as count or percentage of the targeted devices.
+    '''
+
+    if isinstance(wave, six.string_types) and wave.endswith('%'):
+        return max(1, int(total * float(wave[:-1]) / 100))
+
+    return max(1, int(wave))
+
+
+def _waves(devices, canary, wave):
+
+    waves = []
+    if canary:
+        waves.append(devices[:canary])
+        devices = devices[canary:]
+
+    size = _wave_size(wave, len(devices))
+    waves.extend([devices[index:index + size] for index in range(0, len(devices), size)])
+
+    return [devices_wave for devices_wave in waves if devices_wave]
+
+
+def _bgp_established(bgp_neighbors):
+
+    '''
+    Counts the BGP neighbors up, in all the routing instances.
+    '''
+
+    if not isinstance(bgp_neighbors, dict) or not bgp_neighbors.get('result'):
+        return None
+
+    return sum([
+        len([neighbor for neighbor in neighbors if neighbor.get('up')])
+        for instance in six.itervalues(bgp_neighbors.get('out') or {})
+        for neighbors in six.itervalues(instance)
+    ])
+
+
+def _health(_client, devices, timeout):
+
+    '''
+    Returns the number of BGP sessions established, per device.
+    '''
+
+    health_output = _client.cmd(devices, 'bgp.neighbors', expr_form='list', timeout=timeout)
+
+    return dict(
+        (device, _bgp_established(health_output.get(device)))
+        for device in devices
+    )
+
+
+def _apply(_client, devices, fun, kwarg, concurrency, timeout):
+
+    '''
+    Executes the function on the devices of a wave, on maximum `concurrency` devices at a time.
+    '''
+
+    results = {}
+
+    for index in range(0, len(devices), concurrency):
+        window = devices[index:index + concurrency]
+        for device_return in _client.cmd_iter(window, fun, kwarg=kwarg, expr_form='list', timeout=timeout):
+            for device, device_output in six.iteritems(device_return):
+                device_result = device_output.get('ret', {})
+                if not isinstance(device_result, dict):
+                    device_result = {'result': False, 'comment': device_result}
+                results[device] = device_result
+                _progress('{device}: {status}'.format(
+                              device=device,
+                              status='success' if device_result.get('result') else 'failed'
+                          ),
+                          device=device,
+                          result=device_result.get('result', False),
+                          already_configured=device_result.get('already_configured', False),
+                          comment=device_result.get('comment', ''))
+        for device in window:
+            if device not in results:
+                results[device] = {'result': False, 'comment': 'No response in {0} seconds'.format(timeout)}
+
+    return results
+
+
+def _rollout(fun, kwarg, tgt, expr_form, canary, wave, concurrency, health_check, health_wait, max_failures,
+             timeout):
+
+    _client = _get_client()
+
+    devices = sorted(_client.cmd(tgt, 'test.ping', expr_form=expr_form, timeout=timeout).keys())
+    waves = _waves(devices, canary, wave)
+
+    rollout = {
+        'result': True,
+        'comment': '',
+        'devices': len(devices),
+        'waves': [],
+        'failed': [],
+        'unhealthy': [],
+        'not_touched': []
+    }
+
+    _progress('Rolling out {fun} on {count} devices, in {waves} waves'.format(
+        fun=fun,
+        count=len(devices),
+        waves=len(waves)
+    ), devices=len(devices), waves=len(waves))
+
+    baseline = {}
+    if health_check and devices and not kwarg.get('test'):
+        baseline = _health(_client, devices, timeout)
+
+    for wave_index, devices_wave in enumerate(waves):
+        wave_name = 'canary' if (canary and wave_index == 0) else 'wave {0}'.format(wave_index)
+        wave_start = time.time()
+        results = _apply(_client, devices_wave, fun, kwarg, concurrency, timeout)
+        failed = sorted([device for device, result in six.iteritems(results) if not result.get('result')])
+
+        unhealthy = []
+        if baseline:
+            if health_wait:
+                time.sleep(health_wait)  # let the sessions re-establish
+            wave_health = _health(_client, devices_wave, timeout)
+            unhealthy = sorted([
+                device
+                for device, established in six.iteritems(wave_health)
+                if baseline.get(device) is not None and (established is None or established < baseline[device])
+            ])
+
+        rollout['waves'].append({
+            'name': wave_name,
+            'devices': devices_wave,
+            'changed': sorted([
+                device
+                for device, result in six.iteritems(results)
+                if result.get('result') and not result.get('already_configured')
+            ]),
+            'failed': failed,
+            'unhealthy': unhealthy,
+            'duration': round(time.time() - wave_start, 3)
+        })
+        rollout['failed'].extend(failed)
+        rollout['unhealthy'].extend(unhealthy)
+
+        _progress('{wave} completed: {count} devices, {failed} failed, {unhealthy} unhealthy'.format(
+                      wave=wave_name,
+                      count=len(devices_wave),
+                      failed=len(failed),
+                      unhealthy=len(unhealthy)
+                  ),
+                  wave=wave_name,
+                  failed=failed,
+                  unhealthy=unhealthy)
+
+        if len(rollout['failed']) > max_failures or unhealthy:
+            rollout['not_touched'] = [device for remaining in waves[wave_index + 1:] for device in remaining]
+            rollout['result'] = False
+            rollout['comment'] = 'Rollout stopped after {wave}: {reason}. {count} devices not touched.'.format(
+                wave=wave_name,
+                reason='health check failed on {0}'.format(', '.join(unhealthy)) if unhealthy
+                else '{0} devices failed'.format(len(rollout['failed'])),
+                count=len(rollout['not_touched'])
+            )
+            _progress(rollout['comment'], not_touched=rollout['not_touched'])
+            return rollout
+
+    rollout['comment'] = 'Rollout completed on {0} devices.'.format(len(devices))
+    _progress(rollout['comment'])
+
+    return rollout
+
+# ----------------------------------------------------------------------------------------------------------------------
+# callable functions
+# ----------------------------------------------------------------------------------------------------------------------
+
+
+def template(template_name, tgt='*', expr_form='glob', canary=1, wave='25%', concurrency=10, health_check=True,
+             health_wait=0, max_failures=0, test=False, timeout=300, **template_vars):
+
+    '''
+    Rolls out a configuration template, using `net.load_template`.
+
+    :param template_name: the name of the template, or the absolute path
+    :param tgt: target expression, by default all the devices
+    :param expr_form: target type
+    :param canary: number of devices in the first batch
+    :param wave: size of the next waves: number of devices (e.g.: `10`) or percentage of the devices (e.g.: `25%`)
+    :param concurrency: maximum number of devices configured at the same time, inside a wave
+    :param health_check: compare the number of BGP sessions established before and after each wave
+    :param health_wait: number of seconds to wait after a wave, before checking the health of the devices
+    :param max_failures: number of devices accepted to fail, before stopping the rollout
+    :param test: dry run, the changes are discarded on each device
+    :param timeout: maximum number of seconds to wait for a device to reply
+    :param template_vars: the variables sent to `net.load_template`
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt-run rollout.template set_ntp_peers tgt='edge*' wave=10% peers='["172.17.17.1"]'
+
+    Output Example:
+
+    .. code-block:: python
+
+        {
+            'result': False,
+            'comment': 'Rollout stopped after wave 1: health check failed on edge02.bjm01. 80 devices not touched.',
+            'devices': 100,
+            'waves': [
+                {
+                    'name': 'canary',
+                    'devices': ['edge01.bjm01'],
+                    'changed': ['edge01.bjm01'],
+                    'failed': [],
+                    'unhealthy': [],
+                    'duration': 7.2
+                },
+                ...
+            ],
+            'failed': [],
+            'unhealthy': ['edge02.bjm01'],
+            'not_touched': [...]
+        }
+    '''
+
+    kwarg = _clean_kwargs(template_vars)
+    kwarg.update({
+        'template_name': template_name,
+        'test': test
+    })
+
+    return _rollout('net.load_template', kwarg, tgt, expr_form, canary, wave, concurrency, health_check,
+                    health_wait, max_failures, timeout)
+
+
+def config(filename=None, text=None, tgt='*', expr_form='glob', canary=1, wave='25%', concurrency=10,
+           health_check=True, health_wait=0, max_failures=0, test=False, timeout=300):
+
+    '''
+    Rolls out a static configuration, using `net.load_config`.
+    The arguments controlling the rollout are the same as for `rollout.template`.
+
+    :param filename: path to the file containing the configuration, on the proxy minion
+    :param text: the configuration to be loaded
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt-run rollout.config text='set system ntp peer 172.17.17.1' canary=2 wave=10 concurrency=5
+    '''
+
+    kwarg = {
+        'filename': filename,
+        'text': text,
+        'test': test
+    }
+
+    return _rollout('net.load_config', kwarg, tgt, expr_form, canary, wave, concurrency, health_check,
+                    health_wait, max_failures, timeout)
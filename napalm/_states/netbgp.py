@@ -0,0 +1,356 @@
+# -*- coding: utf-8 -*-
+'''
+Network BGP
+===========
+
+Manage the BGP neighbors configured on the network devices through the NAPALM proxy.
+
+Only the neighbors whose attributes differ from the running configuration are rendered,
+therefore changing one neighbor on a device having thousands of them loads and commits one small change.
+
+:codeauthor: Mircea Ulinic <mircea@cloudflare.com> & Jerome Fleury <jf@cloudflare.com>
+:maturity:   new
+:depends:    napalm
+:platform:   unix
+
+Dependencies
+------------
+
+- :mod:`NAPALM proxy minion <salt.proxy.napalm>`
+- :mod:`BGP operational and configuration management module <salt.modules.napalm_bgp>`
+'''
+
+from __future__ import absolute_import
+
+# python std lib
+import logging
+log = logging.getLogger(__name__)
+
+from copy import deepcopy
+from json import loads, dumps
+
+# salt modules
+from salt.ext import six
+
+# third party libs
+try:
+    # will try to import NAPALM
+    # https://github.com/napalm-automation/napalm
+    # pylint: disable=W0611
+    from napalm_base import get_network_driver
+    # pylint: enable=W0611
+    HAS_NAPALM = True
+except ImportError:
+    HAS_NAPALM = False
+
+# ----------------------------------------------------------------------------------------------------------------------
+# state properties
+# ----------------------------------------------------------------------------------------------------------------------
+
+__virtualname__ = 'netbgp'
+
+# ----------------------------------------------------------------------------------------------------------------------
+# global variables
+# ----------------------------------------------------------------------------------------------------------------------
+
+_GROUP_ONLY_ATTRIBUTES = ('neighbors', 'type', 'apply_groups', 'multipath', 'multihop_ttl')
+# group attributes not inherited by the neighbors
+
+# ----------------------------------------------------------------------------------------------------------------------
+# property functions
+# ----------------------------------------------------------------------------------------------------------------------
+
+
+def __virtual__():
+
+    '''
+    NAPALM library must be installed for this module to work.
+    Also, the key proxymodule must be set in the __opts___ dictionary.
+    '''
+
+    if HAS_NAPALM and 'proxy' in __opts__:
+        return __virtualname__
+    else:
+        return (False, 'The module netbgp cannot be loaded: NAPALM lib or proxy could not be loaded.')
+
+# ----------------------------------------------------------------------------------------------------------------------
+# helper functions -- will not be exported
+# ----------------------------------------------------------------------------------------------------------------------
+
+
+def _default_ret(name):
+
+    '''
+    Returns a default structure of the dictionary to be returned as output of the state functions.
+    '''
+
+    return {
+        'name': name,
+        'result': False,
+        'changes': {},
+        'comment': ''
+    }
+
+
+def _ordered_dict_to_dict(data):
+
+    '''Mandatory to be dict type in order to be used in the NAPALM Jinja template.'''
+
+    return loads(dumps(data))
+
+
+def _inherited(group_details):
+
+    return dict(
+        (attribute, value)
+        for attribute, value in six.iteritems(group_details)
+        if attribute not in _GROUP_ONLY_ATTRIBUTES and attribute != 'defaults'
+    )
+
+
+def _expand_neighbors(groups, defaults):
+
+    '''
+    Builds the expected attributes of each neighbor: the general defaults, updated with the group defaults,
+    updated with the attributes of the neighbor.
+    '''
+
+    expected = {}
+
+    for group_name, group_details in six.iteritems(groups):
+        group_details = group_details or {}
+        group_defaults = deepcopy(defaults)
+        group_defaults.update(group_details.get('defaults', {}))
+        group_defaults.update(_inherited(group_details))
+        expected[group_name] = {}
+        for neighbor, neighbor_details in six.iteritems(group_details.get('neighbors') or {}):
+            neighbor_attributes = deepcopy(group_defaults)
+            neighbor_attributes.update(neighbor_details or {})
+            expected[group_name][neighbor] = neighbor_attributes
+
+    return expected
+
+
+def _configured_neighbors(bgp_config):
+
+    '''
+    Builds the effective attributes of each neighbor configured on the device:
+    the attributes configured on the group, overridden by the non-empty attributes configured on the neighbor.
+    '''
+
+    configured = {}
+
+    for group_name, group_details in six.iteritems(bgp_config):
+        group_attributes = dict(
+            (attribute, value)
+            for attribute, value in six.iteritems(_inherited(group_details))
+            if value not in ('', None, [], {})
+        )
+        configured[group_name] = {}
+        for neighbor, neighbor_details in six.iteritems(group_details.get('neighbors') or {}):
+            neighbor_attributes = deepcopy(group_attributes)
+            neighbor_attributes.update(dict(
+                (attribute, value)
+                for attribute, value in six.iteritems(neighbor_details)
+                if value not in ('', None, [], {})
+            ))
+            configured[group_name][neighbor] = neighbor_attributes
+
+    return configured
+
+
+def _same_value(expected, configured):
+
+    if isinstance(expected, dict) or isinstance(configured, dict):
+        return _ordered_dict_to_dict(expected) == _ordered_dict_to_dict(configured)
+
+    if isinstance(expected, bool) or isinstance(configured, bool):
+        return bool(expected) == bool(configured)
+
+    return six.text_type(expected) == six.text_type(configured)  # e.g.: AS numbers as int or str
+
+
+def _compare_neighbors(configured, expected, remove):
+
+    '''
+    Compares the neighbors, attribute by attribute, and returns the neighbors to be added, updated and removed.
+    Only the attributes specified in the state are compared.
+    '''
+
+    add_neighbors = {}
+    update_neighbors = {}
+    remove_neighbors = {}
+
+    for group_name, group_neighbors in six.iteritems(expected):
+        configured_group = configured.get(group_name, {})
+        for neighbor, neighbor_attributes in six.iteritems(group_neighbors):
+            if neighbor not in configured_group:
+                add_neighbors.setdefault(group_name, {})[neighbor] = neighbor_attributes
+                continue
+            changed_attributes = dict(
+                (attribute, value)
+                for attribute, value in six.iteritems(neighbor_attributes)
+                if not _same_value(value, configured_group[neighbor].get(attribute))
+            )
+            if changed_attributes:
+                update_neighbors.setdefault(group_name, {})[neighbor] = changed_attributes
+        if not remove:
+            continue
+        for neighbor, neighbor_attributes in six.iteritems(configured_group):
+            if neighbor not in group_neighbors:
+                remove_neighbors.setdefault(group_name, {})[neighbor] = neighbor_attributes
+
+    return {
+        'add': add_neighbors,
+        'update': update_neighbors,
+        'remove': remove_neighbors
+    }
+
+# ----------------------------------------------------------------------------------------------------------------------
+# callable functions
+# ----------------------------------------------------------------------------------------------------------------------
+
+
+def managed(name, groups, template_name, template_path=None, defaults=None, remove=True):
+
+    '''
+    Ensures the BGP neighbors are configured on the device as specified in the state SLS file.
+
+    The neighbors are compared attribute by attribute with the configuration retrieved using `bgp.config`.
+    The template is rendered only with the neighbors to be added, updated or removed, loaded as one candidate
+    configuration and committed once.
+
+    :param groups: the BGP groups and their neighbors. The attributes of a group, except `neighbors`, `type`,
+    `apply_groups`, `multipath` and `multihop_ttl`, apply to all its neighbors, as well as the attributes under the
+    `defaults` key of the group. The attributes of a neighbor are the ones returned by `bgp.config`: remote_as,
+    description, import_policy, export_policy, local_address, local_as, authentication_key, prefix_limit,
+    route_reflector_client, nhs. Only the attributes specified are compared.
+    :param template_name: the name of the template rendering the changes. It receives three variables,
+    `add`, `update` and `remove`, each of them a dictionary of groups, having the neighbors as keys.
+    For `update`, only the attributes changed are sent.
+    :param template_path: the directory of the template, if not a full path in `template_name`
+    :param defaults: attributes common to all the neighbors
+    :param remove: remove the neighbors configured in the groups managed by this state, but not specified.
+    The groups not specified are never touched.
+
+    SLS Example:
+
+    .. code-block:: yaml
+
+        bgp_neighbors:
+            netbgp.managed:
+                - template_name: bgp_neighbors
+                - template_path: /etc/salt/templates/
+                - defaults:
+                    import_policy: PUBLIC-PEER-IN
+                - groups:
+                    PEERS-PUBLIC:
+                        export_policy: PUBLIC-PEER-OUT
+                        neighbors:
+                            192.168.0.1:
+                                remote_as: 32934
+                                description: Facebook [CDN]
+                            172.17.17.1:
+                                remote_as: 13414
+                                description: Twitter [CDN]
+
+    Template Example (Junos):
+
+    .. code-block:: jinja
+
+        protocols {
+            bgp {
+            {%- for group, neighbors in add.items() %}
+                group {{ group }} {
+                {%- for neighbor, attributes in neighbors.items() %}
+                    neighbor {{ neighbor }} {
+                        peer-as {{ attributes.remote_as }};
+                        description "{{ attributes.description }}";
+                    }
+                {%- endfor %}
+                }
+            {%- endfor %}
+            ...
+            }
+        }
+    '''
+
+    ret = _default_ret(name)
+
+    bgp_config = __salt__['bgp.config']()  # retrieves the BGP config from the device
+
+    if not bgp_config.get('result'):
+        ret.update({
+            'comment': 'Cannot retrieve the BGP configuration from the device: {reason}'.format(
+                reason=bgp_config.get('comment')
+            )
+        })
+        return ret
+
+    if not isinstance(defaults, dict):
+        defaults = {}
+
+    expected = _expand_neighbors(_ordered_dict_to_dict(groups or {}), _ordered_dict_to_dict(defaults))
+    configured = _configured_neighbors(bgp_config.get('out') or {})
+
+    diff = _compare_neighbors(configured, expected, remove)
+
+    if not (diff['add'] or diff['update'] or diff['remove']):
+        ret.update({
+            'result': True,
+            'comment': 'BGP neighbors already configured as specified.'
+        })
+        return ret
+
+    changes = {
+        'added': diff['add'],
+        'updated': diff['update'],
+        'removed': diff['remove']
+    }
+
+    loaded = __salt__['net.load_template'](
+        template_name,
+        template_path=template_path,
+        test=__opts__['test'],
+        commit=True,  # committed right after the single comparison, only when there are changes
+        add=diff['add'],
+        update=diff['update'],
+        remove=diff['remove']
+    )
+
+    if not loaded.get('result'):
+        ret.update({
+            'changes': changes,
+            'comment': 'Cannot load the BGP neighbors changes: {reason}'.format(reason=loaded.get('comment'))
+        })
+        return ret
+
+    if loaded.get('already_configured') or not loaded.get('diff'):
+        # the attributes differ only in their representation
+        # the template did not produce any change on the device
+        ret.update({
+            'result': True,
+            'comment': 'BGP neighbors already configured as specified.'
+        })
+        return ret
+
+    changes['diff'] = loaded['diff']
+    ret['changes'] = changes
+
+    if __opts__['test'] is True:
+        ret.update({
+            'comment': 'Testing mode: configuration was not changed!',
+            'result': None
+        })
+        return ret
+
+    ret.update({
+        'result': True,
+        'comment': 'BGP neighbors updated: {added} added, {updated} updated, {removed} removed.'.format(
+            added=sum([len(neighbors) for neighbors in six.itervalues(diff['add'])]),
+            updated=sum([len(neighbors) for neighbors in six.itervalues(diff['update'])]),
+            removed=sum([len(neighbors) for neighbors in six.itervalues(diff['remove'])])
+        )
+    })
+
+    return ret
@@ -27,9 +27,14 @@ Dependencies
 
 from __future__ import absolute_import
 
+import os
+import json
+import time
 import logging
 log = logging.getLogger(__name__)
 
+from multiprocessing.pool import ThreadPool
+
 # third party libs
 try:
     # will try to import NAPALM
@@ -64,6 +69,23 @@ __virtualname__ = 'netntp'
 # global variables
 # ----------------------------------------------------------------------------------------------------------------------
 
+DNS_CACHE = {}
+# addresses resolved for each name, with the expiration given by the TTL of the DNS records
+
+DNS_CACHE_FILENAME = 'napalm_ntp_dns.json'
+# the cache is also persisted in the cachedir, shared by the proxies running on the same host
+
+DNS_RESOLVERS = 10
+# maximum number of names resolved at the same time
+
+NTP_ENTITIES = ('peers', 'servers')
+
+NTP_TEMPLATES = (
+    ('added', 'set_ntp_{what}'),
+    ('removed', 'delete_ntp_{what}')
+)
+# the templates of the driver rendering the changes of each NTP entity
+
 # ----------------------------------------------------------------------------------------------------------------------
 # property functions
 # ----------------------------------------------------------------------------------------------------------------------
@@ -98,195 +120,224 @@ def _default_ret(name):
     return ret
 
 
-def _retrieve_ntp_peers():
-
-    '''Retrieves configured NTP peers'''
-
-    return __salt__['ntp.peers']()
-
-
-def _retrieve_ntp_servers():
-
-    '''Retrieves configured NTP servers'''
-
-    return __salt__['ntp.servers']()
-
+def _retrieve_ntp_config(desired):
 
-def _check(peers):
+    '''
+    Retrieves the NTP entities configured on the device, once, only for the entities managed by the state.
+    Returns the configured entities and the reason of the failure, if any.
+    '''
 
-    '''Checks whether the input is a valid list of peers and transforms domain names into IP Addresses'''
+    configured = {}
 
-    if not isinstance(peers, list):
-        return False
+    for what in desired.keys():
+        ntp_list_output = __salt__['ntp.{what}'.format(what=what)]()  # contains only IP Addresses as dictionary keys
+        if ntp_list_output.get('result', False) is False:
+            return None, 'Cannot retrieve NTP {what} from the device: {reason}'.format(
+                what=what,
+                reason=ntp_list_output.get('comment')
+            )
+        configured[what] = set(ntp_list_output.get('out', {}))
 
-    for peer in peers:
-        if not isinstance(peer, str):
-            return False
+    return configured, ''
 
-    if not HAS_NETADDR:  # if does not have this lib installed, will simply try to load what user specified
-        # if the addresses are not correctly specified, will trow error when loading the actual config
-        return True
 
-    ip_only_peers = []
-    for peer in peers:
-        try:
-            ip_only_peers.append(str(IPAddress(peer)))  # append the str value
-        except AddrFormatError:
-            # if not a valid IP Address
-            # will try to see if it is a nameserver and resolve it
-            if not HAS_DNSRESOLVER:
-                continue  # without the dns resolver cannot populate the list of NTP entities based on their nameserver
-                # so we'll move on
-            dns_reply = []
-            try:
-                # try to see if it is a valid NS
-                dns_reply = dns.resolver.query(peer)
-            except dns.resolver.NoAnswer:
-                # no a valid DNS entry either
-                return False
-            for dns_ip in dns_reply:
-                ip_only_peers.append(str(dns_ip))
+def _get_dns_cache_path():
 
-    peers = ip_only_peers
+    return os.path.join(__opts__['cachedir'], DNS_CACHE_FILENAME)
 
-    return True
 
+def _load_dns_cache():
 
-def _clean(lst):
+    '''
+    Reads the names resolved by the other proxies on this host, or during the previous runs.
+    '''
 
-    return [elem for elem in lst if elem]
+    dns_cache_path = _get_dns_cache_path()
+    if not os.path.isfile(dns_cache_path):
+        return
 
+    try:
+        with open(dns_cache_path, 'r') as dns_cache_file:
+            stored_cache = json.load(dns_cache_file)
+    except (IOError, ValueError):
+        return
 
-def _set_ntp_peers(peers):
+    for dns_name, dns_entry in stored_cache.items():
+        if dns_entry.get('expires', 0) > DNS_CACHE.get(dns_name, {}).get('expires', 0):
+            DNS_CACHE[dns_name] = dns_entry
 
-    '''Calls ntp.set_peers.'''
 
-    return __salt__['ntp.set_peers'](*peers, commit=False)
+def _save_dns_cache():
 
+    dns_cache_path = _get_dns_cache_path()
+    tmp_path = '{path}.{pid}.tmp'.format(path=dns_cache_path, pid=os.getpid())
+    try:
+        with open(tmp_path, 'w') as dns_cache_file:
+            json.dump(DNS_CACHE, dns_cache_file)
+        os.rename(tmp_path, dns_cache_path)
+    except (IOError, OSError) as error:
+        log.warning('Cannot save the DNS cache: {error}'.format(error=error))
 
-def _set_ntp_servers(servers):
 
-    '''Calls ntp.set_servers.'''
+def _resolve(dns_name):
 
-    return __salt__['ntp.set_servers'](*servers, commit=False)
+    '''
+    Resolves a name and returns the addresses and the expiration of the answer,
+    or None when the resolver fails.
+    '''
 
+    try:
+        dns_reply = dns.resolver.query(dns_name)
+    except dns.resolver.NoAnswer:
+        return dns_name, {
+            'addresses': [],
+            'expires': time.time()
+        }
+    except Exception as error:  # timeout, no nameservers, NXDOMAIN etc.
+        log.warning('Cannot resolve {name}: {error}'.format(name=dns_name, error=error))
+        return dns_name, None
 
-def _delete_ntp_peers(peers):
+    return dns_name, {
+        'addresses': [str(dns_ip) for dns_ip in dns_reply],
+        'expires': dns_reply.expiration
+    }
 
-    '''Calls ntp.delete_peers.'''
 
-    return __salt__['ntp.delete_peers'](*peers, commit=False)
+def _resolve_names(dns_names):
 
+    '''
+    Resolves the names not cached or expired, in parallel.
+    When the resolver fails, the last known addresses are used.
+    Returns a dictionary having the names as keys and the list of addresses as values.
+    '''
 
-def _delete_ntp_servers(servers):
+    now = time.time()
 
-    '''Calls ntp.delete_servers.'''
+    expired = [dns_name for dns_name in dns_names if DNS_CACHE.get(dns_name, {}).get('expires', 0) <= now]
+    if expired:
+        _load_dns_cache()
+        expired = [dns_name for dns_name in expired if DNS_CACHE.get(dns_name, {}).get('expires', 0) <= now]
 
-    return __salt__['ntp.delete_servers'](*servers, commit=False)
+    if expired:
+        pool = ThreadPool(min(len(expired), DNS_RESOLVERS))
+        try:
+            answers = pool.map(_resolve, expired)
+        finally:
+            pool.close()
+            pool.join()
+        updated = False
+        for dns_name, dns_entry in answers:
+            if dns_entry is None:
+                continue  # keep the last known answer, if any
+            DNS_CACHE[dns_name] = dns_entry
+            updated = True
+        if updated:
+            _save_dns_cache()
+
+    return dict(
+        (dns_name, DNS_CACHE[dns_name]['addresses'])
+        for dns_name in dns_names
+        if dns_name in DNS_CACHE
+    )
 
 
-def _exec_fun(name, *kargs):
+def _check(peers):
 
-    if name in list(globals().keys()):
-        return globals().get(name)(*kargs)
+    '''
+    Checks whether the input is a valid list of peers and transforms domain names into IP Addresses.
+    Returns the list of IP Addresses, or None when the input is not valid.
+    '''
 
-    return None
+    if not isinstance(peers, list):
+        return None
 
+    for peer in peers:
+        if not isinstance(peer, str):
+            return None
 
-def _check_diff_and_configure(fun_name, peers_servers, name='peers'):
+    if not HAS_NETADDR:  # if does not have this lib installed, will simply try to load what user specified
+        # if the addresses are not correctly specified, will trow error when loading the actual config
+        return peers
 
-    _ret = _default_ret(fun_name)
+    ip_only_peers = []
+    dns_names = []
+    for peer in peers:
+        try:
+            ip_only_peers.append(str(IPAddress(peer)))  # append the str value
+        except AddrFormatError:
+            # if not a valid IP Address
+            # will try to see if it is a nameserver and resolve it
+            if not HAS_DNSRESOLVER:
+                continue  # without the dns resolver cannot populate the list of NTP entities based on their nameserver
+                # so we'll move on
+            dns_names.append(peer)
 
-    _options = ['peers', 'servers']
+    if dns_names:
+        resolved = _resolve_names(dns_names)
+        for dns_name in dns_names:
+            if not resolved.get(dns_name):
+                # no a valid DNS entry either
+                # and never resolved before
+                return None
+            ip_only_peers.extend(resolved[dns_name])
 
-    if name not in _options:
-        return _ret
+    return ip_only_peers
 
-    _retrieve_fun = '_retrieve_ntp_{what}'.format(what=name)
-    ntp_list_output = _exec_fun(_retrieve_fun)  # contains only IP Addresses as dictionary keys
 
-    if ntp_list_output.get('result', False) is False:
-        _ret['comment'] = 'Cannot retrieve NTP {what} from the device: {reason}'.format(
-            what=name,
-            reason=ntp_list_output.get('comment')
-        )
-        return _ret
+def _clean(lst):
 
-    configured_ntp_list = set(ntp_list_output.get('out', {}))
-    desired_ntp_list = set(peers_servers)
+    return [elem for elem in lst if elem]
 
-    if configured_ntp_list == desired_ntp_list:
-        _ret.update({
-            'comment': 'NTP {what} already configured as needed.'.format(
-                what=name
-            ),
-            'result': True
-        })
-        return _ret
 
-    list_to_set = list(desired_ntp_list - configured_ntp_list)
-    list_to_delete = list(configured_ntp_list - desired_ntp_list)
+def _diff(configured, desired):
 
-    list_to_set = _clean(list_to_set)
-    list_to_delete = _clean(list_to_delete)
+    '''
+    Determines the NTP entities to be added and removed.
+    '''
 
     changes = {}
-    if list_to_set:
-        changes['added'] = list_to_set
-    if list_to_delete:
-        changes['removed'] = list_to_delete
-
-    _ret.update({
-        'changes': changes
-    })
-
-    if __opts__['test'] is True:
-        _ret.update({
-            'result': None,
-            'comment': 'Testing mode: configuration was not changed!'
-        })
-        return _ret
 
-    # <---- Retrieve existing NTP peers and determine peers to be added/removed --------------------------------------->
+    for what in NTP_ENTITIES:
+        if what not in desired:
+            continue
+        desired_ntp_list = set(desired[what])
+        list_to_set = _clean(list(desired_ntp_list - configured[what]))
+        list_to_delete = _clean(list(configured[what] - desired_ntp_list))
+        entity_changes = {}
+        if list_to_set:
+            entity_changes['added'] = list_to_set
+        if list_to_delete:
+            entity_changes['removed'] = list_to_delete
+        if entity_changes:
+            changes[what] = entity_changes
 
-    # ----- Call _set_ntp_peers and _delete_ntp_peers as needed ------------------------------------------------------->
+    return changes
 
-    expected_config_change = False
-    successfully_changed = True
 
-    comment = ''
+def _changes_template(changes):
 
-    if list_to_set:
-        _set_fun = '_set_ntp_{what}'.format(what=name)
-        _set = _exec_fun(_set_fun, list_to_set)
-        if _set.get('result'):
-            expected_config_change = True
-        else:  # something went wrong...
-            successfully_changed = False
-            comment += 'Cannot set NTP {what}: {reason}'.format(
-                what=name,
-                reason=_set.get('comment')
-            )
+    '''
+    Builds a template including the set and delete templates of the driver, for all the changes,
+    so they are rendered and loaded as one candidate configuration.
+    Returns the template source and its variables.
+    '''
 
-    if list_to_delete:
-        _delete_fun = '_delete_ntp_{what}'.format(what=name)
-        _removed = _exec_fun(_delete_fun, list_to_delete)
-        if _removed.get('result'):
-            expected_config_change = True
-        else:  # something went wrong...
-            successfully_changed = False
-            comment += 'Cannot remove NTP {what}: {reason}'.format(
-                what=name,
-                reason=_removed.get('comment')
-            )
+    template_lines = []
+    template_vars = {}
 
-    _ret.update({
-        'successfully_changed': successfully_changed,
-        'expected_config_change': expected_config_change,
-        'comment': comment
-    })
+    for what in NTP_ENTITIES:
+        for change, template_name in NTP_TEMPLATES:
+            entities = changes.get(what, {}).get(change)
+            if not entities:
+                continue
+            template_name = template_name.format(what=what)
+            template_vars[template_name] = entities
+            template_lines.extend([
+                '{{%- set {what} = {template_name} %}}'.format(what=what, template_name=template_name),
+                '{{% include \'{template_name}.j2\' %}}'.format(template_name=template_name)
+            ])
 
-    return _ret
+    return '\n'.join(template_lines), template_vars
 
 
 # ----------------------------------------------------------------------------------------------------------------------
@@ -300,6 +351,9 @@ def managed(name, peers=None, servers=None):
     Manages the configuration of NTP peers and servers on the device, as specified in the state SLS file.
     NTP entities not specified in these lists will be removed whilst entities not configured on the device will be set.
 
+    The peers and servers are retrieved once, and all the changes are loaded as one candidate configuration,
+    compared and committed once.
+
     SLS Example:
 
     .. code-block:: yaml
@@ -320,7 +374,7 @@ def managed(name, peers=None, servers=None):
         {
             'edge01.nrt04': {
                 'netntp_|-netntp_example_|-netntp_example_|-managed': {
-                    'comment': 'NTP servers already configured as needed.',
+                    'comment': 'This is in testing mode, the device configuration was not changed!',
                     'name': 'netntp_example',
                     'start_time': '12:45:24.056659',
                     'duration': 2938.857,
@@ -343,50 +397,43 @@ def managed(name, peers=None, servers=None):
     '''
 
     ret = _default_ret(name)
-    result = ret.get('result', False)
-    comment = ret.get('comment', '')
-    changes = ret.get('changes', {})
 
     if not(isinstance(peers, list) or isinstance(servers, list)):  # none of the is a list
         return ret  # just exit
 
-    if isinstance(peers, list) and not _check(peers):  # check and clean peers
-        ret['comment'] = 'NTP peers must be a list of valid IP Addresses or Domain Names'
-        return ret
-
-    if isinstance(servers, list) and not _check(servers):  # check and clean servers
-        ret['comment'] = 'NTP servers must be a list of valid IP Addresses or Domain Names'
-        return ret
+    if isinstance(peers, list):
+        peers = _check(peers)  # check and clean peers
+        if peers is None:
+            ret['comment'] = 'NTP peers must be a list of valid IP Addresses or Domain Names'
+            return ret
 
-    # ----- Retrieve existing NTP peers and determine peers to be added/removed --------------------------------------->
+    if isinstance(servers, list):
+        servers = _check(servers)  # check and clean servers
+        if servers is None:
+            ret['comment'] = 'NTP servers must be a list of valid IP Addresses or Domain Names'
+            return ret
 
-    successfully_changed = True
-    expected_config_change = False
+    # ----- Retrieve existing NTP peers and servers and determine the entities to be added/removed ------------------->
 
+    desired = {}
     if isinstance(peers, list):
-        _peers_ret = _check_diff_and_configure(name, peers, name='peers')
-        expected_config_change = _peers_ret.get('expected_config_change', False)
-        successfully_changed = _peers_ret.get('successfully_changed', True)
-        result = result and _peers_ret.get('result', False)
-        comment += ('\n' + _peers_ret.get('comment', ''))
-        _changed_peers = _peers_ret.get('changes', {})
-        if _changed_peers:
-            changes['peers'] = _changed_peers
+        desired['peers'] = peers
     if isinstance(servers, list):
-        _servers_ret = _check_diff_and_configure(name, servers, name='servers')
-        expected_config_change = expected_config_change or _servers_ret.get('expected_config_change', False)
-        successfully_changed = successfully_changed and _servers_ret.get('successfully_changed', True)
-        result = result and _servers_ret.get('result', False)
-        comment += ('\n' + _servers_ret.get('comment', ''))
-        _changed_servers = _servers_ret.get('changes', {})
-        if _changed_servers:
-            changes['servers'] = _changed_servers
+        desired['servers'] = servers
+
+    configured, retrieve_comment = _retrieve_ntp_config(desired)
+
+    if configured is None:
+        ret['comment'] = retrieve_comment
+        return ret
+
+    changes = _diff(configured, desired)
 
     ret.update({
         'changes': changes
     })
 
-    if not (changes or expected_config_change):
+    if not changes:
         ret.update({
             'result': True,
             'comment': 'Device configured properly.'
@@ -400,20 +447,34 @@ def managed(name, peers=None, servers=None):
         })
         return ret
 
-    # <---- Call _set_ntp_peers and _delete_ntp_peers as needed --------------------------------------------------------
+    # <---- Retrieve existing NTP peers and servers and determine the entities to be added/removed --------------------
+
+    # ----- Load and commit all the changes in one candidate configuration ------------------------------------------->
+
+    template_source, template_vars = _changes_template(changes)
+
+    loaded = __salt__['net.load_template']('ntp_changes',
+                                           template_source=template_source,
+                                           commit=True,  # committed right after the single comparison
+                                           **template_vars)
 
-    # ----- Try to commit changes ------------------------------------------------------------------------------------->
+    if not loaded.get('result'):
+        ret['comment'] = 'Cannot load the NTP changes: {reason}'.format(reason=loaded.get('comment'))
+        return ret
 
-    if expected_config_change:  # commit only in case there's something to update
-        config_result, config_comment = __salt__['net.config_control']()
-        result = config_result and successfully_changed
-        comment += config_comment
+    if loaded.get('already_configured') or not loaded.get('diff'):
+        # the templates did not produce any change on the device
+        ret.update({
+            'result': True,
+            'comment': 'Device configured properly.'
+        })
+        return ret
 
-    # <---- Try to commit changes --------------------------------------------------------------------------------------
+    # <---- Load and commit all the changes in one candidate configuration --------------------------------------------
 
     ret.update({
-        'result': result,
-        'comment': comment
+        'result': True,
+        'comment': 'NTP configuration updated.'
     })
 
     return ret